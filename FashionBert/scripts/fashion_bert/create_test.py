@@ -3,6 +3,7 @@ import numpy as np
 import csv
 import datetime
 import argparse
+from fashion_records import FashionBertRecords, write_pairs, MASKED_FIELDS
 
 # 0: feature
 # 1: image_mask SAME
@@ -17,6 +18,10 @@ import argparse
 
 
 def main(args):
+    if args.format == "binary":
+        main_binary(args)
+        return
+
     folder = "eval_img2txt" if args.type == "i2t" else "eval_txt2img"
     file = "{}/eval_img2txt/{}".format(args.bert_path, args.name_data)
     outfile = "{}/{}/{}".format(args.bert_path, folder, args.name_out)
@@ -28,53 +33,57 @@ def main(args):
     elif args.split == "train":
         train(args, data_im, data_text, ids, outfile)
 
+# pairs of the records in {bert_path}/eval_img2txt/{name_data} written as {name_out}_pairs.npy
+def main_binary(args):
+    record_dir = "{}/eval_img2txt/{}".format(args.bert_path, args.name_data)
+    records = FashionBertRecords(record_dir)
+    ids = list(range(len(records.captions)))
+    captions = np.asarray(records.input_ids)
+
+    if args.split == "test":
+        pairs = [row for row in test_pairs(args, ids)]
+        write_pairs(record_dir, args.name_out, pairs)
+    elif args.split == "train":
+        rows = [row for row in train_pairs(ids, captions)]
+        masked = {field: np.stack([row[3 + k] for row in rows]) for k, field in enumerate(MASKED_FIELDS)}
+        write_pairs(record_dir, args.name_out, [row[:3] for row in rows], masked)
+
 def train(args, data_im, data_text, ids, outfile):
+    captions = {id: np.array(data_text[id][0].split(","), dtype=int) for id in ids}
+    image_mask = ','.join(map(str, np.ones(64, dtype=int)))
+    segment_ids = ','.join(map(str, np.zeros(64, dtype=int)))
+    to_str = lambda array: ','.join(map(str, array))
+
     with open(outfile, 'w', newline='') as csvfile:
         writer = csv.writer(csvfile, delimiter='\t')
 
-        for i in range(len(ids)):
+        for image_id, caption_id, label, masked_patch_pos, masked_lm_positions, masked_lm_ids, masked_lm_weights \
+                in train_pairs(ids, captions):
+            input_mask = create_mask(length_cap(data_text[caption_id][0]))
+            writer.writerow((data_im[image_id], image_mask, to_str(masked_patch_pos),
+                            data_text[caption_id][0], input_mask, segment_ids,
+                            to_str(masked_lm_positions), to_str(masked_lm_ids), to_str(masked_lm_weights),
+                            int(label)))
 
-            print("{}: [{}/{}]".format(datetime.datetime.now().time(), i, len(ids)))
+# for every query the true pair and 1 false pair with the masks of the pre-training objectives
+# --> rows (image id, caption id, label, masked_patch_pos, masked_lm_positions, masked_lm_ids, masked_lm_weights)
+def train_pairs(ids, captions):
+    for i in range(len(ids)):
 
-            query_id = ids[i]
+        print("{}: [{}/{}]".format(datetime.datetime.now().time(), i, len(ids)))
 
-            filtered_ids = list_remove(ids, i)
-            random_ids = random.sample(filtered_ids, 1)
+        query_id = ids[i]
 
-            length = length_cap(data_text[query_id][0])
+        filtered_ids = list_remove(ids, i)
+        random_ids = random.sample(filtered_ids, 1)
 
-            # create all the data needed
-            image_mask = ','.join(map(str, np.ones(64, dtype=int)))
+        for target_id, label in [(query_id, 1)] + [(target_id, 0) for target_id in random_ids]:
+            length = int(np.count_nonzero(captions[target_id]))
             masked_patch_pos = mask_pp()
-            segment_ids = ','.join(map(str, np.zeros(64, dtype=int)))
-            masked_lm_positions, masked_lm_ids, masked_lm_weights = mask_lm(length, data_text[query_id][0])
-            input_mask = create_mask(length)
-
-            # write true pair
-            writer.writerow((data_im[query_id], image_mask, masked_patch_pos,
-                            data_text[query_id][0], input_mask, segment_ids,
-                            masked_lm_positions, masked_lm_ids, masked_lm_weights,
-                            int(1)))
-
-            # write 1 false pairs
-            for j in range(len(random_ids)):
-                target_id = random_ids[j]
-                length = length_cap(data_text[target_id][0])
-
-                masked_patch_pos = mask_pp()
-                masked_lm_positions, masked_lm_ids, masked_lm_weights = mask_lm(length, data_text[target_id][0])
-                input_mask = create_mask(length)
-
-                # write true pair
-                writer.writerow((data_im[query_id], image_mask, masked_patch_pos,
-                                data_text[target_id][0], input_mask, segment_ids,
-                                masked_lm_positions, masked_lm_ids, masked_lm_weights,
-                                int(0)))
-
+            yield (query_id, target_id, label, masked_patch_pos) + mask_lm(length, captions[target_id])
 
 
 def mask_lm(length, caption_ids):
-    caption_ids = caption_ids.split(",")
     mask_pos = np.zeros(10, dtype=int)
     mask_ids = np.zeros(10, dtype=int)
     mask_weights = np.zeros(10)
@@ -97,19 +106,28 @@ def mask_lm(length, caption_ids):
         mask_ids[0] = int(caption_ids[n])
         mask_weights[0] = 1.0
 
-    str_pos = ','.join(map(str, mask_pos))
-    str_ids = ','.join(map(str, mask_ids))
-    str_weights = ','.join(map(str, mask_weights))
-
-    return str_pos, str_ids, str_weights
+    return mask_pos, mask_ids, mask_weights
 
 def mask_pp():
     data = [i for i in range(64)]
     random.shuffle(data)
     sample = random.sample(data, 5)
-    return ','.join(map(str, sample))
+    return np.array(sample, dtype=int)
 
 def test(args, data_im, data_text, ids, outfile):
+    image_mask = ','.join(map(str, np.ones(64, dtype=int)))
+    segment_ids = ','.join(map(str, np.zeros(64, dtype=int)))
+
+    with open(outfile, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, delimiter='\t')
+
+        for image_id, caption_id, label in test_pairs(args, ids):
+            input_mask = create_mask(length_cap(data_text[caption_id][0]))
+            writer.writerow((data_im[image_id], image_mask, data_text[caption_id][0], input_mask, segment_ids, int(label),
+                             data_text[caption_id][1], caption_id, image_id, str(image_id)+"_0"))
+
+# for every query of the half the true pair followed by 100 false pairs --> rows (image id, caption id, label)
+def test_pairs(args, ids):
     if args.half == "first":
         start = 0
         end = 500
@@ -117,36 +135,25 @@ def test(args, data_im, data_text, ids, outfile):
         start = 500
         end = 1000
 
-    with open(outfile, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile, delimiter='\t')
-
-        for i in range(start, end):
-
-            print("{}: [{}/{}]".format(datetime.datetime.now().time(), i, len(data_im)))
-
-            query_id = ids[i]
+    for i in range(start, end):
 
-            filtered_ids = list_remove(ids, i)
-            random_ids = random.sample(filtered_ids, 100)
+        print("{}: [{}/{}]".format(datetime.datetime.now().time(), i, len(ids)))
 
-            image_mask = ','.join(map(str, np.ones(64, dtype=int)))
-            segment_ids = ','.join(map(str, np.zeros(64, dtype=int)))
-            length = length_cap(data_text[query_id][0])
-            input_mask = create_mask(length)
+        query_id = ids[i]
 
-            # write true pair
-            writer.writerow((data_im[query_id], image_mask, data_text[query_id][0], input_mask, segment_ids, int(1), data_text[query_id][1], query_id, query_id, str(query_id)+"_0"))
+        filtered_ids = list_remove(ids, i)
+        random_ids = random.sample(filtered_ids, 100)
 
+        # true pair
+        yield query_id, query_id, 1
 
-            # write 100 false pairs
-            for j in range(len(random_ids)):
-                target_id = random_ids[j]
-                if args.type == "i2t":
-                    length = length_cap(data_text[target_id][0])
-                    input_mask = create_mask(length)
-                    writer.writerow((data_im[query_id], image_mask, data_text[target_id][0], input_mask, segment_ids, int(0), data_text[target_id][1], target_id, query_id, str(query_id)+"_0"))
-                else:
-                    writer.writerow((data_im[target_id], image_mask, data_text[query_id][0], input_mask, segment_ids, int(0), data_text[query_id][1], query_id, target_id, str(target_id)+"_0"))
+        # 100 false pairs
+        for j in range(len(random_ids)):
+            target_id = random_ids[j]
+            if args.type == "i2t":
+                yield query_id, target_id, 0
+            else:
+                yield target_id, query_id, 0
 
 def create_mask(length):
     input_mask = np.concatenate([np.ones(length, dtype=int), np.zeros(64-length, dtype=int)])
@@ -192,6 +199,7 @@ if __name__ == '__main__':
     parser.add_argument('--type',help='t2i or i2t', default="i2t", type=str)
     parser.add_argument('--half',help='first or second half', default="first", type=str)
     parser.add_argument('--split',help='train, val, test', default="test", type=str)
+    parser.add_argument('--format',help='tsv: name_data is a TSV file, binary: name_data is a record directory', default="tsv", type=str)
 
     args = parser.parse_args()
 
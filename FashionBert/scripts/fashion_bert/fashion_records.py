@@ -0,0 +1,133 @@
+import os
+import json
+import numpy as np
+
+"""
+Binary records of the FashionBERT data, instead of rows of comma joined strings
+
+A record directory holds every image and caption once:
+    features.npy    (n, 64, dim) patch features of every image, float32 or float16
+    input_ids.npy   (n, 64) int32 token ids of every caption
+    input_mask.npy  (n, 64) int8
+    prod_ids.npy    (n,) int64 id of the product, as the ids of the TSV rows
+    captions.txt    one caption per line
+    meta.json
+
+Image i and caption i are of the same product. A set of pairs (e.g. the 1 + 100 pairs of every test
+query) is stored as {name}_pairs.npy, (n_pairs, 3) int64 (image_idx, caption_idx, label) triples, with
+the masks of the pre-training objectives in {name}_masked_*.npy when the pairs are for training.
+image_mask and segment_ids are the same for every row (all ones and all zeros) and are not stored.
+
+All arrays are memory-mapped, FashionBertRecords.batch only copies the rows of a batch.
+"""
+
+N_PATCHES = 64
+SEQ_LEN = 64
+MASKED_FIELDS = ["masked_patch_positions", "masked_lm_positions", "masked_lm_ids", "masked_lm_weights"]
+
+
+class RecordWriter(object):
+    """Writes the records of n images and captions, row by row"""
+
+    def __init__(self, record_dir, n, feature_dim, dtype=np.float32):
+        if not os.path.exists(record_dir):
+            os.makedirs(record_dir)
+        self.record_dir = record_dir
+        self.n = n
+        self.features = self._open("features", dtype, (n, N_PATCHES, feature_dim))
+        self.input_ids = self._open("input_ids", np.int32, (n, SEQ_LEN))
+        self.input_mask = self._open("input_mask", np.int8, (n, SEQ_LEN))
+        self.prod_ids = self._open("prod_ids", np.int64, (n,))
+        self.captions = [""] * n
+
+    def _open(self, name, dtype, shape):
+        return np.lib.format.open_memmap(os.path.join(self.record_dir, name + ".npy"), mode='w+',
+                                         dtype=dtype, shape=shape)
+
+    def write(self, i, features, input_ids, prod_id, caption):
+        self.features[i] = features.reshape(N_PATCHES, -1)
+        self.input_ids[i] = input_ids
+        self.input_mask[i] = np.asarray(input_ids) != 0
+        self.prod_ids[i] = prod_id
+        self.captions[i] = caption.replace("\n", " ")
+
+    def close(self, n=None):
+        """n: number of rows written, when less than the rows allocated"""
+        n = self.n if n is None else n
+        for array in [self.features, self.input_ids, self.input_mask, self.prod_ids]:
+            array.flush()
+        with open(os.path.join(self.record_dir, "captions.txt"), 'w') as f:
+            for caption in self.captions[:n]:
+                f.write(caption + "\n")
+        with open(os.path.join(self.record_dir, "meta.json"), 'w') as f:
+            json.dump({"n": n, "n_patches": N_PATCHES, "seq_len": SEQ_LEN,
+                       "feature_dim": self.features.shape[2], "dtype": self.features.dtype.name}, f)
+
+
+def write_pairs(record_dir, name, pairs, masked=None):
+    """
+    pairs: (n_pairs, 3) (image_idx, caption_idx, label)
+    masked: arrays of MASKED_FIELDS with n_pairs rows, for training pairs
+    """
+    np.save(os.path.join(record_dir, "{}_pairs.npy".format(name)), np.asarray(pairs, dtype=np.int64))
+    if masked is not None:
+        for field, dtype in zip(MASKED_FIELDS, [np.int32, np.int32, np.int32, np.float32]):
+            np.save(os.path.join(record_dir, "{}_{}.npy".format(name, field)), np.asarray(masked[field], dtype=dtype))
+
+
+class FashionBertRecords(object):
+    """Memory-mapped records of a record directory, with the pairs of name when it is given"""
+
+    def __init__(self, record_dir, name=None):
+        with open(os.path.join(record_dir, "meta.json"), 'r') as f:
+            self.meta = json.load(f)
+        n = self.meta["n"]
+
+        load = lambda file: np.load(os.path.join(record_dir, file), mmap_mode='r')
+        self.features = load("features.npy")[:n]
+        self.input_ids = load("input_ids.npy")[:n]
+        self.input_mask = load("input_mask.npy")[:n]
+        self.prod_ids = load("prod_ids.npy")[:n]
+        with open(os.path.join(record_dir, "captions.txt"), 'r') as f:
+            self.captions = [line.rstrip("\n") for line in f]
+
+        self.pairs = None
+        self.masked = None
+        if name is not None:
+            self.pairs = load("{}_pairs.npy".format(name))
+            if os.path.exists(os.path.join(record_dir, "{}_{}.npy".format(name, MASKED_FIELDS[0]))):
+                self.masked = {field: load("{}_{}.npy".format(name, field)) for field in MASKED_FIELDS}
+
+    def __len__(self):
+        return len(self.pairs) if self.pairs is not None else len(self.captions)
+
+    def batch(self, start, end):
+        """
+        Pairs start to end. The features of every image are in the batch once, image_pos is the row of the
+        image of every pair in features; when the images are consecutive, features is a view of the memmap
+        --> dict of arrays
+        """
+        pairs = np.asarray(self.pairs[start:end])
+        image_idx, caption_idx = pairs[:, 0], pairs[:, 1]
+
+        images, image_pos = np.unique(image_idx, return_inverse=True)
+        if images[-1] - images[0] + 1 == len(images):
+            features = self.features[images[0]:images[-1] + 1]
+        else:
+            features = self.features[images]
+
+        n_pairs = len(pairs)
+        batch = {"features": features, "image_pos": image_pos,
+                 "image_mask": np.ones((n_pairs, N_PATCHES), dtype=np.int8),
+                 "input_ids": self.input_ids[caption_idx], "input_mask": self.input_mask[caption_idx],
+                 "segment_ids": np.zeros((n_pairs, SEQ_LEN), dtype=np.int8),
+                 "nx_sent_labels": pairs[:, 2], "image_idx": image_idx, "caption_idx": caption_idx,
+                 "text_prod_id": self.prod_ids[caption_idx], "image_prod_id": self.prod_ids[image_idx]}
+        if self.masked is not None:
+            for field in MASKED_FIELDS:
+                batch[field] = self.masked[field][start:end]
+        return batch
+
+    def batches(self, batch_size):
+        for start in range(0, len(self), batch_size):
+            yield self.batch(start, min(start + batch_size, len(self)))
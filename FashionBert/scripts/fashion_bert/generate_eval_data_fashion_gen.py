@@ -16,10 +16,13 @@ import math
 import h5py
 import random
 import string
+import threading
+from queue import Queue
 
 sys.path.append('../../easytransfer/preprocessors')
 sys.path.append('/home/kgoei/thesis/FashionBert/easytransfer/preprocessors')
 from tokenization import WordpieceTokenizer
+from fashion_records import RecordWriter
 
 " File to convert fashion-gen data to right format "
 def main(args):
@@ -42,36 +45,61 @@ def main(args):
     # retrieve requiered model with correct transfrom
     net, transform = get_model(args, device)
 
-    create_data(captions, net, transform, args, device, f)
+    if args.format == "binary":
+        create_records(captions, net, transform, args, device, f)
+    else:
+        create_data(captions, net, transform, args, device, f)
 
 def create_data(captions, net, transform, args, device, f):
     vocab = get_vocab("{}/fashionbert_pretrain_model_fin/vocab.txt".format(args.bert_dir))
     tokenizer = WordpieceTokenizer(vocab=vocab)
+
+    n = len(captions) if args.early_stop is None else min(args.early_stop, len(captions))
+    # features = ','.join(map(str, np.ones(131072, dtype=float)))
+    image_mask = ','.join(map(str, np.ones(64, dtype=int)))
+    segment_ids = ','.join(map(str, np.zeros(64, dtype=int)))
+
     # open .txt file
     with open('{}/{}/data_caption_{}.txt'.format(args.bert_dir, args.data_out, args.split), 'w', newline='') as csvfile:
         writer = csv.writer(csvfile, delimiter='\t')
-        count = 0
-        for i in range(len(captions)):
-            id = captions[i][0]
-            caption = captions[i][1].lower()
-            image = f["input_image"][i]
-            features = get_features( image, net, transform, device, args.batch_size)
 
-            # features = ','.join(map(str, np.ones(131072, dtype=float)))
-            image_mask = ','.join(map(str, np.ones(64, dtype=int)))
-            segment_ids = ','.join(map(str, np.zeros(64, dtype=int)))
+        def write(i, features):
+            caption = captions[i][1].lower()
+            features = ','.join(map(str, features.flatten()))
 
             caption_ids = word2id(vocab, tokenizer, caption)
 
             input_ids = ','.join(map(str, caption_ids))
 
             writer.writerow((features, image_mask, input_ids, image_mask, segment_ids, int(0), caption, str(i), str(i), str(i)+"_0"))
-            count += 1
-            if count % 10 == 0:
-                print(count)
+            if (i + 1) % 10 == 0:
+                print(i + 1)
+
+        get_features(f["input_image"], n, net, transform, device, args.batch_size, args.slab_size, write)
+
+# same data as create_data, as binary records in {bert_dir}/{data_out}/records_{split}
+def create_records(captions, net, transform, args, device, f):
+    vocab = get_vocab("{}/fashionbert_pretrain_model_fin/vocab.txt".format(args.bert_dir))
+    tokenizer = WordpieceTokenizer(vocab=vocab)
+
+    n = len(captions) if args.early_stop is None else min(args.early_stop, len(captions))
+    record_dir = '{}/{}/records_{}'.format(args.bert_dir, args.data_out, args.split)
+    writer = None
+
+    def write(i, features):
+        nonlocal writer
+        caption = captions[i][1].lower()
 
-            if args.early_stop == count:
-                break
+        # the feature size is known after the first image
+        if writer is None:
+            writer = RecordWriter(record_dir, n, features.shape[-1], np.float16 if args.fp16 else np.float32)
+        writer.write(i, features, word2id(vocab, tokenizer, caption), i, caption)
+
+        if (i + 1) % 10 == 0:
+            print(i + 1)
+
+    get_features(f["input_image"], n, net, transform, device, args.batch_size, args.slab_size, write)
+    writer.close()
 
 def word2id(vocab, tokenizer, caption, length=64):
     caption = tokenizer.tokenize(caption)
@@ -91,26 +119,51 @@ def get_vocab(file):
         vocab[x.strip()] = i
     return vocab
 
-def get_features(image, net, transform, device, batch_size):
-    n_segs = 64
-
-
-    segments = segment_dresses(image, n_segs, transform)
-
-    stack = []
-    for i in range(int(n_segs/batch_size)):
-        print(i)
-        seg_part = segments[i*batch_size:(i+1)*batch_size].to(device)
-        dict = net(seg_part)
-        features_seg = dict.detach().to("cpu")
-        del dict
-        torch.cuda.empty_cache()
-        stack.append(features_seg)
+def get_features(images, n, net, transform, device, batch_size, slab_size, write, n_segs=64):
+    """
+    Patch features of the first n images of the HDF5 dataset. The images are read in slabs of slab_size and
+    tiled at once; a background thread pushes the patches of a slab through the net in batches of batch_size
+    patches, mixing images, and calls write(i, features (n_segs, dim)) for every image in order
+    """
+    queue = Queue(maxsize=2)
+    errors = []
 
-    hidden_features = torch.cat(stack, dim=0)
-    features = hidden_features.numpy().flatten()
-    features = ','.join(map(str, features))
-    return features
+    def backbone():
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    return
+                start, patches = item
+
+                stack = []
+                with torch.no_grad():
+                    for i in range(0, len(patches), batch_size):
+                        seg_part = transform(patches[i:i+batch_size]).to(device)
+                        stack.append(net(seg_part).to("cpu"))
+                features = torch.cat(stack, dim=0)
+                features = features.view(-1, n_segs, features.shape[-1]).numpy()
+
+                for k in range(len(features)):
+                    write(start + k, features[k])
+        except Exception as e:
+            errors.append(e)
+            # keep taking the slabs so the reader is never blocked
+            while queue.get() is not None:
+                pass
+
+    thread = threading.Thread(target=backbone, daemon=True)
+    thread.start()
+
+    for start in range(0, n, slab_size):
+        if len(errors) > 0:
+            break
+        queue.put((start, segment_dresses(images[start:min(start+slab_size, n)], n_segs)))
+    queue.put(None)
+    thread.join()
+
+    if len(errors) > 0:
+        raise errors[0]
 
 # get the captions and ids from the caption text file
 def get_captions(f, args):
@@ -154,9 +207,10 @@ def get_model(args, device):
     # set to evaluation
     net.eval()
 
+    # works on batches of uint8 patches (B, C, H, W), as ToTensor on every patch would
     transform = transforms.Compose([
         transforms.CenterCrop((224, 224)),
-        transforms.ToTensor(),
+        transforms.ConvertImageDtype(torch.float),
         transforms.Normalize(mean=[0.485, 0.456, 0.406],
                               std=[0.229, 0.224, 0.225])])
 
@@ -168,15 +222,16 @@ def get_model(args, device):
 
     return net, transform
 
-def segment_dresses(im, tiles, transform):
+# tile a slab of images (B, H, W, C) in rows x rows patches --> (B * tiles, C, H // rows, W // rows) uint8
+def segment_dresses(ims, tiles):
     rows = int(math.sqrt(tiles))
-    M = im.shape[0]//rows
-    N = im.shape[1]//rows
-
-    # tile images, convert to PIL and transform them directly
-    tiles = [transform(Image.fromarray(im[x:x+M,y:y+N])) for x in range(0,rows*M,M) for y in range(0,rows*N,N)]
+    M = ims.shape[1]//rows
+    N = ims.shape[2]//rows
 
-    stacked_segments = torch.stack(tiles, dim=0)
+    ims = torch.from_numpy(np.ascontiguousarray(ims)).permute(0, 3, 1, 2)[:, :, :rows*M, :rows*N]
+    # (B, C, rows, rows, M, N), patches row by row
+    patches = ims.unfold(2, M, M).unfold(3, N, N)
+    stacked_segments = patches.permute(0, 2, 3, 1, 4, 5).reshape(-1, ims.shape[1], M, N)
 
     return stacked_segments
 
@@ -187,7 +242,8 @@ def parse_args():
     """
     parser = argparse.ArgumentParser(description='Generate features from image')
     parser.add_argument('--early_stop',help='take lower number of samples for testing purpose', default=None, type=int)
-    parser.add_argument('--batch_size',help='', default=8, type=int)
+    parser.add_argument('--batch_size',help='patches per forward pass, of several images', default=256, type=int)
+    parser.add_argument('--slab_size',help='images read and tiled at once', default=32, type=int)
 
     parser.add_argument('--data_dir',help='location data directory', default="../../../data/Fashion_gen/all", type=str)
     parser.add_argument('--bert_dir',help='location data directory', default=".", type=str)
@@ -195,6 +251,8 @@ def parse_args():
     parser.add_argument('--clothing',help='clothing focus', default="all", type=str)
     parser.add_argument('--split',help='train, val, test', default="train", type=str)
     parser.add_argument('--filename', default="fashiongen_256_256_",help='path to training file')
+    parser.add_argument('--format',help='tsv: comma joined rows, binary: memory-mapped records (fashion_records.py)', default="tsv", type=str)
+    parser.add_argument('--fp16', action='store_true', help="store the binary features in float16")
 
     args = parser.parse_args()
 
@@ -0,0 +1,88 @@
+import copy
+import time
+import argparse
+import torch
+import torchvision
+
+from modules import LARS
+
+"""
+Micro-benchmark of the LARS step on the parameters of a ResNet-50 with random gradients:
+the multi-tensor step of modules/lars.py against the former step, one parameter at a time
+with a host sync (.item()) on every trust ratio. Both are checked to give the same parameters.
+"""
+
+# python benchmark_lars.py --device cuda --steps 50
+
+
+def reference_step(params, state, lr, momentum, weight_decay, eeta):
+    """the former LARS.step, weight decay and layer adaptation for every parameter"""
+    for p in params:
+        param = p.data
+        grad = p.grad.data + weight_decay * param
+
+        w_norm = torch.norm(param)
+        g_norm = torch.norm(grad)
+
+        device = g_norm.device
+        trust_ratio = torch.where(
+            w_norm.gt(0),
+            torch.where(g_norm.gt(0), (eeta * w_norm / g_norm), torch.Tensor([1.0]).to(device)),
+            torch.Tensor([1.0]).to(device),
+        ).item()
+
+        scaled_lr = lr * trust_ratio
+        if p not in state:
+            state[p] = torch.zeros_like(p.data)
+        next_v = state[p]
+        next_v.mul_(momentum).add_(grad, alpha=scaled_lr)
+        p.data.add_(-next_v)
+
+
+def timed(step, steps, device):
+    step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(steps):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.time() - start) / steps
+
+
+def main(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+
+    model = torchvision.models.resnet50().to(device)
+    reference = copy.deepcopy(model)
+    for p, q in zip(model.parameters(), reference.parameters()):
+        p.grad = torch.randn_like(p) * 1e-3
+        q.grad = p.grad.clone()
+
+    lr = 0.3 * args.batch_size / 256
+    optimizer = LARS(model.parameters(), lr=lr, weight_decay=args.weight_decay)
+    ref_params = list(reference.parameters())
+    ref_state = {}
+
+    lars_time = timed(optimizer.step, args.steps, device)
+    ref_time = timed(lambda: reference_step(ref_params, ref_state, lr, 0.9, args.weight_decay, 0.001),
+                     args.steps, device)
+
+    diff = max((p - q).abs().max().item() for p, q in zip(model.parameters(), reference.parameters()))
+    print("{} parameter tensors on {}".format(len(ref_params), device))
+    print("reference step: {:.2f} ms".format(ref_time * 1000))
+    print("LARS step:      {:.2f} ms ({:.1f}x)".format(lars_time * 1000, ref_time / lars_time))
+    print("max parameter difference: {:.2e}".format(diff))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the LARS step")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str)
+    parser.add_argument("--steps", default=20, type=int)
+    parser.add_argument("--batch_size", default=128, type=int, help="sets the learning rate as in model.py")
+    parser.add_argument("--weight_decay", default=1.0e-6, type=float)
+
+    args = parser.parse_args()
+    main(args)
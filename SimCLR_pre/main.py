@@ -16,24 +16,36 @@ except ImportError:
 
 from model import load_model, save_model
 from modules import NT_Xent
-from modules.transformations import TransformsSimCLR
-from utils import mask_correlated_samples, post_config_hook
+from modules.transformations import TransformsSimCLR, BatchTransformsSimCLR
+from utils import post_config_hook
+from utils.image_store import ImageStore
 
 #### pass configuration
 from experiment import ex
 
 
-def train(args, train_loader, model, criterion, optimizer, writer):
+def train(args, train_loader, model, criterion, optimizer, writer, batch_transform=None):
     loss_epoch = 0
-    for step, ((x_i, x_j), _) in enumerate(train_loader):
+    for step, (x, _) in enumerate(train_loader):
 
         optimizer.zero_grad()
-        x_i = x_i.to(args.device)
-        x_j = x_j.to(args.device)
+        if batch_transform is not None:
+            # both views of the uint8 images of the store, augmented on the device within their valid size
+            x, sizes = x
+            x_i, x_j = batch_transform(x.to(args.device, non_blocking=True), sizes.to(args.device))
+        else:
+            x_i, x_j = x
+            x_i = x_i.to(args.device)
+            x_j = x_j.to(args.device)
 
         # positive pair, with encoding
-        h_i, z_i = model(x_i)
-        h_j, z_j = model(x_j)
+        if getattr(args, "fused_views", False):
+            # one forward and backward pass for both views, batch norm statistics are over both
+            h, z = model(torch.cat((x_i, x_j), dim=0))
+            z_i, z_j = z.chunk(2, dim=0)
+        else:
+            h_i, z_i = model(x_i)
+            h_j, z_j = model(x_j)
 
         loss = criterion(z_i, z_j)
 
@@ -64,8 +76,13 @@ def main(_run, _log):
     root = args.root
 
     train_sampler = None
+    batch_transform = None
 
-    if args.dataset == "STL10":
+    if getattr(args, "image_store", ""):
+        print("loading image store")
+        train_dataset = ImageStore(args.image_store)
+        batch_transform = BatchTransformsSimCLR()
+    elif args.dataset == "STL10":
         train_dataset = torchvision.datasets.STL10(
             root, split="unlabeled", download=True, transform=TransformsSimCLR()
         )
@@ -87,6 +104,7 @@ def main(_run, _log):
         drop_last=True,
         num_workers=args.workers,
         sampler=train_sampler,
+        pin_memory=batch_transform is not None and args.device.type == "cuda",
     )
 
     model, optimizer, scheduler = load_model(args, train_loader)
@@ -95,15 +113,14 @@ def main(_run, _log):
     os.makedirs(tb_dir)
     writer = SummaryWriter(log_dir=tb_dir)
 
-    mask = mask_correlated_samples(args)
-    criterion = NT_Xent(args.batch_size, args.temperature, mask, args.device)
+    criterion = NT_Xent(args.batch_size, args.temperature, args.device, getattr(args, "loss_chunk", 0))
 
     args.global_step = 0
     args.current_epoch = 0
     for epoch in range(args.start_epoch, args.epochs):
         print("start running experiment")
         lr = optimizer.param_groups[0]['lr']
-        loss_epoch = train(args, train_loader, model, criterion, optimizer, writer)
+        loss_epoch = train(args, train_loader, model, criterion, optimizer, writer, batch_transform)
 
         if scheduler:
             scheduler.step()
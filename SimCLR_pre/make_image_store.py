@@ -0,0 +1,25 @@
+import argparse
+from torchvision.datasets import ImageFolder
+
+from utils.image_store import write_image_store
+
+"""
+Writes the pre-resized uint8 store of an image folder, set image_store in config/config.yaml to its path
+to pretrain on it with the batched augmentations
+"""
+
+# python make_image_store.py --root ../data/Fashion200K/all/pictures_only --out ../data/Fashion200K/simclr_store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a pre-resized uint8 image store")
+    parser.add_argument("--root", default="../data/Fashion200K/all/pictures_only", type=str, help="image folder")
+    parser.add_argument("--out", required=True, type=str, help="directory of the store")
+    parser.add_argument("--size", default=128, type=int, help="short side of the images is resized to size, the aspect ratio is kept")
+    parser.add_argument("--max_size", default=None, type=int,
+                        help="side of the padded canvas the images are stored in, the long side is at most max_size (default 1.5 * size)")
+    parser.add_argument("--batch_size", default=256, type=int)
+    parser.add_argument("--workers", default=16, type=int)
+
+    args = parser.parse_args()
+    write_image_store(ImageFolder(args.root), args.out, args.size, args.max_size, args.batch_size, args.workers)
@@ -22,10 +22,11 @@ def load_model(args, loader, reload_model=False):
         # (i.e. LearningRate = 0.3 × BatchSize/256) and weight decay of 10−6.
         learning_rate = 0.3 * args.batch_size / 256
         optimizer = LARS(
-            model.parameters(),
+            model.named_parameters(),
             lr=learning_rate,
             weight_decay=args.weight_decay,
-            exclude_from_weight_decay=["batch_normalization", "bias"],
+            # batch norm parameters of the ResNet (bn1, layer1.0.bn2, layer1.0.downsample.1) and biases
+            exclude_from_weight_decay=[r"bn\d*\.", r"downsample\.1\.", "bias"],
         )
 
         # "decay the learning rate with the cosine decay schedule without restarts"
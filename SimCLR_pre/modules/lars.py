@@ -11,6 +11,13 @@ import re
 
 EETA_DEFAULT = 0.001
 
+
+def _norms(tensors):
+    if hasattr(torch, "_foreach_norm"):
+        return list(torch._foreach_norm(tensors))
+    return [torch.norm(t) for t in tensors]
+
+
 class LARS(Optimizer):
     """
     Layer-wise Adaptive Rate Scaling for large batch training.
@@ -49,9 +56,18 @@ class LARS(Optimizer):
             classic momentum, but after momentum for popular momentum.
         eeta: A `float` for scaling of learning rate when computing trust ratio.
         name: The name for the scope.
+
+        params may be model.named_parameters(), the names are matched against
+        exclude_from_weight_decay and exclude_from_layer_adaptation. Parameters
+        without a name are never excluded.
         """
 
         self.epoch = 0
+        params = list(params)
+        self.param_names = {}
+        if len(params) > 0 and isinstance(params[0], tuple):
+            self.param_names = {p: name for name, p in params}
+            params = [p for name, p in params]
         defaults = dict(
             lr=lr,
             momentum=momentum,
@@ -78,7 +94,22 @@ class LARS(Optimizer):
         else:
             self.exclude_from_layer_adaptation = exclude_from_weight_decay
 
+        # the exclusions of every parameter, matched once
+        self.use_decay = {}
+        self.do_adaptation = {}
+        for group in self.param_groups:
+            for p in group["params"]:
+                name = self.param_names.get(p)
+                self.use_decay[p] = name is None or self._use_weight_decay(name)
+                self.do_adaptation[p] = name is None or self._do_layer_adaptation(name)
+        # layer adaptation mask on the device, per set of parameters with a gradient
+        self._adapt_masks = {}
+
     def step(self, epoch=None, closure=None):
+        """
+        One multi-tensor pass per parameter group: the norms and trust ratios of all
+        layers are computed at once on the device, nothing is synced with the host
+        """
         loss = None
         if closure is not None:
             loss = closure()
@@ -93,51 +124,50 @@ class LARS(Optimizer):
             eeta = group["eeta"]
             lr = group["lr"]
 
-            for p in group["params"]:
-                if p.grad is None:
-                    continue
-
-                param = p.data
-                grad = p.grad.data
-
+            params = [p for p in group["params"] if p.grad is not None]
+            if len(params) == 0:
+                continue
+            if not self.classic_momentum:
+                raise NotImplementedError
+
+            param_data = [p.data for p in params]
+            grads = [p.grad.data for p in params]
+            decay = [weight_decay != 0 and self.use_decay[p] for p in params]
+            if any(decay):
+                grads = [g.add(w, alpha=weight_decay) if d else g for g, w, d in zip(grads, param_data, decay)]
+
+            w_norm = torch.stack(_norms(param_data))
+            g_norm = torch.stack(_norms(grads))
+            ones = torch.ones_like(w_norm)
+            trust_ratio = torch.where(
+                w_norm.gt(0),
+                torch.where(g_norm.gt(0), eeta * w_norm / g_norm, ones),
+                ones,
+            )
+            key = tuple(id(p) for p in params)
+            if key not in self._adapt_masks:
+                self._adapt_masks[key] = torch.tensor([self.do_adaptation[p] for p in params],
+                                                      device=trust_ratio.device)
+            adapt = self._adapt_masks[key]
+            scaled_lr = lr * torch.where(adapt, trust_ratio, ones)
+
+            scaled_grads = [g * s for g, s in zip(grads, scaled_lr.unbind())]
+
+            next_v = []
+            for p in params:
                 param_state = self.state[p]
-
-                # TODO: get param names
-                # if self._use_weight_decay(param_name):
-                grad += self.weight_decay * param
-
-                if self.classic_momentum:
-                    trust_ratio = 1.0
-
-                    # TODO: get param names
-                    # if self._do_layer_adaptation(param_name):
-                    w_norm = torch.norm(param)
-                    g_norm = torch.norm(grad)
-
-                    device = g_norm.get_device()
-                    trust_ratio = torch.where(
-                        w_norm.ge(0),
-                        torch.where(g_norm.ge(0), (self.eeta * w_norm / g_norm), torch.Tensor([1.0]).to(device)),
-                        torch.Tensor([1.0]).to(device),
-                    ).item()
-
-                    scaled_lr = lr * trust_ratio
-                    if "momentum_buffer" not in param_state:
-                        next_v = param_state["momentum_buffer"] = torch.zeros_like(
-                            p.data
-                        )
-                    else:
-                        next_v = param_state["momentum_buffer"]
-
-                    next_v.mul_(momentum).add_(scaled_lr, grad)
-                    if self.use_nesterov:
-                        update = (self.momentum * next_v) + (scaled_lr * grad)
-                    else:
-                        update = next_v
-
-                    p.data.add_(-update)
-                else:
-                    raise NotImplementedError
+                if "momentum_buffer" not in param_state:
+                    param_state["momentum_buffer"] = torch.zeros_like(p.data)
+                next_v.append(param_state["momentum_buffer"])
+
+            torch._foreach_mul_(next_v, momentum)
+            torch._foreach_add_(next_v, scaled_grads)
+            if self.use_nesterov:
+                update = torch._foreach_add(torch._foreach_mul(next_v, self.momentum), scaled_grads)
+            else:
+                update = next_v
+
+            torch._foreach_sub_(param_data, update)
 
         return loss
 
@@ -1,35 +1,50 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 class NT_Xent(nn.Module):
 
-    def __init__(self, batch_size, temperature, mask, device):
+    def __init__(self, batch_size, temperature, device, chunk_size=0):
         super(NT_Xent, self).__init__()
         self.batch_size = batch_size
         self.temperature = temperature
-        self.mask = mask
         self.device = device
-
-        self.criterion = nn.CrossEntropyLoss(reduction="sum")
-        self.similarity_f = nn.CosineSimilarity(dim=2)
+        # rows of the logits computed at once, 0 for all rows
+        self.chunk_size = chunk_size
 
     def forward(self, z_i, z_j):
         """
         We do not sample negative examples explicitly.
         Instead, given a positive pair, similar to (Chen et al., 2017), we treat the other 2(N − 1) augmented examples within a minibatch as negative examples.
-        """
-
-        p1 = torch.cat((z_i, z_j), dim=0)
-        sim = self.similarity_f(p1.unsqueeze(1), p1.unsqueeze(0)) / self.temperature
-
-        sim_i_j = torch.diag(sim, self.batch_size)
-        sim_j_i = torch.diag(sim, -self.batch_size)
 
-        positive_samples = torch.cat((sim_i_j, sim_j_i), dim=0).reshape(self.batch_size * 2, 1)
-        negative_samples = sim[self.mask].reshape(self.batch_size * 2, -1)
-
-        labels = torch.zeros(self.batch_size * 2).to(self.device).long()
-        logits = torch.cat((positive_samples, negative_samples), dim=1)
-        loss = self.criterion(logits, labels)
-        loss /= 2 * self.batch_size
+        The cosine similarities are the matmul of the normalized projections, the similarity of every sample
+        with itself is filled with -inf so it drops out of the softmax. N is the size of the batch given, the
+        last batch of an epoch may be smaller than batch_size.
+        """
+        n = z_i.size(0)
+        z = F.normalize(torch.cat((z_i, z_j), dim=0), dim=1)
+
+        # the positive of sample i is i + N, of sample i + N it is i
+        labels = torch.cat((torch.arange(n, 2 * n), torch.arange(0, n))).to(z.device)
+
+        chunk_size = self.chunk_size if self.chunk_size > 0 else 2 * n
+        loss = 0
+        for start in range(0, 2 * n, chunk_size):
+            end = min(start + chunk_size, 2 * n)
+            if self.chunk_size > 0 and torch.is_grad_enabled():
+                # the logits of the chunk are recomputed in the backward pass instead of kept
+                loss = loss + checkpoint(self.chunk_loss, z, labels, start, end, use_reentrant=False)
+            else:
+                loss = loss + self.chunk_loss(z, labels, start, end)
+
+        loss /= 2 * n
         return loss
+
+    def chunk_loss(self, z, labels, start, end):
+        """summed cross entropy of rows start to end of the (2N, 2N) logits"""
+        sim = z[start:end] @ z.t() / self.temperature
+        rows = torch.arange(start, end, device=z.device)
+        self_mask = rows.unsqueeze(1) == torch.arange(z.size(0), device=z.device).unsqueeze(0)
+        sim = sim.masked_fill(self_mask, float("-inf"))
+        return F.cross_entropy(sim, labels[start:end], reduction="sum")
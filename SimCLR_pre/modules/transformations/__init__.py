@@ -1 +1 @@
-from .simclr import TransformsSimCLR
\ No newline at end of file
+from .simclr import TransformsSimCLR, BatchTransformsSimCLR
\ No newline at end of file
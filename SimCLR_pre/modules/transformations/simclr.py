@@ -1,3 +1,6 @@
+import math
+import torch
+import torch.nn.functional as F
 import torchvision
 
 class TransformsSimCLR:
@@ -25,3 +28,131 @@ class TransformsSimCLR:
     def __call__(self, x):
         return self.train_transform(x), self.train_transform(x)
 
+
+
+class BatchTransformsSimCLR:
+    """
+    The augmentations of TransformsSimCLR on a batch of uint8 images (B, 3, H, W), as tensor ops on the
+    device of the batch: every image is decoded once and both views are generated from it.
+
+    Random resized crop and flip are one affine grid_sample per view, the color jitter factors are drawn
+    per image. Unlike torchvision, the order of the four color jitter operations is drawn per batch.
+    The images may be padded (see utils/image_store.py), sizes (B, 2) holds the valid height and width
+    of every image in its top left corner and the crops are sampled within it.
+    """
+
+    def __init__(self, size=96, scale=(0.08, 1.0), ratio=(3.0 / 4.0, 4.0 / 3.0), s=1, p_jitter=0.8, p_gray=0.2):
+        self.size = size
+        self.scale = scale
+        self.ratio = ratio
+        self.brightness = 0.8 * s
+        self.contrast = 0.8 * s
+        self.saturation = 0.8 * s
+        self.hue = 0.2 * s
+        self.p_jitter = p_jitter
+        self.p_gray = p_gray
+
+    def __call__(self, x, sizes=None):
+        x = x.float() / 255
+        return self.transform(x, sizes), self.transform(x, sizes)
+
+    def transform(self, x, sizes=None):
+        x = self.resized_crop_flip(x, sizes)
+
+        jitter = torch.rand(x.size(0), device=x.device) < self.p_jitter
+        x = torch.where(jitter[:, None, None, None], self.color_jitter(x), x)
+
+        gray = torch.rand(x.size(0), device=x.device) < self.p_gray
+        x = torch.where(gray[:, None, None, None], grayscale(x).expand_as(x), x)
+        return x
+
+    def resized_crop_flip(self, x, sizes=None, attempts=10):
+        """RandomResizedCrop(size) and RandomHorizontalFlip of every image, within its valid size"""
+        B, _, H, W = x.shape
+        device = x.device
+        if sizes is None:
+            valid_h = torch.full((B, 1), float(H), device=device)
+            valid_w = torch.full((B, 1), float(W), device=device)
+        else:
+            valid_h, valid_w = sizes.to(device).float().unbind(1)
+            valid_h, valid_w = valid_h.unsqueeze(1), valid_w.unsqueeze(1)
+
+        # as torchvision: the first of attempts random boxes that fits, the whole image when none does
+        area = valid_h * valid_w * torch.empty(B, attempts, device=device).uniform_(*self.scale)
+        log_ratio = torch.empty(B, attempts, device=device).uniform_(math.log(self.ratio[0]), math.log(self.ratio[1]))
+        w = torch.sqrt(area * torch.exp(log_ratio)).round()
+        h = torch.sqrt(area / torch.exp(log_ratio)).round()
+        fits = (w > 0) & (w <= valid_w) & (h > 0) & (h <= valid_h)
+        first = fits.float().argmax(dim=1, keepdim=True)
+        found = fits.any(dim=1)
+        valid_h, valid_w = valid_h.squeeze(1), valid_w.squeeze(1)
+        w = torch.where(found, w.gather(1, first).squeeze(1), valid_w)
+        h = torch.where(found, h.gather(1, first).squeeze(1), valid_h)
+
+        left = (torch.rand(B, device=device) * (valid_w - w + 1)).floor()
+        top = (torch.rand(B, device=device) * (valid_h - h + 1)).floor()
+        flip = torch.where(torch.rand(B, device=device) < 0.5, -1.0, 1.0)
+
+        # maps the output grid on the box, in the normalized coordinates of grid_sample
+        theta = torch.zeros(B, 2, 3, device=device)
+        theta[:, 0, 0] = flip * w / W
+        theta[:, 0, 2] = (2 * left + w) / W - 1
+        theta[:, 1, 1] = h / H
+        theta[:, 1, 2] = (2 * top + h) / H - 1
+        grid = F.affine_grid(theta, (B, x.size(1), self.size, self.size), align_corners=False)
+        return F.grid_sample(x, grid, mode="bilinear", padding_mode="border", align_corners=False)
+
+    def color_jitter(self, x):
+        B = x.size(0)
+        factor = lambda amount: torch.empty(B, 1, 1, 1, device=x.device).uniform_(max(0, 1 - amount), 1 + amount)
+        brightness, contrast, saturation = factor(self.brightness), factor(self.contrast), factor(self.saturation)
+        hue = torch.empty(B, 1, 1, device=x.device).uniform_(-self.hue, self.hue)
+
+        for op in torch.randperm(4).tolist():
+            if op == 0:
+                x = (x * brightness).clamp(0, 1)
+            elif op == 1:
+                mean = grayscale(x).mean(dim=(1, 2, 3), keepdim=True)
+                x = (x * contrast + mean * (1 - contrast)).clamp(0, 1)
+            elif op == 2:
+                x = (x * saturation + grayscale(x) * (1 - saturation)).clamp(0, 1)
+            else:
+                h, s, v = rgb_to_hsv(x)
+                x = hsv_to_rgb(torch.remainder(h + hue, 1.0), s, v)
+        return x
+
+
+def grayscale(x):
+    """(B, 3, H, W) --> (B, 1, H, W)"""
+    return (0.2989 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]).unsqueeze(1)
+
+
+def rgb_to_hsv(x):
+    """(B, 3, H, W) in [0, 1] --> h, s, v (B, H, W) in [0, 1]"""
+    r, g, b = x.unbind(1)
+    maxc = x.max(dim=1)[0]
+    minc = x.min(dim=1)[0]
+    delta = maxc - minc
+
+    s = torch.where(maxc > 0, delta / maxc.clamp(min=1e-8), torch.zeros_like(maxc))
+    deltac = delta.clamp(min=1e-8)
+    rc, gc, bc = (maxc - r) / deltac, (maxc - g) / deltac, (maxc - b) / deltac
+    h = torch.where(maxc == r, bc - gc, torch.where(maxc == g, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = torch.where(delta > 0, torch.remainder(h / 6.0, 1.0), torch.zeros_like(h))
+    return h, s, maxc
+
+
+def hsv_to_rgb(h, s, v):
+    """h, s, v (B, H, W) --> (B, 3, H, W)"""
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.long() % 6
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+
+    # the channels of the six sectors of the hue
+    r = torch.stack((v, q, p, p, t, v)).gather(0, i.unsqueeze(0)).squeeze(0)
+    g = torch.stack((t, v, v, q, p, p)).gather(0, i.unsqueeze(0)).squeeze(0)
+    b = torch.stack((p, p, t, v, v, q)).gather(0, i.unsqueeze(0)).squeeze(0)
+    return torch.stack((r, g, b), dim=1)
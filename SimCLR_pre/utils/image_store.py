@@ -0,0 +1,91 @@
+import os
+import numpy as np
+import torch
+from PIL import Image
+
+"""
+Pre-resized uint8 store of an image dataset, so the images are decoded once instead of every epoch:
+    {path}/images.npy   (n, max_size, max_size, 3) uint8, the short side of every image resized to size
+                        (less when the long side would exceed max_size), the aspect ratio is kept and
+                        the whole image is stored in the top left corner, padded with its edge pixels
+                        (bilinear sampling at the border of a crop then reads no padding color)
+    {path}/sizes.npy    (n, 2) int32 valid height and width of every image
+    {path}/targets.npy  (n,) int64 labels of the dataset
+The augmentations are done on the batches of the store (BatchTransformsSimCLR), the crops are sampled
+within the valid region of every image, as RandomResizedCrop does on the full image.
+"""
+
+
+class ResizeRGB:
+    """
+    short side resized to size and long side to at most max_size, aspect ratio kept, in the top left
+    of a max_size x max_size canvas --> (canvas (max_size, max_size, 3), valid (height, width))
+    """
+
+    def __init__(self, size, max_size):
+        self.size = size
+        self.max_size = max_size
+
+    def __call__(self, img):
+        img = img.convert("RGB")
+        w, h = img.size
+        scale = min(self.size / min(w, h), self.max_size / max(w, h))
+        w, h = min(self.max_size, max(1, round(w * scale))), min(self.max_size, max(1, round(h * scale)))
+        img = img.resize((w, h), Image.BILINEAR)
+        canvas = np.zeros((self.max_size, self.max_size, 3), dtype=np.uint8)
+        canvas[:h, :w] = np.asarray(img, dtype=np.uint8)
+        canvas[h:, :w] = canvas[h - 1, :w]
+        canvas[:, w:] = canvas[:, w - 1:w]
+        return torch.from_numpy(canvas), torch.tensor([h, w], dtype=torch.int32)
+
+
+def write_image_store(dataset, path, size, max_size=None, batch_size=256, workers=16):
+    """
+    dataset: e.g. ImageFolder without transform, its images are resized by the workers of a DataLoader
+    max_size: side of the canvas, 1.5 * size when not given
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    max_size = max_size or int(1.5 * size)
+    dataset.transform = ResizeRGB(size, max_size)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=workers)
+
+    images = np.lib.format.open_memmap(os.path.join(path, "images.npy"), mode="w+", dtype=np.uint8,
+                                       shape=(len(dataset), max_size, max_size, 3))
+    sizes = np.zeros((len(dataset), 2), dtype=np.int32)
+    targets = np.zeros(len(dataset), dtype=np.int64)
+    start = 0
+    for step, ((x, hw), y) in enumerate(loader):
+        images[start:start + len(x)] = x.numpy()
+        sizes[start:start + len(x)] = hw.numpy()
+        targets[start:start + len(x)] = y.numpy()
+        start += len(x)
+        if step % 50 == 0:
+            print(f"Step [{step}/{len(loader)}]")
+
+    images.flush()
+    np.save(os.path.join(path, "sizes.npy"), sizes)
+    np.save(os.path.join(path, "targets.npy"), targets)
+
+
+class ImageStore(torch.utils.data.Dataset):
+    """the images of a store as uint8 tensors (3, max_size, max_size) with their valid (height, width)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.targets = np.load(os.path.join(path, "targets.npy"))
+        self.images = None
+        # stores without sizes.npy hold square crops, the whole image is valid
+        sizes_file = os.path.join(path, "sizes.npy")
+        self.sizes = np.load(sizes_file) if os.path.exists(sizes_file) else None
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        # opened in every worker
+        if self.images is None:
+            self.images = np.load(os.path.join(self.path, "images.npy"), mmap_mode="r")
+        image = torch.from_numpy(np.array(self.images[index])).permute(2, 0, 1)
+        size = self.sizes[index] if self.sizes is not None else self.images.shape[1:3]
+        return (image, torch.tensor(size, dtype=torch.int32)), int(self.targets[index])
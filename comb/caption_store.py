@@ -0,0 +1,113 @@
+"""Pre-tokenized caption store"""
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from utils import calculatate_freq
+
+"""
+Tokenizes the captions of a split once and stores the token ids, the word frequencies and
+the frequency scores as flat int32 buffers with offsets. The files are opened memory-mapped,
+so DataLoader workers share them and no tokenizer runs in __getitem__.
+"""
+
+
+class RaggedArray(object):
+    """Variable length rows stored as one flat buffer and the offsets of every row"""
+
+    def __init__(self, flat, offsets):
+        self.flat = flat
+        self.offsets = offsets
+
+    def __getitem__(self, index):
+        return self.flat[self.offsets[index]:self.offsets[index+1]]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @staticmethod
+    def from_lists(rows, dtype=np.int32):
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(row) for row in rows])
+        flat = np.zeros(offsets[-1], dtype=dtype)
+        for i, row in enumerate(rows):
+            flat[offsets[i]:offsets[i+1]] = row
+        return RaggedArray(flat, offsets)
+
+
+def vocab_hash(vocab):
+    """sha1 of the words, ids and counts of the vocabulary"""
+    content = json.dumps([sorted(vocab.word2idx.items()), sorted(getattr(vocab, "count", {}).items())])
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def captions_fingerprint(data_path, version, data_split):
+    """Size and modification time of the captions file, changes whenever the data is regenerated"""
+    file = '{}/data_captions_{}_{}.txt'.format(data_path, version, data_split)
+    if not os.path.exists(file):
+        return "missing"
+    stat = os.stat(file)
+    return "{}_{}".format(stat.st_size, int(stat.st_mtime))
+
+
+def store_path(data_path, version, data_split, dset):
+    """Folder of the store, the tokenizer options, the vocabulary and the captions file are part
+    of the name so a change in any of them builds a new store
+    """
+    key = [type(dset).__name__, str(dset.bert), str(dset.filter), str(dset.n_filter),
+           str(dset.cut), str(dset.n_cut), vocab_hash(dset.vocab),
+           captions_fingerprint(data_path, version, data_split)]
+    name = hashlib.sha1("|".join(key).encode("utf-8")).hexdigest()[:12]
+    return "{}/tokens_{}_{}_{}".format(data_path, version, data_split, name)
+
+
+def build_caption_store(path, captions, tokenize, count):
+    """Tokenize every caption with tokenize (caption -> token ids) and write the store,
+    the folder only appears once it is complete
+    """
+    tokens = [np.asarray(tokenize(caption), dtype=np.int32) for caption in captions]
+    freq_score, freqs = calculatate_freq(captions, count)
+
+    tmp_path = path + ".tmp{}".format(os.getpid())
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    tokens = RaggedArray.from_lists(tokens)
+    freqs = RaggedArray.from_lists(freqs)
+    np.save("{}/tokens_flat.npy".format(tmp_path), tokens.flat)
+    np.save("{}/tokens_offsets.npy".format(tmp_path), tokens.offsets)
+    np.save("{}/freqs_flat.npy".format(tmp_path), freqs.flat)
+    np.save("{}/freqs_offsets.npy".format(tmp_path), freqs.offsets)
+    np.save("{}/freq_score.npy".format(tmp_path), np.asarray(freq_score, dtype=np.float32))
+
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # built by another process in the meantime
+        shutil.rmtree(tmp_path)
+
+
+class CaptionStore(object):
+    """Memory-mapped view on a store written by build_caption_store"""
+
+    def __init__(self, path):
+        load = lambda name: np.load("{}/{}.npy".format(path, name), mmap_mode='r')
+        self.tokens = RaggedArray(load("tokens_flat"), load("tokens_offsets"))
+        self.freqs = RaggedArray(load("freqs_flat"), load("freqs_offsets"))
+        self.freq_score = load("freq_score")
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+def load_caption_store(data_path, version, data_split, dset):
+    """Open the store of the dataset, tokenizes the captions first when it does not exist yet
+    """
+    path = store_path(data_path, version, data_split, dset)
+    if not os.path.exists(path):
+        print("Tokenizing captions to {}".format(path))
+        build_caption_store(path, dset.captions, dset.tokenize, dset.count)
+    return CaptionStore(path)
@@ -28,16 +28,13 @@ class CNN_layers(nn.Module):
         self.div_transform = div_transform
 
     def forward(self, x):
-        # transform the input
-        batch_size = x.shape[0]
-
-        x = x.repeat(self.n_detectors, 1, 1, 1)
-
+        # transform the input, the transforms are batched tensor ops on the device of x
+        # and do not change x, so every detector can use the same batch
         stack = []
         for i in range(self.n_detectors):
             conv = self.conv[i]
             transform = self.transforms[i]
-            temp = x[i * batch_size : (i + 1) * batch_size]
+            temp = x
 
             if self.div_transform:
                 temp = transform(temp)
@@ -74,7 +71,8 @@ class remove_channel(object):
         self.channel = channel
 
     def __call__(self,x):
-        x[:, self.channel, :, :] = torch.zeros(x.shape[0], x.shape[2], x.shape[3])
+        x = x.clone()
+        x[:, self.channel, :, :] = 0
         return  x
 
 
@@ -9,6 +9,7 @@ from vocab import Vocabulary, deserialize_vocab
 from model import SCAN, xattn_score_i2t, xattn_score_t2i, cosine_similarity
 from data_ken import PrecompDataset, PrecompTrans, collate_fn
 from evaluation import encode_data
+from emb_cache import cache_path, encode_data_cached
 import pandas as pd
 import seaborn as sns
 """
@@ -45,7 +46,8 @@ def main(args):
         loader_train, pos_train = retrieve_loader("train", opt, dpath, word_row, vocab)
 
         average_attn = word_attn[word_row]
-        img_features = avg_features_img(average_attn, model, loader_train, loader_test)
+        paths = (emb_cache_path(args, model_path, opt, word_row, "train"), emb_cache_path(args, model_path, opt, word_row, "test"))
+        img_features = avg_features_img(average_attn, model, loader_train, loader_test, paths)
         n_image = img_features.shape[0]
 
         temp_cos = {}
@@ -102,14 +104,14 @@ def avg_features_word(word, model, vocab):
 
     return word_feature
 
-def avg_features_img(avg_attn, model, loader_train, loader_test):
-    train_feat = retrieve_img_features(loader_train, model)
-    test_feat = retrieve_img_features(loader_test, model)
+def avg_features_img(avg_attn, model, loader_train, loader_test, paths=(None, None)):
+    train_feat = retrieve_img_features(loader_train, model, paths[0])
+    test_feat = retrieve_img_features(loader_test, model, paths[1])
     features = np.concatenate((train_feat, test_feat), axis=0)
     features = torch.from_numpy(features)
 
     n_images = features.shape[0]
-    avg_attn = avg_attn.to(torch.float64)
+    avg_attn = avg_attn.to(features.dtype)
     avg_attn = avg_attn.unsqueeze(dim=0).expand(n_images, -1).unsqueeze(dim=1)
 
     if torch.cuda.is_available():
@@ -122,7 +124,11 @@ def avg_features_img(avg_attn, model, loader_train, loader_test):
 
 
 
-def retrieve_img_features(loader, model):
+def retrieve_img_features(loader, model, path=None):
+    if path is not None:
+        img_embs, _, _, _ = encode_data_cached(encode_data, path, model, loader, compute_loss=False)
+        return img_embs
+
     img_embs = None
     with torch.no_grad():
         for i, (images, captions, lengths, ids, freq_score, freqs) in enumerate(loader):
@@ -139,6 +145,12 @@ def retrieve_img_features(loader, model):
             img_embs[ids] = img_emb.data.cpu().numpy().copy()
     return img_embs
 
+def emb_cache_path(args, model_path, opt, word, split):
+    # embeddings of the dataset filtered on word, None when caching is off
+    if args.cache_dir is None:
+        return None
+    return cache_path(args.cache_dir, model_path, split, opt, subset=word)
+
 def write_out(out_path, dic, file_name):
     file = open("{}/{}.txt".format(out_path, file_name), "w")
     for key in dic.keys():
@@ -252,6 +264,7 @@ if __name__ == "__main__":
     parser.add_argument('--out_folder', default="vizAttn", type=str, help='')
     # parser.add_argument("--list_words", nargs="+", default=["black", "blue", "white", "red","multicolor","floral", "sheath", "midi", "maxi", "short", "knee-length", "crepe", "v-neck", "jersey", "lace", "silk", "cotton"])
     parser.add_argument("--list_words", nargs="+", default=["black"])
+    parser.add_argument('--cache_dir', default=None, type=str, help='folder to cache the encoded embeddings in')
 
 
     args = parser.parse_args()
@@ -18,9 +18,11 @@ import numpy as np
 import json as jsonmod
 import csv
 from utils import count_words, calculatate_freq, filter_freq, cut
-import h5py
 from transformers import BertTokenizer
 from util.cnn_end2end import Data_segs
+from caption_store import load_caption_store
+from image_store import ImageStore
+from h5_reader import H5Images, ChunkSampler
 
 
 class PrecompTrans(data.Dataset):
@@ -29,7 +31,8 @@ class PrecompTrans(data.Dataset):
     Possible options: Fashion200K and Fashion-Gen
     """
 
-    def __init__(self, data_path, data_split, vocab, version, image_path, rectangle, data_name, filter, n_filter, cut, n_cut, clothing, txt_enc):
+    def __init__(self, data_path, data_split, vocab, version, image_path, rectangle, data_name, filter, n_filter, cut, n_cut, clothing, txt_enc, pretokenize=False, image_store=False,
+                 h5_cache_mb=64, uint8_images=False):
         self.bert = True if txt_enc == "bert" else False
         self.vocab = vocab
         loc = data_path + '/'
@@ -50,7 +53,22 @@ class PrecompTrans(data.Dataset):
                 self.captions.append(line[1].strip())
                 self.images.append(line[0].strip())
 
-        self.h5_images =  get_h5_images(self.data_name, data_split, data_path)
+        self.h5_images =  get_h5_images(self.data_name, data_split, data_path, h5_cache_mb)
+
+        # pre-decoded uint8 images, normalized per batch in SCAN.forward_emb
+        self.image_store = None
+        if image_store and self.data_name == "Fashion200K" and self.clothing != "multi":
+            self.image_store = ImageStore(data_path, version, data_split)
+
+        # only resize in the workers, normalization is done per batch in SCAN.forward_emb
+        self.uint8_images = uint8_images
+
+        self.transform = transforms.Compose([
+            # transforms.Resize((256, 256)),
+            transforms.Resize((256, 256)),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                                  std=[0.229, 0.224, 0.225])])
 
         self.length = len(self.captions)
 
@@ -58,9 +76,6 @@ class PrecompTrans(data.Dataset):
         self.im_div = 1
 
         self.count  = vocab.count
-        freq_score, freqs = calculatate_freq(self.captions, self.count)
-        self.freq_score = freq_score
-        self.freqs = freqs
         self.height = 512 if rectangle else 256
 
         if self.bert == True:
@@ -68,6 +83,17 @@ class PrecompTrans(data.Dataset):
         else:
             self.tokenizer = nltk.tokenize
 
+        # token ids and frequencies from the pre-tokenized caption store
+        self.store = None
+        if pretokenize:
+            self.store = load_caption_store(data_path, version, data_split, self)
+            self.freq_score = self.store.freq_score
+            self.freqs = self.store.freqs
+        else:
+            freq_score, freqs = calculatate_freq(self.captions, self.count)
+            self.freq_score = freq_score
+            self.freqs = freqs
+
 
 
     def __getitem__(self, index):
@@ -75,40 +101,58 @@ class PrecompTrans(data.Dataset):
         img_id = int(index/self.im_div)
         img_id = self.images[img_id]
 
-        if self.clothing == "multi":
-            # work around to get multi away from the path
-            new_path = self.data_path[:-6]
-            image = Image.open("{}/{}".format(new_path, img_id))
-        elif self.data_name == "Fashion200K":
-            # load image
-            image = Image.open("{}/{}/{}_0.jpeg".format(self.data_path, self.image_path, img_id))
-        elif self.data_name == "Fashion_gen":
-            image = self.h5_images[int(img_id)]
-            image = Image.fromarray(image)
-
-        transform = transforms.Compose([
-            # transforms.Resize((256, 256)),
-            transforms.Resize((256, 256)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                  std=[0.229, 0.224, 0.225])])
-
-        image = transform(image)
+        if self.image_store is not None:
+            image = self.image_store[img_id]
+        elif self.uint8_images:
+            image = self.load_uint8(img_id)
+        else:
+            if self.clothing == "multi":
+                # work around to get multi away from the path
+                new_path = self.data_path[:-6]
+                image = Image.open("{}/{}".format(new_path, img_id))
+            elif self.data_name == "Fashion200K":
+                # load image
+                image = Image.open("{}/{}/{}_0.jpeg".format(self.data_path, self.image_path, img_id))
+            elif self.data_name == "Fashion_gen":
+                image = self.h5_images[int(img_id)]
+                image = Image.fromarray(image)
+
+            image = self.transform(image)
 
         caption = self.captions[index]
         vocab = self.vocab
         freq_score = self.freq_score[index]
         freqs = self.freqs[index]
 
-        if self.bert:
-            target = self.bert_tokenize(caption)
+        if self.store is not None:
+            target = torch.from_numpy(self.store.tokens[index].astype(np.float32))
         else:
-            target = self.normal_tokenize(caption)
+            target = self.tokenize(caption)
         return image, target, index, img_id, freq_score, freqs
 
     def __len__(self):
         return self.length
 
+    def load_uint8(self, img_id):
+        """uint8 (3, 256, 256) tensor of the image, without normalization
+        """
+        if self.data_name == "Fashion_gen" and self.clothing != "multi":
+            # already stored as 256x256 images
+            image = np.asarray(self.h5_images[int(img_id)], dtype=np.uint8)
+            return torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1)
+
+        if self.clothing == "multi":
+            image = Image.open("{}/{}".format(self.data_path[:-6], img_id))
+        else:
+            image = Image.open("{}/{}/{}_0.jpeg".format(self.data_path, self.image_path, img_id))
+        image = image.convert("RGB").resize((256, 256), Image.BILINEAR)
+        return torch.from_numpy(np.asarray(image, dtype=np.uint8).copy()).permute(2, 0, 1)
+
+    def tokenize(self, caption):
+        if self.bert:
+            return self.bert_tokenize(caption)
+        return self.normal_tokenize(caption)
+
     def bert_tokenize(self, caption):
         tokenized_cap = self.tokenizer.encode(caption, add_special_tokens=False)
         target = torch.Tensor(tokenized_cap)
@@ -165,6 +209,8 @@ class PrecompTrans(data.Dataset):
 
         self.freq_score = filtered_freq_score
         self.freqs = filtered_freqs
+        # the store is indexed by the unfiltered dataset
+        self.store = None
         print("dataset filtered, word: {} \t size: {}".format(word, self.length))
         return position
 
@@ -172,7 +218,7 @@ class PrecompTrans(data.Dataset):
 
 
 #
-def get_h5_images(data_name, data_split, data_path):
+def get_h5_images(data_name, data_split, data_path, cache_mb=64):
     if data_name == "Fashion200K":
         return None
     elif data_name == "Fashion_gen":
@@ -180,9 +226,8 @@ def get_h5_images(data_name, data_split, data_path):
             file = "{}/fashiongen_256_256_train.h5".format(data_path)
         else:
             file = "{}/fashiongen_256_256_validation.h5".format(data_path)
-        f = h5py.File(file, 'r')
-        dset = f["input_image"]
-        return dset
+        # opened lazily in every DataLoader worker
+        return H5Images(file, "input_image", cache_mb=cache_mb)
 
 
 
@@ -191,7 +236,7 @@ class PrecompDataset(data.Dataset):
     Load precomputed captions and image features
     """
 
-    def __init__(self, data_path, data_split, vocab, version, filter, n_filter, cut, n_cut, txt_enc):
+    def __init__(self, data_path, data_split, vocab, version, filter, n_filter, cut, n_cut, txt_enc, pretokenize=False):
         self.bert = True if txt_enc == "bert" else False
         self.vocab = vocab
         loc = data_path + '/'
@@ -213,15 +258,23 @@ class PrecompDataset(data.Dataset):
 
 
         self.count = vocab.count
-        freq_score, freqs = calculatate_freq(self.captions, self.count)
-        self.freq_score = freq_score
-        self.freqs = freqs
 
         if self.bert:
             self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
         else:
             self.tokenizer = nltk.tokenize
 
+        # token ids and frequencies from the pre-tokenized caption store
+        self.store = None
+        if pretokenize:
+            self.store = load_caption_store(data_path, version, data_split, self)
+            self.freq_score = self.store.freq_score
+            self.freqs = self.store.freqs
+        else:
+            freq_score, freqs = calculatate_freq(self.captions, self.count)
+            self.freq_score = freq_score
+            self.freqs = freqs
+
     def __getitem__(self, index):
         # handle the image redundancy
         img_id = int(index/self.im_div)
@@ -231,10 +284,10 @@ class PrecompDataset(data.Dataset):
         freq_score = self.freq_score[index]
         freqs = self.freqs[index]
 
-        if self.bert:
-            target = self.bert_tokenize(caption)
+        if self.store is not None:
+            target = torch.from_numpy(self.store.tokens[index].astype(np.float32))
         else:
-            target = self.normal_tokenize(caption)
+            target = self.tokenize(caption)
 
 
         return image, target, index, img_id, freq_score, freqs
@@ -242,6 +295,11 @@ class PrecompDataset(data.Dataset):
     def __len__(self):
         return self.length
 
+    def tokenize(self, caption):
+        if self.bert:
+            return self.bert_tokenize(caption)
+        return self.normal_tokenize(caption)
+
 
     def bert_tokenize(self, caption):
         tokenized_cap = self.tokenizer.encode(caption, add_special_tokens=True)
@@ -302,6 +360,8 @@ class PrecompDataset(data.Dataset):
 
         self.freq_score = filtered_freq_score
         self.freqs = filtered_freqs
+        # the store is indexed by the unfiltered dataset
+        self.store = None
         print("dataset filtered, word: {} \t size: {}".format(word, self.length))
         return position
 
@@ -341,16 +401,28 @@ def get_precomp_loader(data_path, data_split, vocab, opt, batch_size=100,
     if opt.precomp_enc_type == "trans" or opt.precomp_enc_type == "layers" or opt.precomp_enc_type == "layers_attention" or opt.precomp_enc_type == "cnn_layers" or opt.precomp_enc_type == "layers_attention_res" or opt.precomp_enc_type == "layers_attention_im" or opt.precomp_enc_type == "layers_same":
         dset = PrecompTrans(data_path, data_split, vocab, opt.version, opt.image_path,
                             opt.rectangle, opt.data_name, opt.filter, opt.n_filter,
-                            opt.cut, opt.n_cut, opt.clothing, opt.txt_enc)
+                            opt.cut, opt.n_cut, opt.clothing, opt.txt_enc,
+                            getattr(opt, "pretokenize", False), getattr(opt, "image_store", False),
+                            getattr(opt, "h5_cache_mb", 64), getattr(opt, "uint8_images", False))
     elif opt.precomp_enc_type == "cnn":
         dset = Data_segs(data_path, data_split, vocab, opt.version, opt.image_path, opt.data_name)
     else:
         dset = PrecompDataset(data_path, data_split, vocab, opt.version, opt.filter,
-                                opt.n_filter, opt.cut, opt.n_cut, opt.txt_enc)
+                                opt.n_filter, opt.cut, opt.n_cut, opt.txt_enc,
+                                getattr(opt, "pretokenize", False))
+
+    # read the HDF5 images chunk by chunk
+    sampler = None
+    if getattr(opt, "h5_chunk_sampler", False) and getattr(dset, "h5_images", None) is not None:
+        rows = [int(img_id) for img_id in dset.images]
+        sampler = ChunkSampler(rows, dset.h5_images.chunk_rows, shuffle)
+        shuffle = False
 
     data_loader = torch.utils.data.DataLoader(dataset=dset,
                                               batch_size=batch_size,
                                               shuffle=shuffle,
+                                              sampler=sampler,
+                                              num_workers=num_workers,
                                               pin_memory=True,
                                               collate_fn=collate_fn,
                                               drop_last=True)
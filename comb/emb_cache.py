@@ -0,0 +1,105 @@
+"""Cache of precomputed embeddings on disk"""
+
+import os
+import json
+import hashlib
+import numpy as np
+
+"""
+The embeddings of a split are written once as .npy files and reopened memory-mapped
+afterwards, so the analysis scripts do not re-run the encoder for the same checkpoint.
+An entry is keyed by (checkpoint hash, split, data version, clothing).
+"""
+
+FILES = ["img_embs", "cap_embs", "cap_lens", "freqs_flat", "freqs_offsets"]
+
+
+# sha1 of the checkpoints hashed so far, by (path, size, mtime)
+_CHECKPOINT_HASHES = {}
+
+
+def checkpoint_hash(model_path, block_size=1 << 20):
+    """sha1 of the content of the checkpoint file, hashed once per version of the file
+    """
+    stat = os.stat(model_path)
+    key = (os.path.abspath(model_path), stat.st_size, stat.st_mtime_ns)
+    if key not in _CHECKPOINT_HASHES:
+        sha = hashlib.sha1()
+        with open(model_path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha.update(block)
+        _CHECKPOINT_HASHES[key] = sha.hexdigest()
+    return _CHECKPOINT_HASHES[key]
+
+
+def data_fingerprint(opt, split):
+    """Size and modification time of the captions file of the split, changes
+    whenever the data is regenerated
+    """
+    dpath = os.path.join(opt.data_path, opt.data_name, opt.clothing)
+    file = '{}/data_captions_{}_{}.txt'.format(dpath, opt.version, split)
+    if not os.path.exists(file):
+        return "missing"
+    stat = os.stat(file)
+    return "{}_{}".format(stat.st_size, int(stat.st_mtime))
+
+
+def cache_path(cache_dir, model_path, split, opt, subset=None):
+    """Folder of the cache entry for this checkpoint, split and data version
+    subset: extra name for filtered datasets (e.g. the word used in filter_word)
+    """
+    key = [checkpoint_hash(model_path), split, opt.version, opt.clothing, data_fingerprint(opt, split)]
+    if subset is not None:
+        key.append(str(subset))
+    name = hashlib.sha1("|".join(key).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, "{}_{}_{}".format(opt.clothing, split, name))
+
+
+def save_embeddings(path, img_embs, cap_embs, cap_lens, freqs):
+    """Write the output of encode_data to path, meta.json is written last and
+    marks the entry as complete
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    freqs = [np.asarray(f, dtype=np.int64).reshape(-1) for f in freqs]
+    offsets = np.zeros(len(freqs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(f) for f in freqs])
+    flat = np.concatenate(freqs) if len(freqs) > 0 else np.zeros(0, dtype=np.int64)
+
+    arrays = {"img_embs": img_embs, "cap_embs": cap_embs,
+              "cap_lens": np.asarray([int(l) for l in cap_lens], dtype=np.int64),
+              "freqs_flat": flat, "freqs_offsets": offsets}
+    for name in FILES:
+        np.save(os.path.join(path, "{}.npy".format(name)), arrays[name])
+
+    with open(os.path.join(path, "meta.json"), 'w') as f:
+        json.dump({"n": len(cap_lens), "img_shape": list(img_embs.shape), "cap_shape": list(cap_embs.shape)}, f)
+
+
+def load_embeddings(path):
+    """Reopen a cache entry memory-mapped
+    --> (img_embs, cap_embs, cap_lens, freqs) like encode_data, None when the entry is missing
+    """
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        return None
+
+    arrays = {name: np.load(os.path.join(path, "{}.npy".format(name)), mmap_mode='r') for name in FILES}
+    offsets = arrays["freqs_offsets"]
+    freqs = [arrays["freqs_flat"][offsets[i]:offsets[i+1]] for i in range(len(offsets) - 1)]
+    cap_lens = [int(l) for l in arrays["cap_lens"]]
+    return arrays["img_embs"], arrays["cap_embs"], cap_lens, freqs
+
+
+def encode_data_cached(encode, path, *args, **kwargs):
+    """Load the embeddings from path, or compute them with encode(*args, **kwargs)
+    and store them when path is not cached yet
+    """
+    cached = load_embeddings(path)
+    if cached is not None:
+        print("Loaded cached embeddings from {}".format(path))
+        return cached
+
+    img_embs, cap_embs, cap_lens, freqs = encode(*args, **kwargs)
+    save_embeddings(path, img_embs, cap_embs, cap_lens, freqs)
+    return load_embeddings(path)
@@ -40,7 +40,8 @@ def main(args):
         print("Evaluating seed{}".format(str(i+1)))
         model_path = "{}{}/seed{}/checkpoint/{}".format(args.model_path, run, i+1, checkpoint )
         # plot_path = "{}{}/seed{}checkpoint/".format(args.plot_path,  run)
-        rt, rti, attn, r, ri = evaluation.evalrank(model_path, run, data_path=args.data_path, split="test", vocab_path=args.vocab_path, change=args.change)
+        rt, rti, attn, r, ri = evaluation.evalrank(model_path, run, data_path=args.data_path, split="test", vocab_path=args.vocab_path, change=args.change, cache_dir=args.cache_dir,
+                                                       stream_eval=args.stream_eval or None, stream_k=args.stream_k)
         r1 += r[0]
         r5 += r[1]
         r10 += r[2]
@@ -78,5 +79,10 @@ if __name__ == "__main__":
     parser.add_argument('--vocab_path', default="/$TMPDIR/thesis/vocab/", type=str, help='which checkpoint to use')
     parser.add_argument('--plot_path', default="/$HOME/runs/", type=str, help='which checkpoint to use')
     parser.add_argument('--change', action='store_true',help='change clothing from all to dresses (trained on all, evaluate on dresses)')
+    parser.add_argument('--cache_dir', default=None, type=str, help='folder to cache the encoded embeddings in')
+    parser.add_argument('--stream_eval', action='store_true',
+                        help="only keep the top-k per image/caption instead of the full similarity matrix, also for models trained without it")
+    parser.add_argument('--stream_k', default=None, type=int,
+                        help='(Used for stream_eval) number of best matches kept per image/caption, default the one of the checkpoint or 50')
     args = parser.parse_args()
     main(args)
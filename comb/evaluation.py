@@ -18,6 +18,8 @@ import numpy as np
 from vocab import Vocabulary, deserialize_vocab  # NOQA
 import torch
 from model import SCAN, xattn_score_t2i, xattn_score_i2t
+from ranking import diag_ranks, recall_metrics, NO_GT_RANK
+from emb_cache import cache_path, encode_data_cached
 from collections import OrderedDict
 import time
 from torch.autograd import Variable
@@ -81,8 +83,11 @@ class LogCollector(object):
             tb_logger.log_value(prefix + k, v.val, step=step)
 
 
-def encode_data(model, data_loader, log_step=10, logging=print):
-    """Encode all images and captions loadable by `data_loader`
+def encode_data(model, data_loader, log_step=10, logging=print, compute_loss=True, dtype=np.float32):
+    """Encode all images and captions loadable by `data_loader` in a single pass,
+    the caption buffer is padded further whenever a longer batch shows up.
+    compute_loss: also run the loss to fill the val logger, not needed for retrieval metrics
+    dtype: dtype of the stored embeddings (np.float32 or np.float16)
     """
     batch_time = AverageMeter()
     val_logger = LogCollector()
@@ -98,10 +103,6 @@ def encode_data(model, data_loader, log_step=10, logging=print):
     cap_lens = None
     freqs_new = None
 
-    max_n_word = 0
-    for i, (images, captions, lengths, ids, freq_score, freqs) in enumerate(data_loader):
-        max_n_word = max(max_n_word, max(lengths))
-
     for i, (images, captions, lengths, ids, freq_score, freqs) in enumerate(data_loader):
         # make sure val logger is used
         model.logger = val_logger
@@ -110,25 +111,26 @@ def encode_data(model, data_loader, log_step=10, logging=print):
         img_emb, cap_emb, cap_len = model.forward_emb(images, captions, lengths, volatile=True)
 
         if img_embs is None:
-            if img_emb.dim() == 3:
-                img_embs = np.zeros((len(data_loader.dataset), img_emb.size(1), img_emb.size(2)))
-            else:
-                img_embs = np.zeros((len(data_loader.dataset), img_emb.size(1)))
-            cap_embs = np.zeros((len(data_loader.dataset), max_n_word, cap_emb.size(2)))
+            img_embs = np.zeros((len(data_loader.dataset),) + tuple(img_emb.size()[1:]), dtype=dtype)
+            cap_embs = np.zeros((len(data_loader.dataset), max(lengths), cap_emb.size(2)), dtype=dtype)
             cap_lens = [0] * len(data_loader.dataset)
             freqs_new = [0] * len(data_loader.dataset)
+        elif max(lengths) > cap_embs.shape[1]:
+            # pad the words dimension of the captions seen so far
+            cap_embs = np.pad(cap_embs, ((0, 0), (0, max(lengths) - cap_embs.shape[1]), (0, 0)), mode='constant')
         # cache embeddings
         # changes ids tuple to list
         ids = list(ids)
 
-        img_embs[ids] = img_emb.data.cpu().numpy().copy()
-        cap_embs[ids,:max(lengths),:] = cap_emb.data.cpu().numpy().copy()
+        img_embs[ids] = img_emb.data.cpu().numpy()
+        cap_embs[ids,:max(lengths),:] = cap_emb.data.cpu().numpy()
         for j, nid in enumerate(ids):
             cap_lens[nid] = cap_len[j]
             freqs_new[nid] = freqs[j]
 
         # measure accuracy and record loss, first argument is 100 for LaenenLoss
-        model.forward_loss(100 ,img_emb, cap_emb, cap_len, freq_score, freqs)
+        if compute_loss:
+            model.forward_loss(100 ,img_emb, cap_emb, cap_len, freq_score, freqs)
 
         # measure elapsed time
         batch_time.update(time.time() - end)
@@ -146,11 +148,13 @@ def encode_data(model, data_loader, log_step=10, logging=print):
 
 
 
-def evalrank(model_path,run, data_path=None, split='dev', fold5=False, vocab_path="../vocab/", change=False):
+def evalrank(model_path,run, data_path=None, split='dev', fold5=False, vocab_path="../vocab/", change=False, cache_dir=None,
+             stream_eval=None, stream_k=None):
     """
     Evaluate a trained model on either dev or test. If `fold5=True`, 5 fold
     cross-validation is done (only for MSCOCO). Otherwise, the full data is
-    used for evaluation.
+    used for evaluation. When `cache_dir` is given the embeddings are cached there.
+    `stream_eval` and `stream_k` override the options of the checkpoint when given.
     """
     # load model and options
     checkpoint = torch.load(model_path)
@@ -182,22 +186,37 @@ def evalrank(model_path,run, data_path=None, split='dev', fold5=False, vocab_pat
                                   opt.batch_size, opt.workers, opt)
 
     print('Computing results...')
-    img_embs, cap_embs, cap_lens, freqs = encode_data(model, data_loader)
+    if cache_dir is not None:
+        path = cache_path(cache_dir, model_path, split, opt)
+        img_embs, cap_embs, cap_lens, freqs = encode_data_cached(encode_data, path, model, data_loader, compute_loss=False)
+    else:
+        img_embs, cap_embs, cap_lens, freqs = encode_data(model, data_loader, compute_loss=False)
     print('Images: %d, Captions: %d' %
           (img_embs.shape[0] , cap_embs.shape[0]))
 
-    t2i_switch = True
-    if opt.cross_attn == 't2i':
-        sims, attn = shard_xattn_t2i(img_embs, cap_embs, cap_lens, freqs, opt, shard_size=128)
-    elif opt.cross_attn == 'i2t':
-        sims, attn = shard_xattn_i2t(img_embs, cap_embs, cap_lens, freqs, opt, shard_size=128)
-        t2i_switch = False
+    t2i_switch = opt.cross_attn == 't2i'
+    if stream_eval is None:
+        stream_eval = getattr(opt, "stream_eval", False)
+    if stream_k is None:
+        stream_k = getattr(opt, "stream_k", 50)
+    if stream_eval:
+        # only keeps the top-k per image/caption, no attention
+        (ranks, top), (ranks_i, top_i) = shard_xattn_stream(img_embs, cap_embs, cap_lens, freqs, opt,
+                                                            k=stream_k, shard_size=128)
+        attn = []
+        r, rt = recall_metrics(ranks), (ranks, top[:, 0])
+        ri, rti = recall_metrics(ranks_i), (ranks_i, top_i[:, 0])
     else:
-        raise NotImplementedError
-
-    # r = (r1, r2, r5, medr, meanr), rt= (ranks, top1)
-    r, rt = i2t(img_embs, cap_embs, cap_lens, sims, return_ranks=True)
-    ri, rti = t2i(img_embs, cap_embs, cap_lens, sims, return_ranks=True)
+        if opt.cross_attn == 't2i':
+            sims, attn = shard_xattn_t2i(img_embs, cap_embs, cap_lens, freqs, opt, shard_size=128)
+        elif opt.cross_attn == 'i2t':
+            sims, attn = shard_xattn_i2t(img_embs, cap_embs, cap_lens, freqs, opt, shard_size=128)
+        else:
+            raise NotImplementedError
+
+        # r = (r1, r2, r5, medr, meanr), rt= (ranks, top1)
+        r, rt = i2t(img_embs, cap_embs, cap_lens, sims, return_ranks=True)
+        ri, rti = t2i(img_embs, cap_embs, cap_lens, sims, return_ranks=True)
     ar = (r[0] + r[1] + r[2]) / 3
     ari = (ri[0] + ri[1] + ri[2]) / 3
     rsum = r[0] + r[1] + r[2] + ri[0] + ri[1] + ri[2]
@@ -235,7 +254,7 @@ def softmax(X, axis):
     return p
 
 
-def shard_xattn_t2i(images, captions, caplens, freqs, opt, shard_size=128):
+def shard_xattn_t2i(images, captions, caplens, freqs, opt, shard_size=128, keep_attn=True):
     """
     Computer pairwise t2i image-caption distance with locality sharding
     """
@@ -244,7 +263,7 @@ def shard_xattn_t2i(images, captions, caplens, freqs, opt, shard_size=128):
     n_im_shard = (len(images)-1)/shard_size + 1
     n_cap_shard = (len(captions)-1)/shard_size + 1
 
-    d = np.zeros((len(images), len(captions)))
+    d = np.zeros((len(images), len(captions)), dtype=np.float32)
 
     attention = []
 
@@ -266,12 +285,13 @@ def shard_xattn_t2i(images, captions, caplens, freqs, opt, shard_size=128):
             sim, attn = xattn_score_t2i(im, s, l, f, opt)
             d[im_start:im_end, cap_start:cap_end] = sim.data.cpu().numpy()
 
-            attention = attention + attn
+            if keep_attn:
+                attention.extend(attn)
     sys.stdout.write('\n')
     return d, attention
 
 
-def shard_xattn_i2t(images, captions, caplens, freqs, opt, shard_size=128):
+def shard_xattn_i2t(images, captions, caplens, freqs, opt, shard_size=128, keep_attn=True):
     """
     Computer pairwise i2t image-caption distance with locality sharding
     """
@@ -279,7 +299,7 @@ def shard_xattn_i2t(images, captions, caplens, freqs, opt, shard_size=128):
     n_cap_shard = (len(captions)-1)/shard_size + 1
 
     attention = []
-    d = np.zeros((len(images), len(captions)))
+    d = np.zeros((len(images), len(captions)), dtype=np.float32)
     for i in range(int(n_im_shard)):
         im_start, im_end = shard_size*i, min(shard_size*(i+1), len(images))
         for j in range(int(n_cap_shard)):
@@ -294,11 +314,94 @@ def shard_xattn_i2t(images, captions, caplens, freqs, opt, shard_size=128):
             l = caplens[cap_start:cap_end]
             sim, attn = xattn_score_i2t(im, s, l, freqs, opt)
             d[im_start:im_end, cap_start:cap_end] = sim.data.cpu().numpy()
-            attention = attention + attn
+            if keep_attn:
+                attention.extend(attn)
     sys.stdout.write('\n')
     return d, attention
 
 
+def merge_topk(top_scores, top_inds, block, offset, k):
+    """
+    Merge the scores of a new block of columns into the running top-k of
+    every row, best first
+    top_scores, top_inds: (n, k) running top-k
+    block: (n, m) new scores, column j has global index offset + j
+    """
+    n, m = block.shape
+    scores = np.concatenate([top_scores, block], axis=1)
+    inds = np.concatenate([top_inds, np.broadcast_to(np.arange(offset, offset + m), (n, m))], axis=1)
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1)
+    return np.take_along_axis(part_scores, order, axis=1), np.take_along_axis(np.take_along_axis(inds, part, axis=1), order, axis=1)
+
+
+def shard_xattn_stream(images, captions, caplens, freqs, opt, k=50, shard_size=128):
+    """
+    Streaming version of shard_xattn_t2i/shard_xattn_i2t, the (N, N) similarity
+    matrix is never stored. Only the running top-k of every image and caption
+    and the number of scores beating the ground truth (the diagonal) are kept,
+    so memory stays O(N*k). No attention is captured.
+    When n_image != n_caption, the rows without ground truth get rank -1 (NO_GT_RANK)
+    and are left out by recall_metrics.
+    --> (ranks_i2t, top_i2t), (ranks_t2i, top_t2i), ranks (N) and top (N, k)
+    """
+    if opt.cross_attn == 't2i':
+        score = xattn_score_t2i
+    elif opt.cross_attn == 'i2t':
+        score = xattn_score_i2t
+    else:
+        raise NotImplementedError
+
+    n_image, n_caption = len(images), len(captions)
+    k_i2t, k_t2i = min(k, n_caption), min(k, n_image)
+    n_im_shard = (n_image-1)//shard_size + 1
+    n_cap_shard = (n_caption-1)//shard_size + 1
+
+    top_i2t = (np.full((n_image, k_i2t), -np.inf, dtype=np.float32), np.zeros((n_image, k_i2t), dtype=np.int64))
+    top_t2i = (np.full((n_caption, k_t2i), -np.inf, dtype=np.float32), np.zeros((n_caption, k_t2i), dtype=np.int64))
+    ranks_i2t = np.zeros(n_image)
+    ranks_t2i = np.zeros(n_caption)
+    gt = np.zeros(min(n_image, n_caption), dtype=np.float32)
+
+    # the diagonal shards come first, they hold the ground truth scores
+    shards = [(i, i) for i in range(min(n_im_shard, n_cap_shard))]
+    shards += [(i, j) for i in range(n_im_shard) for j in range(n_cap_shard) if i != j]
+
+    for i, j in shards:
+        sys.stdout.write('\r>> shard_xattn_stream batch (%d,%d)' % (i,j))
+        im_start, im_end = shard_size*i, min(shard_size*(i+1), n_image)
+        cap_start, cap_end = shard_size*j, min(shard_size*(j+1), n_caption)
+        with torch.no_grad():
+            im = torch.from_numpy(images[im_start:im_end])
+            s = torch.from_numpy(captions[cap_start:cap_end])
+            if torch.cuda.is_available():
+                im, s = im.cuda(), s.cuda()
+            sim, _ = score(im, s, caplens[cap_start:cap_end], freqs[cap_start:cap_end], opt)
+        block = sim.data.cpu().numpy().astype(np.float32)
+
+        if i == j:
+            n_diag = min(im_end, cap_end) - im_start
+            gt[im_start:im_start+n_diag] = block[np.arange(n_diag), np.arange(n_diag)]
+
+        # rows of images, columns of captions
+        gt_rows = gt[im_start:min(im_end, len(gt))]
+        ranks_i2t[im_start:im_start+len(gt_rows)] += np.count_nonzero(block[:len(gt_rows)] > gt_rows[:, None], axis=1)
+        gt_cols = gt[cap_start:min(cap_end, len(gt))]
+        ranks_t2i[cap_start:cap_start+len(gt_cols)] += np.count_nonzero(block[:, :len(gt_cols)] > gt_cols[None, :], axis=0)
+
+        top_i2t_s, top_i2t_i = merge_topk(top_i2t[0][im_start:im_end], top_i2t[1][im_start:im_end], block, cap_start, k_i2t)
+        top_i2t[0][im_start:im_end], top_i2t[1][im_start:im_end] = top_i2t_s, top_i2t_i
+        top_t2i_s, top_t2i_i = merge_topk(top_t2i[0][cap_start:cap_end], top_t2i[1][cap_start:cap_end], block.T, im_start, k_t2i)
+        top_t2i[0][cap_start:cap_end], top_t2i[1][cap_start:cap_end] = top_t2i_s, top_t2i_i
+    sys.stdout.write('\n')
+
+    # rows without a ground truth pair have no rank
+    ranks_i2t[len(gt):] = NO_GT_RANK
+    ranks_t2i[len(gt):] = NO_GT_RANK
+    return (ranks_i2t, top_i2t[1]), (ranks_t2i, top_t2i[1])
+
+
 def i2t(images, captions, caplens, sims, npts=None, return_ranks=False):
     """
     Images->Text (Image Annotation)
@@ -310,38 +413,14 @@ def i2t(images, captions, caplens, sims, npts=None, return_ranks=False):
     rank: what is the rank of the corresponding image/caption,
           when 0 the image-caption is matched, because rank is highest
     """
-    npts = images.shape[0]
-    ranks = np.zeros(npts)
-    top1 = np.zeros(npts)
-
-    for index in range(npts):
-
-        # sort the array and reverse the order to find most similar caption to image
-        inds = np.argsort(sims[index])[::-1]
-        # Score
-        rank = 1e20
-
-        # return indexes where inds == index
-        tmp = np.where(inds == index)
-        tmp = tmp[0][0]
-
-        if tmp < rank:
-            rank = tmp
-        ranks[index] = rank
-        top1[index] = inds[0]
-
-    # Compute metrics
-    r1 = 100.0 * len(np.where(ranks < 1)[0]) / len(ranks)
-    r5 = 100.0 * len(np.where(ranks < 5)[0]) / len(ranks)
-    r10 = 100.0 * len(np.where(ranks < 10)[0]) / len(ranks)
-    r20 = 100.0 * len(np.where(ranks < 20)[0]) / len(ranks)
-    r50 = 100.0 * len(np.where(ranks < 50)[0]) / len(ranks)
-    medr = np.floor(np.median(ranks)) + 1
-    meanr = ranks.mean() + 1
+    ranks, top1 = diag_ranks(sims)
+
+    # (r1, r5, r10, r20, r50, medr, meanr)
+    r = recall_metrics(ranks)
     if return_ranks:
-        return (r1, r5, r10, r20, r50, medr, meanr), (ranks, top1)
+        return r, (ranks, top1)
     else:
-        return (r1, r5, r10,r20, r50, medr, meanr)
+        return r
 
 
 def t2i(images, captions, caplens, sims, npts=None, return_ranks=False):
@@ -352,28 +431,11 @@ def t2i(images, captions, caplens, sims, npts=None, return_ranks=False):
     CapLens: (N) array of caption lengths
     sims: (N, N) matrix of similarity im-cap
     """
-    npts = images.shape[0]
-    ranks = np.zeros(npts)
-    top1 = np.zeros(npts)
-
     # --> (5N(caption), N(image))
-    sims = sims.T
-
-    for index in range(npts):
-
-        inds = np.argsort(sims[index])[::-1]
-        ranks[index] = np.where(inds == index)[0][0]
-        top1[index] = inds[0]
-
-    # Compute metrics
-    r1 = 100.0 * len(np.where(ranks < 1)[0]) / len(ranks)
-    r5 = 100.0 * len(np.where(ranks < 5)[0]) / len(ranks)
-    r10 = 100.0 * len(np.where(ranks < 10)[0]) / len(ranks)
-    r20 = 100.0 * len(np.where(ranks < 20)[0]) / len(ranks)
-    r50 = 100.0 * len(np.where(ranks < 50)[0]) / len(ranks)
-    medr = np.floor(np.median(ranks)) + 1
-    meanr = ranks.mean() + 1
+    ranks, top1 = diag_ranks(sims.T)
+
+    r = recall_metrics(ranks)
     if return_ranks:
-        return (r1, r5, r10, r20, r50, medr, meanr), (ranks, top1)
+        return r, (ranks, top1)
     else:
-        return (r1, r5, r10, r20, r50, medr, meanr)
+        return r
@@ -0,0 +1,83 @@
+from vocab import Vocabulary, deserialize_vocab  # NOQA
+from data_ken import get_test_loader
+from model import SCAN
+from evaluation import encode_data
+from emb_cache import cache_path, encode_data_cached
+import numpy as np
+import torch
+import argparse
+
+"""
+Writes mean pooled, l2 normalized image and caption embeddings of a trained SCAN model,
+used by vilbert_beta (vilbert/two_stage.py) to shortlist the images before re-ranking.
+Every caption row is stored with the id of its image and its text as in the captions file, the two
+together identify the caption when the embeddings are joined with another dataset (the text is
+normalized on both sides by the reader, vilbert/two_stage.py caption_text).
+"""
+
+# python export_pooled.py --model_path "runs/run0/seed1/checkpoint/model_best.pth.tar" --split test --out pooled_test.npz
+
+
+def pool(img_embs, cap_embs, cap_lens):
+    """
+    Mean over the regions of every image and over the words of every caption
+    --> (image embeddings (n, d), caption embeddings (n, d)), l2 normalized
+    """
+    img_pooled = np.asarray(img_embs, dtype=np.float32).mean(axis=1)
+
+    cap_embs = np.asarray(cap_embs, dtype=np.float32)
+    cap_lens = np.asarray(cap_lens)
+    mask = np.arange(cap_embs.shape[1])[None, :] < cap_lens[:, None]
+    cap_pooled = (cap_embs * mask[:, :, None]).sum(axis=1) / np.maximum(cap_lens, 1)[:, None]
+
+    normalize = lambda x: x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+    return normalize(img_pooled), normalize(cap_pooled)
+
+
+def main(args):
+    checkpoint = torch.load(args.model_path)
+    opt = checkpoint['opt']
+    if args.data_path is not None:
+        opt.data_path = args.data_path
+
+    vocab = deserialize_vocab("{}{}/{}_vocab_{}.json".format(args.vocab_path, opt.clothing, opt.data_name, opt.version))
+    opt.vocab_size = len(vocab)
+    model = SCAN(opt)
+    model.load_state_dict(checkpoint['model'])
+
+    data_loader = get_test_loader(args.split, opt.data_name, vocab, opt.batch_size, opt.workers, opt)
+
+    if args.cache_dir is not None:
+        path = cache_path(args.cache_dir, args.model_path, args.split, opt)
+        img_embs, cap_embs, cap_lens, _ = encode_data_cached(encode_data, path, model, data_loader, compute_loss=False)
+    else:
+        img_embs, cap_embs, cap_lens, _ = encode_data(model, data_loader, compute_loss=False)
+
+    img_pooled, cap_pooled = pool(img_embs, cap_embs, cap_lens)
+
+    # row i of the embeddings is caption i of the dataset, of image dset.images[i]
+    dset = data_loader.dataset
+    if isinstance(dset.images, list):
+        caption_ids = np.array([int(img_id) for img_id in dset.images])
+    else:
+        caption_ids = np.arange(len(cap_lens)) // dset.im_div
+    caption_texts = np.array(dset.captions[:len(cap_lens)])
+    image_ids, first = np.unique(caption_ids, return_index=True)
+
+    np.savez(args.out, image_ids=image_ids, image_embs=img_pooled[first],
+             caption_ids=caption_ids, caption_texts=caption_texts, caption_embs=cap_pooled)
+    print("Wrote {} images and {} captions to {}".format(len(image_ids), len(caption_ids), args.out))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export pooled SCAN embeddings')
+
+    parser.add_argument('--model_path', required=True, type=str, help='checkpoint of the model')
+    parser.add_argument('--split', default="test", type=str, help='split to export')
+    parser.add_argument('--out', default="pooled_test.npz", type=str, help='output .npz file')
+    parser.add_argument('--data_path', default=None, type=str, help='overrides the data path of the checkpoint')
+    parser.add_argument('--vocab_path', default="../vocab/", type=str, help='folder of the vocabularies')
+    parser.add_argument('--cache_dir', default=None, type=str, help='cache the embeddings in this folder')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,99 @@
+"""Fork-safe reader for the Fashion-Gen HDF5 images"""
+
+import os
+import random
+from collections import OrderedDict
+import h5py
+import torch.utils.data as data
+
+"""
+The h5py file is opened lazily in every process that reads from it, so the reader can be
+handed to DataLoader workers. Reads go per HDF5 chunk: the whole chunk that holds a row is read
+at once and kept in a small LRU cache. Together with ChunkSampler, which orders the indices by
+chunk, the reads become sequential. There is no read-ahead thread: h5py holds a global lock
+during every read, so a background read cannot overlap the reads of the DataLoader worker.
+"""
+
+
+class H5Images(object):
+    """Rows of one dataset of a HDF5 file"""
+
+    def __init__(self, file, key="input_image", cache_mb=64, n_cached_chunks=4):
+        self.file = file
+        self.key = key
+        self.cache_mb = cache_mb
+        self.n_cached_chunks = n_cached_chunks
+
+        with h5py.File(file, 'r') as f:
+            dset = f[key]
+            self.shape = dset.shape
+            self.dtype = dset.dtype
+            self.chunk_rows = dset.chunks[0] if dset.chunks is not None else 1
+
+        self._pid = None
+
+    def __getstate__(self):
+        # the open file stays in the process that created it
+        state = self.__dict__.copy()
+        for key in ["_h5", "_dset", "_chunks"]:
+            state.pop(key, None)
+        state["_pid"] = None
+        return state
+
+    def _open(self):
+        if self._pid != os.getpid():
+            self._h5 = h5py.File(self.file, 'r', rdcc_nbytes=self.cache_mb * 1024 ** 2)
+            self._dset = self._h5[self.key]
+            self._chunks = OrderedDict()
+            self._pid = os.getpid()
+        return self._dset
+
+    def _read_chunk(self, chunk):
+        start = chunk * self.chunk_rows
+        if chunk in self._chunks:
+            self._chunks.move_to_end(chunk)
+            return self._chunks[chunk]
+        slab = self._dset[start:min(start + self.chunk_rows, self.shape[0])]
+        self._chunks[chunk] = slab
+        while len(self._chunks) > self.n_cached_chunks:
+            self._chunks.popitem(last=False)
+        return slab
+
+    def __getitem__(self, row):
+        self._open()
+        chunk = row // self.chunk_rows
+        slab = self._read_chunk(chunk)
+        return slab[row - chunk * self.chunk_rows]
+
+    def __len__(self):
+        return self.shape[0]
+
+
+class ChunkSampler(data.Sampler):
+    """
+    Yields the dataset indices grouped by the HDF5 chunk of their row, the order of the
+    chunks and of the indices within a chunk is shuffled every epoch
+    rows: HDF5 row of every dataset index
+    """
+
+    def __init__(self, rows, chunk_rows, shuffle=True):
+        self.shuffle = shuffle
+        groups = OrderedDict()
+        for index, row in enumerate(rows):
+            groups.setdefault(row // chunk_rows, []).append(index)
+        self.groups = list(groups.values())
+        self.length = len(rows)
+
+    def __iter__(self):
+        order = list(range(len(self.groups)))
+        if self.shuffle:
+            random.shuffle(order)
+        for g in order:
+            group = list(self.groups[g])
+            if self.shuffle:
+                random.shuffle(group)
+            for index in group:
+                yield index
+
+    def __len__(self):
+        return self.length
@@ -173,6 +173,26 @@ if __name__ == '__main__':
                         help="use rectangle ratio for images")
     parser.add_argument('--shard_size', default=128, type=int,
                         help='batch size for validating')
+    parser.add_argument('--batched_xattn', action='store_true',
+                        help="score all image-caption pairs of a batch at once instead of looping over the captions")
+    parser.add_argument('--stream_eval', action='store_true',
+                        help="only keep the top-k per image/caption during validation instead of the full similarity matrix")
+    parser.add_argument('--stream_k', default=50, type=int,
+                        help='(Used for stream_eval) number of best matches kept per image/caption')
+    parser.add_argument('--pretokenize', action='store_true',
+                        help="tokenize the captions once into a memory-mapped store instead of in every __getitem__")
+    parser.add_argument('--image_store', action='store_true',
+                        help="(Fashion200K) read pre-decoded uint8 images created by image_store.py and normalize them per batch")
+    parser.add_argument('--h5_cache_mb', default=64, type=int,
+                        help='(Fashion-Gen) size of the HDF5 chunk cache per DataLoader worker')
+    parser.add_argument('--h5_chunk_sampler', action='store_true',
+                        help="(Fashion-Gen) group the samples of an epoch by HDF5 chunk so reads are sequential")
+    parser.add_argument('--uint8_images', action='store_true',
+                        help="send uint8 images to the model and resize/normalize them per batch on its device")
+    parser.add_argument('--amp', action='store_true',
+                        help="(GPU) mixed precision training of the encoders and the cross attention loss with gradient scaling")
+    parser.add_argument('--channels_last', action='store_true',
+                        help="use channels-last memory format for the convolutional image encoders")
 
     opt = parser.parse_args()
     main(opt)
@@ -0,0 +1,118 @@
+"""Pre-decoded image store"""
+
+import os
+import csv
+import argparse
+import numpy as np
+import torch
+import torch.nn.functional as F
+from multiprocessing import Pool
+from PIL import Image
+
+"""
+Decodes and resizes the Fashion200K images of a split once into a uint8 (n_image, H, W, 3)
+memory-mapped .npy file, the ids of the rows are stored next to it. The dataset returns the
+uint8 images and the normalization is done per batch on the training device (normalize_batch).
+"""
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+
+def store_files(data_path, version, data_split, size=256):
+    file = "{}/images_{}_{}_{}".format(data_path, version, data_split, size)
+    return file + ".npy", file + "_ids.txt"
+
+
+def read_image_ids(data_path, version, data_split):
+    """Unique image ids of the split, in order of appearance in the captions file
+    """
+    ids = []
+    seen = set()
+    with open('{}/data_captions_{}_{}.txt'.format(data_path, version, data_split), 'r', newline='') as csvfile:
+        reader = csv.reader(csvfile, delimiter='\t')
+        for line in reader:
+            img_id = line[0].strip()
+            if img_id not in seen:
+                seen.add(img_id)
+                ids.append(img_id)
+    return ids
+
+
+def decode_image(args):
+    path, size = args
+    image = Image.open(path).convert("RGB")
+    # same interpolation as transforms.Resize
+    image = image.resize((size, size), Image.BILINEAR)
+    return np.asarray(image, dtype=np.uint8)
+
+
+def build_image_store(data_path, version, data_split, image_path, size=256, workers=4):
+    """Decode and resize all images of the split into the store
+    """
+    file, ids_file = store_files(data_path, version, data_split, size)
+    ids = read_image_ids(data_path, version, data_split)
+
+    tmp_file = file + ".tmp.npy"
+    images = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.uint8, shape=(len(ids), size, size, 3))
+    jobs = [("{}/{}/{}_0.jpeg".format(data_path, image_path, img_id), size) for img_id in ids]
+
+    with Pool(workers) as pool:
+        for i, image in enumerate(pool.imap(decode_image, jobs, chunksize=64)):
+            images[i] = image
+            if i % 1000 == 0:
+                print("decoded {}/{}".format(i, len(ids)))
+    images.flush()
+    del images
+
+    with open(ids_file, 'w') as f:
+        f.write("\n".join(ids))
+    os.rename(tmp_file, file)
+
+
+class ImageStore(object):
+    """Memory-mapped images of a store, indexed by image id"""
+
+    def __init__(self, data_path, version, data_split, size=256):
+        file, ids_file = store_files(data_path, version, data_split, size)
+        if not os.path.exists(file):
+            raise FileNotFoundError("no image store {}, create it first with image_store.py".format(file))
+        self.images = np.load(file, mmap_mode='r')
+        with open(ids_file, 'r') as f:
+            self.rows = {img_id: i for i, img_id in enumerate(f.read().split("\n"))}
+
+    def __getitem__(self, img_id):
+        """uint8 (3, H, W) tensor of the image
+        """
+        image = np.array(self.images[self.rows[img_id]])
+        return torch.from_numpy(image).permute(2, 0, 1)
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def normalize_batch(images, size=None):
+    """uint8 (batch, 3, H, W) images to the normalized float input of the image encoders,
+    resized to (size, size) when given. Runs on the device of images.
+    """
+    images = images.float().div_(255)
+    if size is not None and tuple(images.shape[-2:]) != (size, size):
+        images = F.interpolate(images, size=(size, size), mode='bilinear', align_corners=False)
+    mean = torch.tensor(MEAN, device=images.device).view(1, 3, 1, 1)
+    std = torch.tensor(STD, device=images.device).view(1, 3, 1, 1)
+    return images.sub_(mean).div_(std)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_path', default="../data/Fashion200K/dresses", type=str, help='folder with the captions files')
+    parser.add_argument('--image_path', default="pictures_only/pictures_only", type=str, help='folder of the images in data_path')
+    parser.add_argument('--version', default="laenen", type=str, help='version of the captions')
+    parser.add_argument("--splits", nargs="+", default=["train", "dev", "test"])
+    parser.add_argument('--size', default=256, type=int, help='height and width of the stored images')
+    parser.add_argument('--workers', default=4, type=int, help='number of decoding processes')
+    args = parser.parse_args()
+
+    for split in args.splits:
+        print("creating image store for {}".format(split))
+        build_image_store(args.data_path, args.version, split, args.image_path, args.size, args.workers)
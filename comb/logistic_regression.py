@@ -9,6 +9,7 @@ from vocab import Vocabulary, deserialize_vocab
 from model import SCAN
 from data_ken import PrecompDataset, PrecompTrans, collate_fn
 from evaluation import encode_data
+from emb_cache import cache_path, encode_data_cached
 import random
 import numpy as np
 import math
@@ -56,8 +57,8 @@ def main(args):
         data_loader_train1, positions_train1 = retrieve_loader("train", opt, dpath, word1, vocab)
         data_loader_train2, positions_train2 = retrieve_loader("train", opt, dpath, word2, vocab)
 
-        features1 = create_embs(data_loader_train1, model)
-        features2 = create_embs(data_loader_train2, model)
+        features1 = create_embs(data_loader_train1, model, emb_cache_path(args, model_path, opt, word1))
+        features2 = create_embs(data_loader_train2, model, emb_cache_path(args, model_path, opt, word2))
 
         f1_best = []
         f1_worst = []
@@ -179,10 +180,19 @@ def create_train_test(features1, features2, test_percentage, min_l):
 
     return train, test, y_train, y_test, min_l
 
-def create_embs(data_loader, model):
-    img_emb, cap_emb, cap_len, _ = encode_data(model, data_loader)
+def create_embs(data_loader, model, path=None):
+    if path is not None:
+        img_emb, cap_emb, cap_len, _ = encode_data_cached(encode_data, path, model, data_loader, compute_loss=False)
+    else:
+        img_emb, cap_emb, cap_len, _ = encode_data(model, data_loader, compute_loss=False)
     return img_emb
 
+def emb_cache_path(args, model_path, opt, word, split="train"):
+    # embeddings of the dataset filtered on word, None when caching is off
+    if args.cache_dir is None:
+        return None
+    return cache_path(args.cache_dir, model_path, split, opt, subset=word)
+
 def retrieve_loader(split, opt, dpath, word, vocab):
 
     if opt.precomp_enc_type == "trans" or opt.precomp_enc_type == "layers" or opt.precomp_enc_type == "layers_attention" or opt.precomp_enc_type == "cnn_layers" or opt.precomp_enc_type == "layers_attention_res" or opt.precomp_enc_type == "layers_attention_im":
@@ -231,6 +241,7 @@ if __name__ == "__main__":
     parser.add_argument('--run', default="run61", type=str, help='which run')
     parser.add_argument("--list_words", nargs="+", default=["black", "white", "black", "blue", "green", "red", "floral", "lace", "jersey", "silk", "midi", "sheath"])
     parser.add_argument('--min_l',help='maximum nr of features for one word', default=400, type=int)
+    parser.add_argument('--cache_dir', default=None, type=str, help='folder to cache the encoded embeddings in')
 
 
     args = parser.parse_args()
@@ -17,7 +17,7 @@ from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from torch.nn.utils.weight_norm import weight_norm
 import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
-from torch.nn.utils.clip_grad import clip_grad_norm
+from torch.nn.utils.clip_grad import clip_grad_norm_
 import numpy as np
 from collections import OrderedDict
 from utils import adap_margin
@@ -33,6 +33,7 @@ from util.layers_res4 import LayersScanResDeep
 from util.cnn_end2end import CNN_end2end
 from transformers import BertModel
 from cnn_layers import CNN_layers
+from image_store import normalize_batch
 from div_loss import cosine_loss, euclidean_loss, euclidean_heat_loss, ssd, dpp, weight_loss
 
 def l1norm(X, dim, eps=1e-8):
@@ -326,7 +327,7 @@ def func_attention(query, context, opt, smooth, eps=1e-8):
     if opt.raw_feature_norm == "softmax" or opt.raw_feature_norm == "argmax":
         # --> (batch*sourceL, queryL)
         attn = attn.view(batch_size*sourceL, queryL)
-        attn = nn.Softmax()(attn)
+        attn = nn.Softmax()(attn.float())
         # --> (batch, sourceL, queryL)
         attn = attn.view(batch_size, sourceL, queryL)
     elif opt.raw_feature_norm == "l2norm":
@@ -349,7 +350,7 @@ def func_attention(query, context, opt, smooth, eps=1e-8):
     attn = torch.transpose(attn, 1, 2).contiguous()
     # --> (batch*queryL, sourceL)
     attn = attn.view(batch_size*queryL, sourceL)
-    attn = nn.Softmax()(attn*smooth)
+    attn = nn.Softmax()(attn.float()*smooth)
     # --> (batch, queryL, sourceL)
     attn = attn.view(batch_size, queryL, sourceL)
     # --> (batch, sourceL, queryL)
@@ -368,7 +369,7 @@ def func_attention(query, context, opt, smooth, eps=1e-8):
             temp = temp.cuda()
         attnT = temp.scatter_(dim=1, index=max_indx.unsqueeze(dim=1), value=1)
 
-    weightedContext = torch.bmm(contextT, attnT)
+    weightedContext = torch.bmm(contextT, attnT.to(contextT.dtype))
     # --> (batch, queryL, d)
     weightedContext = torch.transpose(weightedContext, 1, 2)
 
@@ -391,6 +392,9 @@ def xattn_score_t2i(images, captions, cap_lens, freqs, opt):
     Captions: (n_caption, max_n_word, d) matrix of captions
     CapLens: (n_caption) array of caption lengths
     """
+    if getattr(opt, "batched_xattn", False):
+        return xattn_score_t2i_batched(images, captions, cap_lens, freqs, opt)
+
     similarities = []
     n_image = images.size(0)
     n_caption = captions.size(0)
@@ -420,7 +424,7 @@ def xattn_score_t2i(images, captions, cap_lens, freqs, opt):
             row_sim = row_sim.unsqueeze(0)
 
         if opt.agg_func == 'LogSumExp':
-            row_sim.mul_(opt.lambda_lse).exp_()
+            row_sim = row_sim.float().mul_(opt.lambda_lse).exp_()
             row_sim = row_sim.sum(dim=1, keepdim=True)
             row_sim = torch.log(row_sim)/opt.lambda_lse
         elif opt.agg_func == 'Max':
@@ -485,6 +489,9 @@ def xattn_score_i2t(images, captions, cap_lens, freqs, opt):
     Captions: (batch_size, max_n_words, d) matrix of captions
     CapLens: (batch_size) array of caption lengths
     """
+    if getattr(opt, "batched_xattn", False):
+        return xattn_score_i2t_batched(images, captions, cap_lens, freqs, opt)
+
     similarities = []
     n_image = images.size(0)
     n_caption = captions.size(0)
@@ -512,7 +519,7 @@ def xattn_score_i2t(images, captions, cap_lens, freqs, opt):
             row_sim = row_sim.unsqueeze(0)
 
         if opt.agg_func == 'LogSumExp':
-            row_sim.mul_(opt.lambda_lse).exp_()
+            row_sim = row_sim.float().mul_(opt.lambda_lse).exp_()
             row_sim = row_sim.sum(dim=1, keepdim=True)
             row_sim = torch.log(row_sim)/opt.lambda_lse
         elif opt.agg_func == 'Max':
@@ -533,6 +540,162 @@ def xattn_score_i2t(images, captions, cap_lens, freqs, opt):
     return similarities, attention_store
 
 
+def word_mask_from_lens(cap_lens, max_n_word, device):
+    """Boolean (n_caption, max_n_word) mask, True for the valid words,
+    together with the caption lengths as a tensor
+    """
+    cap_lens = torch.as_tensor([int(l) for l in cap_lens], device=device)
+    positions = torch.arange(max_n_word, device=device).unsqueeze(0)
+    return positions < cap_lens.unsqueeze(1), cap_lens
+
+
+def freq_weights(freqs, cap_lens, max_n_word, eps):
+    """Normalized inverse log frequency of every word, used by agg_func=Freq
+    --> (n_caption, max_n_word), zero for padded positions
+    """
+    weights = torch.zeros(len(freqs), max_n_word)
+    for i, freq in enumerate(freqs):
+        n_word = int(cap_lens[i])
+        freqs_log = torch.FloatTensor([1 / (np.log(f + eps)) if f != 0 else 0 for f in freq[:n_word]])
+        weights[i, :len(freqs_log)] = freqs_log / torch.sum(freqs_log)
+    return weights
+
+
+def batched_feature_norm(attn, opt, dim, mask=None):
+    """First normalization of the raw attention (opt.raw_feature_norm) over
+    dim, positions outside mask do not take part in the normalization
+    """
+    if opt.raw_feature_norm == "softmax" or opt.raw_feature_norm == "argmax":
+        if mask is not None:
+            attn = attn.masked_fill(~mask, float("-inf"))
+        return F.softmax(attn.float(), dim=dim)
+
+    if opt.raw_feature_norm in ("clipped_l2norm", "clipped_l1norm", "clipped"):
+        attn = F.leaky_relu(attn, 0.1)
+    elif opt.raw_feature_norm not in ("l2norm", "l1norm", "no_norm"):
+        raise ValueError("unknown first norm type:", opt.raw_feature_norm)
+
+    if mask is not None:
+        attn = attn.masked_fill(~mask, 0)
+    if opt.raw_feature_norm in ("l2norm", "clipped_l2norm"):
+        attn = l2norm(attn, dim)
+    elif opt.raw_feature_norm in ("l1norm", "clipped_l1norm"):
+        attn = l1norm(attn, dim)
+    return attn
+
+
+def batched_attention(raw, opt, smooth, norm_dim, attn_dim, norm_mask=None, attn_mask=None):
+    """Two step attention of func_attention on the full score block,
+    the first normalization over norm_dim and the smoothed softmax over attn_dim
+    """
+    attn = batched_feature_norm(raw, opt, norm_dim, norm_mask)
+    attn = attn * smooth
+    if attn_mask is not None:
+        attn = attn.masked_fill(~attn_mask, float("-inf"))
+    attn = F.softmax(attn.float(), dim=attn_dim).to(raw.dtype)
+
+    # TESTING can be removed later if argmax doesnt work
+    if opt.raw_feature_norm == "argmax":
+        max_indx = torch.argmax(attn, dim=attn_dim, keepdim=True)
+        attn = torch.zeros_like(attn).scatter_(attn_dim, max_indx, 1)
+    return attn
+
+
+def aggregate_sim(row_sim, opt, mask=None, weights=None):
+    """Aggregate the word/region similarities in the last dimension
+    (opt.agg_func), positions outside mask are ignored
+    """
+    if mask is None:
+        mask = torch.ones_like(row_sim, dtype=torch.bool)
+
+    if opt.agg_func == 'LogSumExp':
+        row_sim = (row_sim.float() * opt.lambda_lse).masked_fill(~mask, float("-inf"))
+        return torch.logsumexp(row_sim, dim=-1) / opt.lambda_lse
+    elif opt.agg_func == 'Max':
+        return row_sim.masked_fill(~mask, float("-inf")).max(dim=-1)[0]
+    elif opt.agg_func == 'Sum':
+        return row_sim.masked_fill(~mask, 0).sum(dim=-1)
+    elif opt.agg_func == 'Mean':
+        return row_sim.masked_fill(~mask, 0).sum(dim=-1) / mask.sum(dim=-1).to(row_sim.dtype)
+    elif opt.agg_func == "Freq" and weights is not None:
+        return (row_sim.masked_fill(~mask, 0) * weights).sum(dim=-1)
+    elif opt.agg_func == "Freq":
+        raise ValueError("freq approach works only with t2i")
+    else:
+        raise ValueError("unknown aggfunc: {}".format(opt.agg_func))
+
+
+def xattn_score_t2i_batched(images, captions, cap_lens, freqs, opt, eps=1e-8):
+    """
+    Batched version of xattn_score_t2i, scores all image-caption pairs at once
+    Images: (n_image, n_regions, d) matrix of images
+    Captions: (n_caption, max_n_word, d) matrix of captions
+    CapLens: (n_caption) array of caption lengths
+    """
+    n_caption, max_n_word = captions.size(0), captions.size(1)
+    word_mask, cap_lens = word_mask_from_lens(cap_lens, max_n_word, captions.device)
+    # --> (1, n_caption, 1, max_n_word)
+    mask = word_mask.view(1, n_caption, 1, max_n_word)
+
+    # (n_image, n_caption, n_region, max_n_word)
+    raw = torch.einsum('ird,cwd->icrw', images, captions)
+    # normalize over the words, attend over the regions
+    attn = batched_attention(raw, opt, opt.lambda_softmax, norm_dim=3, attn_dim=2, norm_mask=mask)
+
+    # cosine similarity between every word and its attended image vector,
+    # the attended vector sum_r(attn_r * v_r) is never materialized:
+    # <w, sum_r attn_r v_r> = sum_r attn_r <w, v_r>
+    # |sum_r attn_r v_r|^2 = sum_rs attn_r attn_s <v_r, v_s>
+    w12 = (attn * raw).sum(dim=2)
+    gram = torch.bmm(images, images.transpose(1, 2))
+    w2 = torch.einsum('icrw,irs,icsw->icw', attn, gram, attn).clamp(min=0).sqrt()
+    w1 = captions.norm(dim=2).unsqueeze(0)
+    # (n_image, n_caption, max_n_word)
+    row_sim = w12 / (w1 * w2).clamp(min=eps)
+
+    weights = None
+    if opt.agg_func == "Freq":
+        weights = freq_weights(freqs, cap_lens, max_n_word, opt.epsilon).to(row_sim.device)
+    # (n_image, n_caption)
+    similarities = aggregate_sim(row_sim, opt, word_mask.unsqueeze(0), weights)
+
+    # same layout as the loop version: (n_image, n_region, n_word) per caption
+    attention_store = [attn[:, i, :, :int(cap_lens[i])] for i in range(n_caption)]
+    return similarities, attention_store
+
+
+def xattn_score_i2t_batched(images, captions, cap_lens, freqs, opt, eps=1e-8):
+    """
+    Batched version of xattn_score_i2t, scores all image-caption pairs at once
+    Images: (n_image, n_regions, d) matrix of images
+    Captions: (n_caption, max_n_word, d) matrix of captions
+    CapLens: (n_caption) array of caption lengths
+    """
+    n_caption, max_n_word = captions.size(0), captions.size(1)
+    word_mask, cap_lens = word_mask_from_lens(cap_lens, max_n_word, captions.device)
+    mask = word_mask.view(1, n_caption, 1, max_n_word)
+
+    # (n_image, n_caption, n_region, max_n_word)
+    raw = torch.einsum('ird,cwd->icrw', images, captions)
+    # normalize over the regions, attend over the words
+    attn = batched_attention(raw, opt, opt.lambda_softmax, norm_dim=2, attn_dim=3, attn_mask=mask)
+
+    # cosine similarity between every region and its attended caption vector
+    w12 = (attn * raw).sum(dim=3)
+    gram = torch.bmm(captions, captions.transpose(1, 2))
+    w2 = torch.einsum('icrw,cwv,icrv->icr', attn, gram, attn).clamp(min=0).sqrt()
+    w1 = images.norm(dim=2).unsqueeze(1)
+    # (n_image, n_caption, n_region)
+    row_sim = w12 / (w1 * w2).clamp(min=eps)
+
+    # (n_image, n_caption)
+    similarities = aggregate_sim(row_sim, opt)
+
+    # same layout as the loop version: (n_image, n_word, n_region) per caption
+    attention_store = [attn[:, i, :, :int(cap_lens[i])].transpose(1, 2) for i in range(n_caption)]
+    return similarities, attention_store
+
+
 class ContrastiveLoss(nn.Module):
     """
     Compute contrastive loss
@@ -672,6 +835,16 @@ class SCAN(object):
 
         self.optimizer = torch.optim.Adam(params, lr=opt.learning_rate)
 
+        # mixed precision for the encoders and the cross attention loss, the softmax and
+        # LogSumExp inputs are upcast to fp32
+        self.amp = getattr(opt, "amp", False) and torch.cuda.is_available()
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.amp)
+
+        # channels-last memory format for the convolutional image encoders
+        self.channels_last = getattr(opt, "channels_last", False)
+        if self.channels_last:
+            self.img_enc = self.img_enc.to(memory_format=torch.channels_last)
+
         self.Eiters = 0
 
     def state_dict(self):
@@ -705,12 +878,18 @@ class SCAN(object):
             images = images.cuda()
             captions = captions.cuda()
 
-        # cap_emb (tensor), cap_lens (list)
-        cap_emb, cap_lens = self.txt_enc(captions, lengths)
+        # uint8 images (image store, --uint8_images) are resized and normalized on the device
+        if images.dtype == torch.uint8:
+            images = normalize_batch(images, size=256)
+        if self.channels_last and images.dim() == 4:
+            images = images.contiguous(memory_format=torch.channels_last)
 
-        # Forward
-        img_emb = self.img_enc(images)
+        with torch.cuda.amp.autocast(enabled=self.amp):
+            # cap_emb (tensor), cap_lens (list)
+            cap_emb, cap_lens = self.txt_enc(captions, lengths)
 
+            # Forward
+            img_emb = self.img_enc(images)
 
         return img_emb, cap_emb, cap_lens
 
@@ -725,19 +904,26 @@ class SCAN(object):
             images = images.cuda()
             captions = captions.cuda()
 
-        # cap_emb (tensor), cap_lens (list)
-        cap_emb, cap_lens = self.txt_enc(captions, lengths)
+        # uint8 images (image store, --uint8_images) are resized and normalized on the device
+        if images.dtype == torch.uint8:
+            images = normalize_batch(images, size=256)
+        if self.channels_last and images.dim() == 4:
+            images = images.contiguous(memory_format=torch.channels_last)
 
-        # Forward
-        img_emb, attention = self.img_enc.forward_attention(images)
+        with torch.cuda.amp.autocast(enabled=self.amp):
+            # cap_emb (tensor), cap_lens (list)
+            cap_emb, cap_lens = self.txt_enc(captions, lengths)
 
+            # Forward
+            img_emb, attention = self.img_enc.forward_attention(images)
 
         return img_emb, cap_emb, cap_lens, attention
 
     def forward_loss(self, epoch, img_emb, cap_emb, cap_len, freq_score, freqs, **kwargs):
         """Compute the loss given pairs of image and caption embeddings
         """
-        total_loss, standard_loss, loss_div = self.criterion(img_emb, cap_emb, cap_len, freq_score, freqs, epoch)
+        with torch.cuda.amp.autocast(enabled=self.amp):
+            total_loss, standard_loss, loss_div = self.criterion(img_emb, cap_emb, cap_len, freq_score, freqs, epoch)
 
         # if self.opt.weight_loss != None:
         #     loss = weight_loss(self.img_enc, self.opt.weight_loss, self.opt.theta, self.opt.sigma, self.opt.n_detectors)
@@ -762,8 +948,10 @@ class SCAN(object):
         self.optimizer.zero_grad()
         loss = self.forward_loss(epoch, img_emb, cap_emb, cap_lens, freq_score, freqs)
 
-        # compute gradient and do SGD step
-        loss.backward()
+        # compute gradient and do SGD step, the scaler is a no-op without amp
+        self.scaler.scale(loss).backward()
         if self.grad_clip > 0:
-            clip_grad_norm(self.params, self.grad_clip)
-        self.optimizer.step()
+            self.scaler.unscale_(self.optimizer)
+            clip_grad_norm_(self.params, self.grad_clip)
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
@@ -1,5 +1,6 @@
 from vocab import Vocabulary
 from evaluation import *
+from ranking import top_n
 import csv
 import matplotlib
 matplotlib.use('Agg')
@@ -18,9 +19,9 @@ Evaluate the trained model on the test set
 
 def main(args):
     model_path = "{}{}/seed1/checkpoint/{}".format(args.model_path, args.run, args.checkpoint )
-    find_sims(model_path, args.run, args.top_n, data_path=args.data_path, split="test", vocab_path=args.vocab_path, change=args.change)
+    find_sims(model_path, args.run, args.top_n, data_path=args.data_path, split="test", vocab_path=args.vocab_path, change=args.change, cache_dir=args.cache_dir)
 
-def find_sims(model_path,run, n, data_path=None, split='dev', fold5=False, vocab_path="../vocab/", change=False):
+def find_sims(model_path,run, n, data_path=None, split='dev', fold5=False, vocab_path="../vocab/", change=False, cache_dir=None):
     """
     Evaluate a trained model on either dev or test. If `fold5=True`, 5 fold
     cross-validation is done (only for MSCOCO). Otherwise, the full data is
@@ -56,7 +57,11 @@ def find_sims(model_path,run, n, data_path=None, split='dev', fold5=False, vocab
                                   opt.batch_size, opt.workers, opt)
 
     print('Computing results...')
-    img_embs, cap_embs, cap_lens, freqs = encode_data(model, data_loader)
+    if cache_dir is not None:
+        path = cache_path(cache_dir, model_path, split, opt)
+        img_embs, cap_embs, cap_lens, freqs = encode_data_cached(encode_data, path, model, data_loader, compute_loss=False)
+    else:
+        img_embs, cap_embs, cap_lens, freqs = encode_data(model, data_loader, compute_loss=False)
     print('Images: %d, Captions: %d' %
           (img_embs.shape[0] , cap_embs.shape[0]))
 
@@ -201,16 +206,10 @@ def t2i(images, captions, caplens, sims, n, npts=None, return_ranks=False):
     sims: (N, N) matrix of similarity im-cap
     """
     npts = images.shape[0]
-    top_n = {}
 
     # --> (5N(caption), N(image))
-    sims = sims.T
-
-    for index in range(npts):
-
-        inds = np.argsort(sims[index])[::-1]
-        top_n[index] = inds[:n]
-    return top_n
+    top = top_n(sims.T[:npts], n)
+    return {index: top[index] for index in range(npts)}
 
 
 
@@ -226,13 +225,10 @@ def i2t(images, captions, caplens, sims, n, npts=None, return_ranks=False):
           when 0 the image-caption is matched, because rank is highest
     """
     npts = images.shape[0]
-    top_n = {}
 
-    for index in range(npts):
-        # sort the array and reverse the order to find most similar caption to image
-        inds = np.argsort(sims[index])[::-1]
-        top_n[index] = inds[:n]
-    return top_n
+    # most similar captions to every image
+    top = top_n(sims[:npts], n)
+    return {index: top[index] for index in range(npts)}
 
 
 if __name__ == "__main__":
@@ -245,5 +241,6 @@ if __name__ == "__main__":
     parser.add_argument('--vocab_path', default="/$HOME/thesis/vocab/", type=str, help='which checkpoint to use')
     parser.add_argument('--plot_path', default="/$HOME/runs/", type=str, help='which checkpoint to use')
     parser.add_argument('--change', action='store_true',help='change clothing from all to dresses (trained on all, evaluate on dresses)')
+    parser.add_argument('--cache_dir', default=None, type=str, help='folder to cache the encoded embeddings in')
     args = parser.parse_args()
     main(args)
@@ -22,7 +22,8 @@ import numpy
 import data_ken
 from vocab import Vocabulary, deserialize_vocab
 from model import SCAN
-from evaluation import i2t, t2i, AverageMeter, LogCollector, encode_data, shard_xattn_t2i, shard_xattn_i2t
+from evaluation import i2t, t2i, AverageMeter, LogCollector, encode_data, shard_xattn_t2i, shard_xattn_i2t, shard_xattn_stream
+from ranking import recall_metrics
 from torch.autograd import Variable
 from utils import save_hyperparameters
 import logging
@@ -165,22 +166,31 @@ def validate(opt, val_loader, model):
         start = time.time()
 
         # find the similarity between every caption and image in the validation set?
-        if opt.cross_attn == 't2i':
-            sims, _ = shard_xattn_t2i(img_embs, cap_embs, cap_lens, freqs, opt, shard_size=opt.shard_size)
+        if getattr(opt, "stream_eval", False):
+            (ranks, _), (ranks_i, _) = shard_xattn_stream(img_embs, cap_embs, cap_lens, freqs, opt,
+                                                          k=opt.stream_k, shard_size=opt.shard_size)
+        elif opt.cross_attn == 't2i':
+            sims, _ = shard_xattn_t2i(img_embs, cap_embs, cap_lens, freqs, opt, shard_size=opt.shard_size, keep_attn=False)
         elif opt.cross_attn == 'i2t':
-            sims, _= shard_xattn_i2t(img_embs, cap_embs, cap_lens, freqs,  opt, shard_size=opt.shard_size)
+            sims, _= shard_xattn_i2t(img_embs, cap_embs, cap_lens, freqs,  opt, shard_size=opt.shard_size, keep_attn=False)
         else:
             raise NotImplementedError
         end = time.time()
         print("calculate similarity time:", end-start)
 
         # caption retrieval (find the right text with every image)
-        (r1, r5, r10, r20, r50, medr, meanr) = i2t(img_embs, cap_embs, cap_lens, sims)
+        if getattr(opt, "stream_eval", False):
+            (r1, r5, r10, r20, r50, medr, meanr) = recall_metrics(ranks)
+        else:
+            (r1, r5, r10, r20, r50, medr, meanr) = i2t(img_embs, cap_embs, cap_lens, sims)
         logging.info("Image to text: %.1f, %.1f, %.1f, %.1f, %.1f %.1f %.1f" %
                      (r1, r5, r10, r20, r50, medr, meanr))
         # image retrieval (find the right image for every text)
-        (r1i, r5i, r10i, r20i, r50i, medri, meanr) = t2i(
-            img_embs, cap_embs, cap_lens, sims)
+        if getattr(opt, "stream_eval", False):
+            (r1i, r5i, r10i, r20i, r50i, medri, meanr) = recall_metrics(ranks_i)
+        else:
+            (r1i, r5i, r10i, r20i, r50i, medri, meanr) = t2i(
+                img_embs, cap_embs, cap_lens, sims)
         logging.info("Text to image: %.1f, %.1f, %.1f, %.1f, %.1f %.1f %.1f" %
                      (r1i, r5i, r10i, r20i, r50i, medri, meanr))
         # sum of recalls to be used for early stopping
@@ -47,8 +47,8 @@ def main(args):
         field = "input_name"
 
     if not only_text:
-        data_ims_train = create_features(f["input_image"], early_stop, network, trained_dresses, checkpoint, tile)
-        save_images(data_ims_train, data_path_out, version, "train")
+        create_features(f["input_image"], images_filename(data_path_out, version, "train"), early_stop, network,
+                        trained_dresses, checkpoint, tile, args.batch_size)
 
     data_captions_train = create_captions(f[field], early_stop, description)
     save_captions(data_captions_train, data_path_out, version, "train")
@@ -59,21 +59,19 @@ def main(args):
 
     f = h5py.File(file_path, 'r')
     if not only_text:
-        data_ims_test = create_features(f["input_image"], early_stop, network, trained_dresses, checkpoint, tile)
-        save_images(data_ims_test, data_path_out, version, "test")
+        create_features(f["input_image"], images_filename(data_path_out, version, "test"), early_stop, network,
+                        trained_dresses, checkpoint, tile, args.batch_size)
 
     data_captions_test = create_captions(f[field], early_stop, description)
     save_captions(data_captions_test, data_path_out, version, "test")
     f.close()
 
-def save_images(ims, data_path, version, split):
+def images_filename(data_path, version, split):
     if split == "train":
         filename = "{}/data_ims_{}_{}.npy".format(data_path, version, split)
     elif split == "test":
         filename = "{}/data_ims_{}_devtest.npy".format(data_path, version)
-
-    np.save(filename, ims)
-    print("Shape data ims {} is: {}".format(split, ims.shape))
+    return filename
 
 
 def save_captions(captions, data_path, version, split):
@@ -108,59 +106,60 @@ def create_captions(captions, early_stop, description):
             break
     return cleaned_captions
 
-def create_features(images, early_stop, network, trained_dresses, checkpoint, tile):
+# networks that take the full image, the others take the stacked segments
+FULL_IMAGE = ["layers", "layers_resnest", "layers_resnest_deep", "layers_simCLR", "layers_attr"]
+
+def create_features(images, filename, early_stop, network, trained_dresses, checkpoint, tile, batch_size=32):
+    """
+    Streams the images of the HDF5 dataset in slabs aligned with its chunks, pushes them through the net in
+    batches and writes the features to a memory-mapped .npy, so only one slab is held in memory
+    """
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     net, transform = get_model(network, trained_dresses, checkpoint, device)
 
     net = net.to(device)
 
-    features = []
-    count = 0
+    n_images = len(images) if early_stop is None else min(early_stop, len(images))
 
+    # read whole chunks of the HDF5 file at once
+    chunk = images.chunks[0] if images.chunks is not None else 1
+    slab = max(1, -(-batch_size // chunk)) * chunk
 
-    for image in images:
-        if network == "layers" or network == "layers_resnest" or network == "layers_resnest_deep":
-            img = Image.fromarray(image)
-            img_transformed = transform(img).unsqueeze(0).to(device)
-            feature = net.forward1(img_transformed).to("cpu").squeeze().detach().numpy()
-            features.append(feature)
-        elif network == "layers_simCLR" or  network == "layers_attr":
-            img = Image.fromarray(image)
-            img_transformed = transform(img).unsqueeze(0).to(device)
-            feature = net.forward(img_transformed).to("cpu").squeeze().detach().numpy()
-            features.append(feature)
-        elif network == "vilbert":
-            segments, bboxes = segment_dresses(image)
-            stacked_segs = stack_segments(segments, transform)
-            stacked_segs = stacked_segs.to(device)
-            dict = net(stacked_segs)
-            hidden_features = dict["out"]
-            dim = hidden_features.shape[2]
-            pool = nn.AvgPool2d((dim, dim))
-            feature = pool(hidden_features).to("cpu").squeeze().detach().numpy()
-            features.append(feature)
-        else:
-            # create segments in a dictionary
-            if tile:
-                segments, bboxes = segment_dresses_tile(image)
-            else:
-                segments, bboxes = segment_dresses(image)
-            # stack segments to push through net
-            stacked_segments = stack_segments(segments, transform)
-            feature = get_features(stacked_segments, net, device)
-            features.append(feature)
+    data_out = None
+    with torch.no_grad():
+        for slab_start in range(0, n_images, slab):
+            slab_images = images[slab_start:min(slab_start + slab, n_images)]
 
-        count += 1
+            for start in range(0, len(slab_images), batch_size):
+                batch = torch.stack([prepare_image(image, network, transform, tile)
+                                     for image in slab_images[start:start + batch_size]], dim=0)
+                features = get_features(batch, net, network, device)
 
-        if count % 10 == 0:
-            print(count)
-        if early_stop == count and early_stop != None:
-            break
+                # the shape of the features is known after the first batch
+                if data_out is None:
+                    data_out = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32,
+                                                         shape=(n_images,) + features.shape[1:])
+                data_out[slab_start + start:slab_start + start + len(features)] = features
 
-    data_out = np.stack(features, axis=0)
+            data_out.flush()
+            print(slab_start + len(slab_images))
 
-    return data_out
+    print("Shape data ims is: {}".format(data_out.shape))
+    del data_out
+
+
+# full image (C, H, W) or its stacked segments (S, C, H, W) as input of the net
+def prepare_image(image, network, transform, tile):
+    if network in FULL_IMAGE:
+        return transform(Image.fromarray(image))
+
+    # create segments in a dictionary
+    if tile and network != "vilbert":
+        segments, bboxes = segment_dresses_tile(image)
+    else:
+        segments, bboxes = segment_dresses(image)
+    return stack_segments(segments, transform)
 
 
 def stack_segments(segments, transform):
@@ -263,12 +262,28 @@ def get_model(network, trained_dresses, checkpoint, device):
     return net, transform
 
 
-# segment in seven parts and push through net
-def get_features(stacked_segments, net, device ):
-    stacked_segments = stacked_segments.to(device)
-    feature = net(stacked_segments).to("cpu")
-    feature = feature.detach().numpy()
-    return feature
+# features of a batch of images (B, C, H, W) or of their stacked segments (B, S, C, H, W) --> (B, num_boxes, dim)
+def get_features(batch, net, network, device):
+    batch = batch.to(device)
+    if network in ["layers", "layers_resnest", "layers_resnest_deep"]:
+        features = net.forward1(batch)
+    elif network in ["layers_simCLR", "layers_attr"]:
+        features = net.forward(batch)
+    else:
+        # push the segments of all images through the net at once
+        n_images, n_segments = batch.shape[:2]
+        batch = batch.flatten(0, 1)
+        if network == "vilbert":
+            hidden_features = net(batch)["out"]
+            dim = hidden_features.shape[2]
+            pool = nn.AvgPool2d((dim, dim))
+            features = pool(hidden_features)
+        else:
+            features = net(batch)
+        return features.reshape(n_images, n_segments, -1).to("cpu").numpy()
+
+    # same layout as the squeezed features of a single image
+    return features.reshape((features.shape[0],) + features[0].squeeze().shape).to("cpu").numpy()
 
 def str2bool(v):
     if v.lower() in ('yes', 'true', 't', 'y', '1'):
@@ -297,6 +312,7 @@ if __name__ == '__main__':
                         help="create captions from the input_descriptions field of the data")
     parser.add_argument('--network',help='alex|layers|layers_resnest', default="alex", type=str)
     parser.add_argument('--tile', action='store_true', help="segment image in tiles instead of laenen")
+    parser.add_argument('--batch_size', default=32, type=int, help='images per forward pass')
 
     # TO load pretrained dresses model
     parser.add_argument('--trained_dresses', action='store_true', help="load models trained on dresses")
@@ -2,6 +2,7 @@ import glob
 import argparse
 import time, os, sys
 import base64
+import json
 import numpy as np
 import cv2
 import csv
@@ -257,71 +258,143 @@ def get_model(args, device):
 
     return net, transform
 
-def generate_data(image_ids, args, net, transform, device):
+# networks that take the full image, the others take the stacked segments
+FULL_IMAGE = ["layers", "layers2", "layers_resnest", "layers_resnest_deep", "layers_simCLR", "layers_attr"]
 
-    data = {}
-    count_stop = 0
-    # open file to write data to TSV
+class ImageDataset(torch.utils.data.Dataset):
+    """reads, segments and transforms the images in the workers of the DataLoader"""
+    def __init__(self, image_ids, args, transform):
+        self.image_ids = image_ids
+        self.data_dir = args.data_dir
+        self.network = args.network
+        self.tile = args.tile
+        self.transform = transform
 
-    print("Started reading images")
-    # for every image create seven segmentations and push them through pretrained net
-    for img_id in image_ids:
-        path = img_id[0]
-        img_idx = img_id[1]
+    def __len__(self):
+        return len(self.image_ids)
 
-        img_path = "{}/{}".format(args.data_dir, path)
+    def __getitem__(self, index):
+        img_path = "{}/{}".format(self.data_dir, self.image_ids[index][0])
         img = mpimg.imread(img_path)
 
+        if self.network in FULL_IMAGE:
+            return index, self.transform(Image.fromarray(img))
+
         # segment dresses and retreive segmentations
-        if args.tile:
+        if self.tile:
             segments, bboxes = segment_dresses_tile(img)
         else:
             segments, bboxes = segment_dresses(img)
+        return index, stack_segments(segments, self.transform)
+
+# features of a batch of images (B, C, H, W) or of their stacked segments (B, S, C, H, W) --> (B, num_boxes, dim)
+def get_batch_features(images, net, network):
+    if network in ["layers", "layers2", "layers_resnest", "layers_resnest_deep"]:
+        features = net.forward1(images)
+    elif network in ["layers_simCLR", "layers_attr"]:
+        features = net.forward(images)
+    else:
+        # push the segments of all images through the net at once
+        n_images, n_segments = images.shape[:2]
+        features = images.flatten(0, 1)
+        if network == "vilbert":
+            hidden_features = net(features)["out"]
+            dim = hidden_features.shape[2]
+            pool = nn.AvgPool2d((dim, dim))
+            features = pool(hidden_features)
+        else:
+            features = net(features)
+        return features.reshape(n_images, n_segments, -1)
 
-        # create features from segmentations
-        seg = get_features(img, net, img_idx, transform, segments, bboxes, device, args.network)
-
-        temp = np.frombuffer( base64.b64decode(seg["features"]), dtype=np.float32)
-        temp = temp.reshape((seg["num_boxes"],-1))
-
-        data[img_idx] = temp
-        count_stop +=1
-        if count_stop == args.early_stop:
-            break
-
-        if count_stop % 10 == 0:
-            print(count_stop)
-    return data
-
-# create numpy array of features and txt file for captions, taking sure they match
-def combine_data_captions(data, data_captions, image_ids, args):
+    # same layout as the squeezed features of a single image
+    num_boxes = features[0].squeeze().shape[0]
+    return features.reshape(features.shape[0], num_boxes, -1)
 
-    ids_needed = []
-    for id in image_ids:
-        adress, im_id = id
-        if im_id in data.keys():
-            ids_needed.append(im_id)
-    data_out = np.stack([data[id] for id in ids_needed], axis=0)
+def write_progress(progress_path, progress):
+    tmp_path = "{}.tmp".format(progress_path)
+    with open(tmp_path, 'w') as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, progress_path)
 
-    # check if dir already excists
+def generate_data(image_ids, args, net, transform, device):
+    """
+    Writes the features of the images directly in a memory-mapped data_ims_{version}.npy.part, the number of
+    images done is checkpointed in data_ims_{version}.progress.json, a run that crashed continues from there
+    --> number of images written
+    """
     if not os.path.exists(args.data_out):
         os.makedirs(args.data_out)
 
+    n_images = len(image_ids) if args.early_stop is None else min(args.early_stop, len(image_ids))
+    part_path = "{}/data_ims_{}.npy.part".format(args.data_out, args.version)
+    progress_path = "{}/data_ims_{}.progress.json".format(args.data_out, args.version)
+
+    data_out = None
+    progress = {"n_images": n_images, "network": args.network, "tile": args.tile, "done": 0, "shape": None}
+    if os.path.exists(progress_path) and os.path.exists(part_path):
+        with open(progress_path, 'r') as f:
+            saved = json.load(f)
+        if all(saved[key] == progress[key] for key in ["n_images", "network", "tile"]) and saved["shape"] is not None:
+            progress = saved
+            data_out = np.lib.format.open_memmap(part_path, mode='r+')
+            print("Resuming at image {}".format(progress["done"]))
+
+    dataset = ImageDataset(image_ids[:n_images], args, transform)
+    dataset = torch.utils.data.Subset(dataset, range(progress["done"], n_images))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=False,
+                                         num_workers=args.workers, pin_memory=(device == 'cuda'))
+
+    print("Started reading images")
+    with torch.no_grad():
+        for i, (index, images) in enumerate(loader):
+            features = get_batch_features(images.to(device, non_blocking=True), net, args.network)
+            features = features.to("cpu").numpy()
+
+            # the shape of the features is known after the first batch
+            if data_out is None:
+                progress["shape"] = [n_images] + list(features.shape[1:])
+                data_out = np.lib.format.open_memmap(part_path, mode='w+', dtype=np.float32,
+                                                     shape=tuple(progress["shape"]))
+
+            data_out[index[0]:index[-1] + 1] = features
+            progress["done"] = int(index[-1]) + 1
+
+            if (i + 1) % args.checkpoint_every == 0 or progress["done"] == n_images:
+                # the features are on disk before the progress is written
+                data_out.flush()
+                write_progress(progress_path, progress)
+                print(progress["done"])
+
+    if data_out is not None:
+        data_out.flush()
+        del data_out
+    return n_images
+
+# rename the features to data_ims_{version}.npy and write the captions in the same order
+def combine_data_captions(n_images, data_captions, image_ids, args):
+    part_path = "{}/data_ims_{}.npy.part".format(args.data_out, args.version)
+    progress_path = "{}/data_ims_{}.progress.json".format(args.data_out, args.version)
+
+    ids_needed = [im_id for adress, im_id in image_ids[:n_images]]
+    data_out = np.load(part_path, mmap_mode='r')
+
     # print some shape checks
     print("Shape of data_out is {}".format(data_out.shape))
     print(len(ids_needed))
     if data_out.shape[0] != len(ids_needed):
         print("length should be equal!!")
         exit()
-
-    # save images and captions
-    np.save( "{}/data_ims_{}.npy".format(args.data_out, args.version), data_out)
+    del data_out
 
     with open('{}/data_captions_{}.txt'.format(args.data_out, args.version), 'w', newline='') as csvfile:
         writer = csv.writer(csvfile, delimiter='\t')
         for id in ids_needed:
             writer.writerow((id, data_captions[id]))
 
+    # save images
+    os.replace(part_path, "{}/data_ims_{}.npy".format(args.data_out, args.version))
+    os.remove(progress_path)
+
     return
 
 
@@ -346,6 +419,9 @@ def parse_args():
     parser.add_argument('--tile', action='store_true', help="use basic tile segmentation")
     parser.add_argument('--multi', action='store_true', help="use to create features for multi-modal evaluation")
     parser.add_argument("--list_clothing", nargs="+", default=["dresses"])
+    parser.add_argument('--batch_size',help='images per forward pass', default=32, type=int)
+    parser.add_argument('--workers',help='number of workers that read and segment the images', default=4, type=int)
+    parser.add_argument('--checkpoint_every',help='write the progress every number of batches', default=50, type=int)
 
     # TO load pretrained dresses model
     parser.add_argument('--trained_dresses', action='store_true', help="load models trained on dresses")
@@ -385,7 +461,7 @@ if __name__ == '__main__':
     net, transform = get_model(args, device)
 
     # generate features
-    data = generate_data(image_ids, args, net, transform, device)
+    n_images = generate_data(image_ids, args, net, transform, device)
 
-    # create numpy stack from features and match with captions
-    combine_data_captions(data, data_captions, image_ids, args)
+    # match features with captions
+    combine_data_captions(n_images, data_captions, image_ids, args)
@@ -227,7 +227,7 @@ def get_embs(opt, model ,run , version, data_path, plot_folder, split='test', fo
     data_loader = get_test_loader(split, opt.data_name, vocab,
                                   opt.batch_size, opt.workers, opt)
 
-    img_embs, cap_embs, cap_lens, freqs = encode_data(model, data_loader)
+    img_embs, cap_embs, cap_lens, freqs = encode_data(model, data_loader, compute_loss=False)
 
     if not os.path.exists('{}/embs'.format(plot_folder)):
         os.makedirs('{}/embs'.format(plot_folder))
@@ -1,45 +1,84 @@
+from functools import partial
 import torch.nn as nn
 import torch
-from sklearn import preprocessing
 import numpy as np
+from torch.utils.checkpoint import checkpoint
 
 class LaenenLoss(nn.Module):
     """
     Compute contrastive loss
+    chunk_size: number of captions scored at once, the (batch, chunk, n_frag, max_words)
+                fragment similarities of a chunk are recomputed in the backward pass
+                instead of stored. 0 is unchunked: the full (batch, batch, n_frag, max_words)
+                similarities are built in one matmul and kept for the backward pass
     """
-    def __init__(self, margin, n, switch, beta, gamma):
+    def __init__(self, margin, n, switch, beta, gamma, chunk_size=32):
         super(LaenenLoss, self).__init__()
         self.relu = nn.ReLU()
         self.beta = beta
         self.gamma = gamma
+        self.chunk_size = chunk_size
 
         # hyperparameters
         self.switch = switch
         self.n = n
         self.margin = margin
 
-    def forward(self, epoch, img_emb, cap_emb, cap_l, kmeans_features, kmeans_emb, cluster_loss):
-        n_frag = img_emb.size(1)
+    def forward(self, epoch, img_emb, cap_emb, cap_l, kmeans_features, kmeans_emb, cluster_loss, features=None):
         batch_size = img_emb.size(0)
         n_caption = cap_emb.size(0)
 
-        sims = torch.einsum('bik,ljk->blij', img_emb, cap_emb)
+        part1, centers = None, None
+        if cluster_loss:
+            # per fragment distance to its feature cluster and the nearest embedding centers
+            part1 = cluster1(features, kmeans_features).to(img_emb.device)
+            _, centers = kmeans_emb.nearest(img_emb.detach())
+
+        chunk_size = self.chunk_size if self.chunk_size > 0 else n_caption
+        sims_max = []
+        c_frag_loss = 0
+        c_cluster_loss = 0
+        for start in range(0, n_caption, chunk_size):
+            cap = cap_emb[start:start + chunk_size]
+            l = cap_l[start:start + chunk_size]
+
+            if not cluster_loss:
+                sims_max.append(max_frag(img_emb, cap))
+                continue
+
+            terms = partial(self.chunk_terms, cap_l=l, start=start, epoch=epoch, part1=part1, centers=centers)
+            if self.chunk_size > 0 and torch.is_grad_enabled():
+                chunk_max, frag, clus = checkpoint(terms, img_emb, cap, use_reentrant=False)
+            else:
+                chunk_max, frag, clus = terms(img_emb, cap)
+            sims_max.append(chunk_max)
+            c_frag_loss += frag
+            c_cluster_loss += clus
 
-        c_glob_loss = self.c_glob(sims, cap_l, n_frag, batch_size, n_caption)
+        c_glob_loss = self.c_glob(torch.cat(sims_max, dim=1), cap_l, batch_size, n_caption)
         loss = c_glob_loss
 
         if cluster_loss:
-            c_frag_loss = self.c_frag(sims, cap_l, epoch, n_frag, batch_size, n_caption)
-            c_cluster = self.c_cluster(kmeans_features, kmeans_emb, sims, img_emb, cap_emb, cap_l, features)
-            loss += self.gamma * c_cluster + self.beta * c_frag_loss
+            loss += self.gamma * c_cluster_loss + self.beta * c_frag_loss
 
         return loss
 
+    def chunk_terms(self, img, cap, cap_l, start, epoch, part1, centers):
+        """
+        Fragment similarities of the captions cap (cap[0] is caption start of the batch) with all
+        images, reduced to
+        --> (max over the fragments (batch, n_cap, max_words), fragment loss, cluster loss)
+        """
+        # (batch, n_cap, n_frag, max_words)
+        sims = torch.einsum('bik,ljk->blij', img, cap)
+        chunk_max, _ = torch.max(sims, dim=2)
 
-    def c_glob(self, sims, cap_l, n_frag, batch_size, n_caption):
-        sims, _ = torch.max(sims, dim=2)
+        frag = self.c_frag(sims, cap_l, epoch, start)
+        clus = c_cluster(part1, centers, sims, cap)
+        return chunk_max, frag, clus
 
-        sims = sims.sum(dim=2)
+    def c_glob(self, sims_max, cap_l, batch_size, n_caption):
+        sims = sims_max.sum(dim=2)
 
         thres_image = get_thres(cap_l, self.n).unsqueeze(0).expand(batch_size, -1)
 
@@ -59,9 +98,10 @@ class LaenenLoss(nn.Module):
 
     def sim_val(self, img, cap, l):
         batch_size = img.size(0)
-        sims = torch.einsum('bik,ljk->blij', img, cap)
+        chunk_size = self.chunk_size if self.chunk_size > 0 else cap.size(0)
 
-        sims, _ = torch.max(sims, dim=2)
+        sims = torch.cat([max_frag(img, cap[start:start + chunk_size])
+                          for start in range(0, cap.size(0), chunk_size)], dim=1)
 
         sims = sims.sum(dim=2)
 
@@ -71,26 +111,24 @@ class LaenenLoss(nn.Module):
 
         return sims
 
-    def c_frag(self, sims, cap_l, epoch, n_frag, batch_size, n_caption):
-        loss = 0
+    def c_frag(self, sims, cap_l, epoch, start=0):
+        """
+        Fragment loss of the captions of sims (batch, n_cap, n_frag, max_words),
+        caption l of sims is caption start + l of the batch
+        """
+        n_word = torch.as_tensor(cap_l, device=sims.device).view(-1, 1)
+        words = torch.arange(sims.size(3), device=sims.device).unsqueeze(0)
+        mask = (words < n_word).to(sims.dtype).unsqueeze(0).unsqueeze(2)
 
-        for i in range(n_caption):
-            # Get the i-th text description
-            n_word = cap_l[i]
+        # first n epochs fix the constants y_ij
+        if epoch < self.switch:
+            y = init_y(sims, start)
+        # after let the model optimize y_ij with the heuristic sign
+        else:
+            y = sign(sims, start)
 
-            sims_i = sims[:,i,:,:n_word]
-
-            # first n epochs fix the constants y_ij
-            if epoch < self.switch:
-                y_i = init_y(sims_i, i)
-            # after let the model optimize y_ij with the heuristic sign
-            else:
-                y_i = sign(sims_i, i)
-
-            sims_i = 1 - (y_i * sims_i)
-            score = torch.sum(self.relu(sims_i))
-            loss += score
-        return loss
+        score = self.relu(1 - (y * sims)) * mask
+        return torch.sum(score)
 
 
     def sim_pair(self, img, cap, s_l):
@@ -126,103 +164,81 @@ def get_thres(l, n):
     return thres
 
 
-def sign(sims_i, i):
-    y = torch.sign(sims_i)
-    temp_y = y[i,:,:]
-
-    n_frag = sims_i.size(1)
-    n_word = sims_i.size(2)
+def max_frag(img, cap):
+    """
+    Max over the image fragments of the fragment similarities, without the 4-D
+    (batch, n_cap, n_frag, max_words) tensor being kept for the backward pass
+    --> (batch, n_cap, max_words)
+    """
+    batch_size, n_frag, dim = img.shape
+    n_cap, max_l = cap.size(0), cap.size(1)
+    sims = torch.matmul(img.reshape(-1, dim), cap.reshape(-1, dim).t())
+    sims, _ = torch.max(sims.view(batch_size, n_frag, n_cap, max_l), dim=1)
+    return sims
 
-    # check if at least one in every row has positive sign
-    temp_sum = temp_y.sum(dim=0)
 
-    sign_check = temp_sum > (n_frag * -1)
+def diag_index(sims, start):
+    """
+    (image, caption) indices into sims (batch, n_cap, ...) of the matching pairs,
+    caption l of sims is caption start + l of the batch
+    """
+    cap = torch.arange(sims.size(1), device=sims.device)
+    img = cap + start
+    keep = img < sims.size(0)
+    return img[keep], cap[keep]
 
-    if sign_check.sum() != n_word:
-        for j in range(len(sign_check)):
-            if sign_check[j] == False:
-                i_max = torch.argmax(sims_i[i,:,j])
-                temp_y[i_max, j] = 1
 
+def sign(sims, start=0):
+    """
+    y_ij = sign of the fragment similarities, for the matching pairs every word
+    keeps at least its most similar fragment positive
+    """
+    y = torch.sign(sims.detach())
+    img, cap = diag_index(sims, start)
+    n_frag = sims.size(2)
 
-    y[i,:,:] = temp_y
+    sims_diag = sims.detach()[img, cap]
+    y_diag = y[img, cap]
 
-    if torch.cuda.is_available():
-        y = y.cuda()
+    # words of which all fragments have a negative sign
+    all_neg = y_diag.sum(dim=1) <= (n_frag * -1)
+    i_max = torch.argmax(sims_diag, dim=1)
+    is_max = torch.arange(n_frag, device=sims.device).view(1, -1, 1) == i_max.unsqueeze(1)
 
+    y[img, cap] = torch.where(is_max & all_neg.unsqueeze(1), torch.ones_like(y_diag), y_diag)
     return y
 
 # init y matrix with ones when image and word fragment are from the same pair
-def init_y(sims_i, i):
-    y =  torch.ones(sims_i.shape, requires_grad=True) * -1
-    y[i, :, :] = 1
-
-    if torch.cuda.is_available():
-        y = y.cuda()
+def init_y(sims, start=0):
+    y = -torch.ones_like(sims)
+    img, cap = diag_index(sims, start)
+    y[img, cap] = 1
     return y
 
 
-def c_cluster(self, kmeans_features, kmeans_emb, sims, img_emb, cap_emb, cap_l, features):
-    batch_size = cap_emb.size(0)
-    max_l = cap_emb.size(1)
-    part1 = cluster1(features, kmeans_features)
-    part2 = cluster2(img_emb, kmeans_emb, sims, cap_emb)
-
-    part1 = part1.unsqueeze(1).expand(-1, batch_size, -1)
-    part1 = part1.unsqueeze(3).expand(-1, -1, -1,max_l )
+def c_cluster(part1, centers, sims, cap_emb):
+    """
+    Cluster loss of the captions cap_emb, sims (batch, n_cap, n_frag, max_words)
+    part1: (batch, n_frag) see cluster1, centers: nearest embedding centers of the fragments
+    """
+    part2 = cluster2(centers, sims, cap_emb)
 
-    loss = part1 * part2
+    loss = part1.unsqueeze(1).unsqueeze(3) * part2
     loss = torch.sum(loss)
 
     return loss
 
 def cluster1(features, kmeans_features):
-    dim = features.size(2)
-    batch_size = features.size(0)
-    n_frag = features.size(1)
-
-    # reshape for sklearn
-    im_norm = np.reshape(features, (-1, dim))
-
-    im_norm = preprocessing.normalize(im_norm)
-
-    # find labels of the clusters
-    center_labels = kmeans_features.predict(im_norm)
-
-    # retrieve nearest center vector
-    centers = kmeans_features.cluster_centers_[center_labels]
-
-    centers = np.reshape(centers, (batch_size, n_frag, dim ))
-    im_norm = np.reshape(im_norm, (batch_size, n_frag, dim ))
-
-    centers = torch.from_numpy(centers).float()
-    im_norm = torch.from_numpy(im_norm).float()
+    # normalized features and their nearest center vector (OnlineKMeans)
+    im_norm, centers = kmeans_features.nearest(features)
 
     cos = cosine_similarity(im_norm, centers, dim=2)
     loss1 = 1 - cos
     return loss1
 
 
-def cluster2(img_emb, kmeans_emb, sims, cap_emb):
-    batch_size = img_emb.size(0)
-    n_frag = img_emb.size(1)
-    dim_emb = img_emb.size(2)
-
-    # reshape for sklearn
-    im_norm = np.reshape(img_emb.detach().numpy(), (-1, dim_emb))
-
-    # bring to norm? > check if this is correct
-    im_norm = preprocessing.normalize(im_norm)
-
-    # find labels of the clusters
-    center_labels = kmeans_emb.predict(im_norm)
-
-    # retrieve nearest center vector
-    centers = kmeans_emb.cluster_centers_[center_labels]
-
-    centers = np.reshape(centers, (batch_size, n_frag, dim_emb ))
-    centers = torch.from_numpy(centers).float()
-
+def cluster2(centers, sims, cap_emb):
+    # similarity of the nearest center vectors (OnlineKMeans) with the words
     sims_center = torch.einsum('bik,ljk->blij', centers, cap_emb)
 
     loss2 = torch.abs(sims - sims_center)
@@ -22,6 +22,7 @@ import time
 from torch.autograd import Variable
 from torch.nn.utils.rnn import pad_sequence
 from model_laenen import SCAN
+from ranking import diag_ranks, recall_metrics
 
 class AverageMeter(object):
     """Computes and stores the average and current value"""
@@ -307,27 +308,26 @@ def shard_xattn_t2i(model, images, captions, caplens, opt, shard_size=128):
     """
 
     # takes a block and calculated the similarity, instead of entire d-matrix in one time
-    n_im_shard = (len(images)-1)/shard_size + 1
-    n_cap_shard = (len(captions)-1)/shard_size + 1
-
-    d = np.zeros((len(images), len(captions)))
-
-    for i in range(int(n_im_shard)):
-        im_start, im_end = shard_size*i, min(shard_size*(i+1), len(images))
-        for j in range(int(n_cap_shard)):
-            sys.stdout.write('\r>> shard_xattn_t2i batch (%d,%d)' % (i,j))
-            cap_start, cap_end = shard_size*j, min(shard_size*(j+1), len(captions))
-            if torch.cuda.is_available():
-                im = Variable(torch.from_numpy(images[im_start:im_end])).cuda()
-                s = Variable(torch.from_numpy(captions[cap_start:cap_end])).cuda()
-            else:
-                im = Variable(torch.from_numpy(images[im_start:im_end]))
-                s = Variable(torch.from_numpy(captions[cap_start:cap_end]))
-            l = caplens[cap_start:cap_end]
-            l = torch.FloatTensor(l)
-
-            sim = model.criterion.sim_val(im, s, l)
-            d[im_start:im_end, cap_start:cap_end] = sim.data.cpu().numpy()
+    n_im_shard = (len(images)-1)//shard_size + 1
+    n_cap_shard = (len(captions)-1)//shard_size + 1
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    d = np.zeros((len(images), len(captions)), dtype=np.float32)
+    l_all = torch.FloatTensor(np.asarray(caplens, dtype=np.float32))
+
+    with torch.no_grad():
+        for i in range(n_im_shard):
+            im_start, im_end = shard_size*i, min(shard_size*(i+1), len(images))
+            # the image shard is copied to the device once for all caption shards
+            im = torch.from_numpy(np.asarray(images[im_start:im_end])).float().to(device)
+            for j in range(n_cap_shard):
+                sys.stdout.write('\r>> shard_xattn_t2i batch (%d,%d)' % (i,j))
+                cap_start, cap_end = shard_size*j, min(shard_size*(j+1), len(captions))
+                s = torch.from_numpy(np.asarray(captions[cap_start:cap_end])).float().to(device)
+                l = l_all[cap_start:cap_end]
+
+                sim = model.criterion.sim_val(im, s, l)
+                d[im_start:im_end, cap_start:cap_end] = sim.cpu().numpy()
 
     sys.stdout.write('\n')
     return d
@@ -343,36 +343,14 @@ def i2t(images, captions, caplens, sims, npts=None, return_ranks=False):
     rank: what is the rank of the corresponding image/caption,
           when 0 the image-caption is matched, because rank is highest
     """
-    npts = images.shape[0]
-    ranks = np.zeros(npts)
-    top1 = np.zeros(npts)
-
-    for index in range(npts):
-
-        # sort the array and reverse the order to find most similar caption to image
-        inds = np.argsort(sims[index])[::-1]
-        # Score
-        rank = 1e20
-
-        # return indexes where inds == index
-        tmp = np.where(inds == index)
-        tmp = tmp[0][0]
-
-        if tmp < rank:
-            rank = tmp
-        ranks[index] = rank
-        top1[index] = inds[0]
-
-    # Compute metrics
-    r1 = 100.0 * len(np.where(ranks < 1)[0]) / len(ranks)
-    r5 = 100.0 * len(np.where(ranks < 5)[0]) / len(ranks)
-    r10 = 100.0 * len(np.where(ranks < 10)[0]) / len(ranks)
-    medr = np.floor(np.median(ranks)) + 1
-    meanr = ranks.mean() + 1
+    ranks, top1 = diag_ranks(sims)
+
+    # (r1, r5, r10, medr, meanr)
+    r = recall_metrics(ranks, ks=(1, 5, 10))
     if return_ranks:
-        return (r1, r5, r10, medr, meanr), (ranks, top1)
+        return r, (ranks, top1)
     else:
-        return (r1, r5, r10, medr, meanr)
+        return r
 
 
 def t2i(images, captions, caplens, sims, npts=None, return_ranks=False):
@@ -383,26 +361,11 @@ def t2i(images, captions, caplens, sims, npts=None, return_ranks=False):
     CapLens: (N) array of caption lengths
     sims: (N, N) matrix of similarity im-cap
     """
-    npts = images.shape[0]
-    ranks = np.zeros(npts)
-    top1 = np.zeros(npts)
-
     # --> (5N(caption), N(image))
-    sims = sims.T
-
-    for index in range(npts):
-
-        inds = np.argsort(sims[index])[::-1]
-        ranks[index] = np.where(inds == index)[0][0]
-        top1[index] = inds[0]
+    ranks, top1 = diag_ranks(sims.T)
 
-    # Compute metrics
-    r1 = 100.0 * len(np.where(ranks < 1)[0]) / len(ranks)
-    r5 = 100.0 * len(np.where(ranks < 5)[0]) / len(ranks)
-    r10 = 100.0 * len(np.where(ranks < 10)[0]) / len(ranks)
-    medr = np.floor(np.median(ranks)) + 1
-    meanr = ranks.mean() + 1
+    r = recall_metrics(ranks, ks=(1, 5, 10))
     if return_ranks:
-        return (r1, r5, r10, medr, meanr), (ranks, top1)
+        return r, (ranks, top1)
     else:
-        return (r1, r5, r10, medr, meanr)
+        return r
@@ -82,6 +82,11 @@ if __name__ == '__main__':
                         help='number of clusters for kmeans')
     parser.add_argument('--cluster_loss', action='store_true',
                         help='use of third loss component: image cluster loss')
+    parser.add_argument('--cluster_refresh', default=500, type=int,
+                        help='full refit of the embedding centers every n steps, 0 only once per epoch')
+    parser.add_argument('--loss_chunk', default=32, type=int,
+                        help='captions scored at once in the loss, bounds the memory of large batches. '
+                             '0 is unchunked, the full similarity matmul of the batch')
 
 
 
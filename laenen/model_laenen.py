@@ -157,7 +157,8 @@ class SCAN(object):
             cudnn.benchmark = True
             cudnn.enabled = True
 
-        self.criterion = LaenenLoss(opt.margin, opt.n, opt.switch, opt.beta, opt.gamma)
+        self.criterion = LaenenLoss(opt.margin, opt.n, opt.switch, opt.beta, opt.gamma,
+                                    getattr(opt, "loss_chunk", 32))
 
         params = list(self.txt_enc.parameters())
         params += list(self.img_enc.parameters())
@@ -216,10 +217,10 @@ class SCAN(object):
         cap_emb, cap_lens = self.txt_enc(captions, lengths)
         return cap_emb, cap_lens
 
-    def forward_loss(self,epoch,img_emb, cap_emb, cap_l, kmeans_features, kmeans_emb, cluster_loss):
+    def forward_loss(self,epoch,img_emb, cap_emb, cap_l, kmeans_features, kmeans_emb, cluster_loss, features=None):
         """Compute the loss given pairs of image and caption embeddings
         """
-        loss = self.criterion( epoch, img_emb, cap_emb, cap_l, kmeans_features, kmeans_emb, cluster_loss)
+        loss = self.criterion( epoch, img_emb, cap_emb, cap_l, kmeans_features, kmeans_emb, cluster_loss, features)
         self.logger.update('Le', loss.item(), img_emb.size(0))
         return loss
 
@@ -251,9 +252,12 @@ class SCAN(object):
         # measure accuracy and record loss
         self.optimizer.zero_grad()
         loss = self.forward_loss(epoch,img_emb, cap_emb, l, kmeans_features,
-                                kmeans_emb, cluster_loss)
+                                kmeans_emb, cluster_loss, images)
 
         # compute gradient and do SGD step
         loss.backward()
 
         self.optimizer.step()
+
+        # used to update the online cluster centers
+        return img_emb.detach()
@@ -0,0 +1,81 @@
+import numpy as np
+import torch
+from sklearn import preprocessing
+from sklearn.cluster import MiniBatchKMeans
+
+"""
+K-means centers in the (l2 normalized) embedding space that are updated incrementally
+with every training batch, instead of re-encoding the training set and refitting
+sklearn MiniBatchKMeans each step. The nearest center lookup is a batched torch op.
+"""
+
+class OnlineKMeans(object):
+    def __init__(self, n_clusters, chunk_size=4096):
+        self.n_clusters = n_clusters
+        self.chunk_size = chunk_size
+        self.centers = None
+        self.counts = None
+
+    def refresh(self, emb):
+        """
+        Full refit of the centers on all embeddings (n, n_frag, dim) or (n, dim)
+        """
+        emb = np.asarray(emb)
+        dim = emb.shape[-1]
+        im_norm = preprocessing.normalize(np.reshape(emb, (-1, dim)))
+        kmeans = MiniBatchKMeans(n_clusters=self.n_clusters, random_state=0, batch_size=128).fit(im_norm)
+
+        device = self.centers.device if self.centers is not None else torch.device("cpu")
+        self.centers = torch.from_numpy(kmeans.cluster_centers_).float().to(device)
+        self.counts = torch.from_numpy(np.bincount(kmeans.labels_, minlength=self.n_clusters)).float().to(device)
+        return self
+
+    def to(self, device):
+        self.centers = self.centers.to(device)
+        self.counts = self.counts.to(device)
+        return self
+
+    def normalize(self, x):
+        x = torch.as_tensor(x).float().to(self.centers.device)
+        x = x.reshape(-1, x.size(-1))
+        return x / x.norm(dim=1, keepdim=True).clamp(min=1e-12)
+
+    def predict(self, x):
+        """
+        Index of the nearest center of every row of the normalized x (n, dim)
+        """
+        c_norm = (self.centers ** 2).sum(dim=1)
+        labels = []
+        for start in range(0, x.size(0), self.chunk_size):
+            # argmin |x - c|^2 = argmax 2<x, c> - |c|^2
+            dist = 2 * x[start:start + self.chunk_size] @ self.centers.t() - c_norm
+            labels.append(dist.argmax(dim=1))
+        return torch.cat(labels)
+
+    def nearest(self, x):
+        """
+        Normalized x and its nearest center, both with the shape of x
+        """
+        shape = x.shape
+        x = self.normalize(x)
+        centers = self.centers[self.predict(x)]
+        return x.view(shape), centers.view(shape)
+
+    def partial_fit(self, x):
+        """
+        Mini-batch k-means update (Sculley, 2010) of the centers with the embeddings of one batch
+        """
+        with torch.no_grad():
+            x = self.normalize(x.detach())
+            labels = self.predict(x)
+
+            batch_counts = torch.bincount(labels, minlength=self.n_clusters).float()
+            batch_sums = torch.zeros_like(self.centers).index_add_(0, labels, x)
+
+            self.counts += batch_counts
+            # every center moves to the running mean of its assigned points
+            seen = batch_counts > 0
+            lr = (batch_counts[seen] / self.counts[seen]).unsqueeze(1)
+            batch_mean = batch_sums[seen] / batch_counts[seen].unsqueeze(1)
+            self.centers[seen] += lr * (batch_mean - self.centers[seen])
+        return self
@@ -29,9 +29,8 @@ import logging
 import tb as tb_logger
 import numpy as np
 import random
-from sklearn.cluster import MiniBatchKMeans
-from sklearn import preprocessing
 from evaluation import encode_data, retrieve_features
+from online_kmeans import OnlineKMeans
 
 def start_experiment(opt, seed):
     torch.manual_seed(seed)
@@ -120,16 +119,24 @@ def train(opt, model, epoch, train_loader, val_loader):
 
     if opt.cluster_loss:
         features = retrieve_features(train_loader)
-        kmeans_features = get_centers(features, opt.n_clusters)
+        kmeans_features = OnlineKMeans(opt.n_clusters).refresh(features)
+        kmeans_emb = OnlineKMeans(opt.n_clusters)
+        if torch.cuda.is_available():
+            kmeans_features.to(torch.device("cuda"))
 
     # https://stats.stackexchange.com/questions/299013/cosine-distance-as-similarity-measure-in-kmeans
     # normalizing and euclidian distance is linear correlated with cosine distance
 
     for j, (images, targets, lengths, ids) in enumerate(train_loader):
 
-        if opt.cluster_loss:
+        # full refit of the embedding centers at the start of the epoch and every cluster_refresh steps,
+        # in between they are updated with the embeddings of every batch
+        cluster_refresh = getattr(opt, "cluster_refresh", 500)
+        if opt.cluster_loss and (j == 0 or (cluster_refresh > 0 and j % cluster_refresh == 0)):
             img_embs, _ , _ = encode_data(model, train_loader)
-            kmeans_emb = get_centers(img_embs, opt.n_clusters)
+            kmeans_emb.refresh(img_embs)
+            if torch.cuda.is_available():
+                kmeans_emb.to(torch.device("cuda"))
 
         # switch to train mode
         model.train_start()
@@ -145,7 +152,9 @@ def train(opt, model, epoch, train_loader, val_loader):
         model.logger = train_logger
 
         # Update the model
-        model.train_emb(epoch, images, targets, lengths, ids, opt.cluster_loss, kmeans_features, kmeans_emb)
+        img_emb = model.train_emb(epoch, images, targets, lengths, ids, opt.cluster_loss, kmeans_features, kmeans_emb)
+        if opt.cluster_loss:
+            kmeans_emb.partial_fit(img_emb)
 
         # measure elapsed time
         batch_time.update(time.time() - end)
@@ -254,13 +263,3 @@ def accuracy(output, target, topk=(1,)):
         correct_k = correct[:k].view(-1).float().sum(0)
         res.append(correct_k.mul_(100.0 / batch_size))
     return res
-
-def get_centers(emb, n_clusters):
-    """
-    Run kmeans to retrieve the clusters
-    """
-    dim = emb.shape[2]
-    img_embs = np.reshape(emb, (-1,dim))
-    im_norm = preprocessing.normalize(img_embs)
-    kmeans = MiniBatchKMeans(n_clusters=n_clusters,random_state=0,batch_size=128).fit(im_norm)
-    return kmeans
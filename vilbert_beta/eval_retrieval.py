@@ -22,6 +22,9 @@ from vilbert.vilbert import VILBertForVLTasks, BertForMultiModalPreTraining
 from vilbert.basebert import BaseBertForVLTasks
 
 import vilbert.utils as utils
+from vilbert.ranking import recall_metrics
+from vilbert.catalog_eval import evaluate_catalog
+from vilbert.two_stage import two_stage_ranks
 import torch.distributed as dist
 
 logging.basicConfig(
@@ -101,6 +104,9 @@ def main():
     parser.add_argument(
         "--in_memory", default=False, type=bool, help="whether use chunck for parallel training."
     )
+    parser.add_argument(
+        "--feature_cache_size", default=10000, type=int, help="number of images kept in memory by the feature readers with --in_memory."
+    )
     parser.add_argument(
         "--baseline", action="store_true", help="whether use single stream baseline."
     )
@@ -113,6 +119,24 @@ def main():
     parser.add_argument(
         "--batch_size", default=1, type=int, help="which split to use."
     )
+    parser.add_argument(
+        "--image_block", default=500, type=int, help="images moved to the device and scored at once."
+    )
+    parser.add_argument(
+        "--caption_block", default=1, type=int, help="captions scored against an image block per forward pass."
+    )
+    parser.add_argument(
+        "--top_k", default=20, type=int, help="number of best images kept per caption."
+    )
+    parser.add_argument(
+        "--score_matrix", action="store_true", help="also write all scores to a memory-mapped scores.npy."
+    )
+    parser.add_argument(
+        "--pooled_file", default="", type=str, help="dual encoder embeddings (.npz) to shortlist the images, see vilbert/two_stage.py."
+    )
+    parser.add_argument(
+        "--shortlist_k", default=100, type=int, help="images per caption re-ranked by ViLBERT with --pooled_file."
+    )
     args = parser.parse_args()
     with open('vlbert_tasks.yml', 'r') as f:
         task_cfg = edict(yaml.safe_load(f))
@@ -172,8 +196,9 @@ def main():
     if default_gpu and not os.path.exists(savePath):
         os.makedirs(savePath)
 
-    task_batch_size, task_num_iters, task_ids, task_datasets_val, task_dataloader_val \
-                        = LoadDatasetEval(args, task_cfg, args.tasks.split('-'))
+    # the catalog is scored block by block from the feature reader, without a DataLoader
+    task_batch_size, task_num_iters, task_ids, task_datasets_val, _ \
+                        = LoadDatasetEval(args, task_cfg, args.tasks.split('-'), dataloader=False)
 
     num_labels = max([dataset.num_labels for dataset in task_datasets_val.values()])
 
@@ -201,75 +226,48 @@ def main():
 
     no_decay = ["bias", "LayerNorm.bias", "LayerNorm.weight"]
 
-    print("  Num Iters: ", task_num_iters)
-    print("  Batch size: ", task_batch_size)
-
     model.eval()
+
+    def score_fn(question, input_mask, segment_ids, features, spatials, image_mask):
+        """ViLBERT score of aligned (caption, image) pairs"""
+        if args.zero_shot:
+            _, _, vil_logit, _ = model(question, features, spatials, segment_ids, input_mask, image_mask)
+            return torch.softmax(vil_logit, dim=1)[:,0].view(-1)
+        _, vil_logit, _, _, _, _, _ = model(question, features, spatials, segment_ids, input_mask, image_mask)
+        return vil_logit.view(-1)
+
     # when run evaluate, we run each task sequentially.
     for task_id in task_ids:
-        results = []
         others = []
 
-        score_matrix = np.zeros((1000, 1000))
-        target_matrix = np.zeros((1000, 1000))
-        rank_matrix = np.ones((1000)) * 1000
-        count = 0
-
-        for i, batch in enumerate(task_dataloader_val[task_id]):
-            if torch.cuda.is_available():
-                batch = tuple(t.cuda(device=device, non_blocking=True) for t in batch)
-            features, spatials, image_mask, question, input_mask, segment_ids, target, caption_idx, image_idx = batch
-
-            if task_id in ['TASK3']:
-                batch_size = features.size(0)
-                features = features.squeeze(0)
-                spatials = spatials.squeeze(0)
-                image_mask = image_mask.squeeze(0)
-
-            with torch.no_grad():
-                if args.zero_shot:
-                    _, _, vil_logit, _ = model(question, features, spatials, segment_ids, input_mask, image_mask)
-
-                    score_matrix[caption_idx, image_idx*500:(image_idx+1)*500] = torch.softmax(vil_logit, dim=1)[:,0].view(-1).cpu().numpy()
-                    target_matrix[caption_idx, image_idx*500:(image_idx+1)*500] = target.view(-1).float().cpu().numpy()
-
-                else:
-                    _, vil_logit, _, _, _, _, _ = model(question, features, spatials, segment_ids, input_mask, image_mask)
-                    score_matrix[caption_idx, image_idx*500:(image_idx+1)*500] = vil_logit.view(-1).cpu().numpy()
-                    target_matrix[caption_idx, image_idx*500:(image_idx+1)*500] = target.view(-1).float().cpu().numpy()
-
-                if image_idx.item() == 1:
-                    rank = np.where((np.argsort(-score_matrix[caption_idx]) == np.where(target_matrix[caption_idx]==1)[0][0]) == 1)[0][0]
-                    rank_matrix[caption_idx] = rank
-
-                    rank_matrix_tmp = rank_matrix[:caption_idx+1]
-                    r1 = 100.0 * np.sum(rank_matrix_tmp < 1) / len(rank_matrix_tmp)
-                    r5 = 100.0 * np.sum(rank_matrix_tmp < 5) / len(rank_matrix_tmp)
-                    r10 = 100.0 * np.sum(rank_matrix_tmp < 10) / len(rank_matrix_tmp)
-
-                    medr = np.floor(np.median(rank_matrix_tmp) + 1)
-                    meanr = np.mean(rank_matrix_tmp) + 1
-                    print("%d Final r1:%.3f, r5:%.3f, r10:%.3f, mder:%.3f, meanr:%.3f" %(count, r1, r5, r10, medr, meanr))
-
-                    results.append(np.argsort(-score_matrix[caption_idx]).tolist()[:20])
-            count += 1
-
+        if args.split:
+            json_path = os.path.join(savePath, args.split)
+        else:
+            json_path = os.path.join(savePath, task_cfg[task_id]['val_split'])
 
-        r1 = 100.0 * np.sum(rank_matrix < 1) / len(rank_matrix)
-        r5 = 100.0 * np.sum(rank_matrix < 5) / len(rank_matrix)
-        r10 = 100.0 * np.sum(rank_matrix < 10) / len(rank_matrix)
+        if args.pooled_file:
+            # ViLBERT only re-ranks the shortlist of a dual encoder
+            ranks_first, ranks, top, timings = two_stage_ranks(score_fn, task_datasets_val[task_id], args.pooled_file,
+                                                               device, k=args.shortlist_k, caption_block=args.caption_block)
+            r1, r5, r10, medr, meanr = recall_metrics(ranks_first, ks=(1, 5, 10))
+            print("First stage r1:%.3f, r5:%.3f, r10:%.3f, mder:%.3f, meanr:%.3f" %(r1, r5, r10, medr, meanr))
+            # the cost of all pairs is extrapolated from the re-ranking time, not measured
+            print("First stage %.1fs, re-ranking %.1fs, all pairs (estimate) %.1fs, estimated speedup %.1fx" %(
+                timings["first_stage"], timings["second_stage"], timings["full_estimate"], timings["speedup_estimate"]))
+        else:
+            # all captions against the whole catalog, resumes from json_path_catalog when interrupted
+            ranks, top = evaluate_catalog(score_fn, task_datasets_val[task_id], device, json_path + '_catalog',
+                                          image_block=args.image_block, caption_block=args.caption_block,
+                                          k=args.top_k, keep_scores=args.score_matrix)
+        results = top[:, :20].tolist()
 
-        medr = np.floor(    np.median(rank_matrix) + 1)
-        meanr = np.mean(rank_matrix) + 1
+        # captions without an image in the catalog (rank NO_GT_RANK) are left out
+        r1, r5, r10, medr, meanr = recall_metrics(ranks, ks=(1, 5, 10))
 
         print("************************************************")
         print("Final r1:%.3f, r5:%.3f, r10:%.3f, mder:%.3f, meanr:%.3f" %(r1, r5, r10, medr, meanr))
         print("************************************************")
 
-        if args.split:
-            json_path = os.path.join(savePath, args.split)
-        else:
-            json_path = os.path.join(savePath, task_cfg[task_id]['val_split'])
         json.dump(results, open(json_path+ '_result.json', 'w'))
         json.dump(others, open(json_path+ '_others.json', 'w'))
 
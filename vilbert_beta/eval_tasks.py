@@ -104,6 +104,9 @@ def main():
     parser.add_argument(
         "--in_memory", default=False, type=bool, help="whether use chunck for parallel training."
     )
+    parser.add_argument(
+        "--feature_cache_size", default=10000, type=int, help="number of images kept in memory by the feature readers with --in_memory."
+    )
     parser.add_argument(
         "--baseline", action="store_true", help="whether use single stream baseline."
     )
@@ -18,6 +18,12 @@ import torch.nn as nn
 import torch
 import _pickle as cPickle
 
+# the record layout lives with the reader, imported without the dependencies of the vilbert package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vilbert', 'datasets'))
+from _image_features_reader import encode_padded_record
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from vilbert.hard_negative import mine_hard_pool, write_hard_pool
+
 csv.field_size_limit(sys.maxsize)
 
 def main(args):
@@ -28,7 +34,6 @@ def main(args):
     data_path_out = args.data_path_out
     nr_test = args.nr_test
     n_hard = args.n_hard
-    n_negative = args.n_negative
 
     print("Start loading features")
     # read features
@@ -41,14 +46,14 @@ def main(args):
     print("Finished reading captions")
 
     print("Start saving lmdb")
-    save_lmdb(data_path_out, captions, features)
+    save_lmdb(data_path_out, captions, features, args.record_format, args.max_region_num, args.fp16)
     print("Finisged saving lmdb")
 
     print("Start splitting data")
     train_ids = split_data(data_path_out, captions, nr_test, version)
     print("Finished splitting data")
 
-    create_hard_negative(train_ids, features, data_path_out, img2id, n_hard, n_negative)
+    create_hard_negative(train_ids, features, data_path_out, img2id, n_hard)
     print("finished creating hard negatives")
 
 def split_data(data_path_out, captions, nr_test, version):
@@ -71,53 +76,18 @@ def write_jsonline(captions, indx, split, version, data_path_out):
             image_ids.append(int(captions[indx[i]][0]))
     return image_ids
 
-def create_hard_negative(train_ids, features, data_path_out, img2id, n_hard, n_negative):
-    # only take the features used in train set
-    features_train = np.stack([features[img2id[id]] for id in train_ids], axis=0)
-
-    # take only the last full image
-    features_train = torch.from_numpy(features_train[:, 6, :])
-
-    hard_negative = []
-
-    # select number of features to find hardest negative
-    n_features = n_negative
-
-    n_max = features_train.shape[0]
-    # check n_features en train_ids
-    if len(train_ids) != n_max:
-        print("not equal")
-        exit()
-
-    cos = nn.CosineSimilarity(dim=1)
+def create_hard_negative(train_ids, features, data_path_out, img2id, n_hard):
+    # only take the features used in train set, the last full image
+    features_train = np.stack([features[img2id[id]][6] for id in train_ids], axis=0)
 
-    for i in range (len(train_ids)):
-        # take full image
-        feature = features_train[i]
+    # exact nearest neighbours over the whole train set, the pool of every image starts with itself
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    negative_pool = mine_hard_pool(features_train, n_hard, device)
 
-        # remove current image from list
-        ids = list(range(0,n_max))
-        ids.remove(i)
-        random_ids = random.sample(ids,n_features)
+    # save pickle {"train_hard_pool" : numpy(29000,n_hard+1), "train_image_id_list": list(29000) }
+    write_hard_pool('{}/hard_negative.pkl'.format(data_path_out), negative_pool, train_ids)
 
-        features_random = torch.stack([features_train[id] for id in random_ids], axis=0)
-        feature_expand = feature.expand((n_features, -1))
-        sims = cos(feature_expand, features_random)
-
-        results = torch.topk(sims, n_hard)[1].tolist()
-        final_results = [random_ids[r] for r in results ]
-
-        hard_negative.append(final_results)
-        if i % 100 == 0:
-            print(i)
-
-    negative_pool = np.stack(hard_negative)
-    hard_negative = {"train_hard_pool": negative_pool, "train_image_list": train_ids}
-
-    # save pickle {"train_hard_pool" : numpy(29000,100), "train_image_id_list": list(29000) }
-    pickle.dump(hard_negative, open('{}/hard_negative.pkl'.format(data_path_out), 'wb'))
-
-def save_lmdb(data_path_out, captions, features):
+def save_lmdb(data_path_out, captions, features, record_format="pickle", max_region_num=8, fp16=False):
     id_list = []
     save_path = os.path.join(data_path_out, 'Gen.lmdb')
 
@@ -137,6 +107,15 @@ def save_lmdb(data_path_out, captions, features):
 
             # feature = np.float16(features[i])
             feature = features[i]
+            if record_format == "padded":
+                # global feature and normalized spatials precomputed, see ImageFeaturesH5Reader
+                dtype = np.float16 if fp16 else np.float32
+                txn.put(img_id, encode_padded_record(H, W, feature, bboxes, max_region_num, dtype))
+                if count % 1000 == 0:
+                    print(count)
+                count += 1
+                continue
+
             item = {
                 "image_id": int(img_id),
                 "image_h": int(256),
@@ -175,7 +154,10 @@ if __name__ == '__main__':
     parser.add_argument('--clothing', default="dresses", type=str, help='clothing item')
     parser.add_argument('--nr_test', default=3, type=int, help='size of test set')
     parser.add_argument('--n_hard', default=4, type=int, help='size of test set')
-    parser.add_argument('--n_negative', default=10, type=int, help='size of n negative')
+    parser.add_argument('--record_format', default="pickle", choices=["pickle", "padded"],
+                        help='pickled dicts or padded binary records with precomputed spatials')
+    parser.add_argument('--max_region_num', default=8, type=int, help='regions per padded record, including the global one')
+    parser.add_argument('--fp16', action='store_true', help='store the features of padded records in float16')
 
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,61 @@
+import os
+import sys
+import pickle
+import argparse
+import numpy as np
+import lmdb # install lmdb by "pip install lmdb"
+
+# the record layout lives with the reader, imported without the dependencies of the vilbert package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'vilbert', 'datasets'))
+from _image_features_reader import (decode_record, decode_pickle_record, encode_padded_record,
+                                    record_version, RECORD_VERSION)
+
+"""
+Rewrites a feature LMDB of one of the convert_lmdb_*.py scripts (pickled dicts with base64 strings)
+into padded binary records: the global feature is prepended, the normalized spatials are precomputed
+and every record is padded to max_region_num regions, so ImageFeaturesH5Reader only copies them.
+"""
+
+def main(args):
+    dtype = np.float16 if args.fp16 else np.float32
+
+    env_in = lmdb.open(args.lmdb_in, readonly=True, lock=False, readahead=False, meminit=False)
+    env_out = lmdb.open(args.lmdb_out, map_size=1099511627776)
+
+    with env_in.begin(write=False, buffers=True) as txn_in:
+        keys = bytes(txn_in.get('keys'.encode()))
+        image_ids = pickle.loads(keys)
+
+        txn_out = env_out.begin(write=True)
+        for count, image_id in enumerate(image_ids):
+            buf = txn_in.get(image_id)
+            if record_version(buf) == RECORD_VERSION:
+                image_h, image_w, features, boxes = decode_record(buf)
+            else:
+                image_h, image_w, features, boxes = decode_pickle_record(buf)
+
+            txn_out.put(image_id, encode_padded_record(image_h, image_w, features, boxes, args.max_region_num, dtype))
+            if count % 1000 == 0:
+                # commit in parts, a single transaction would hold the whole LMDB in memory
+                txn_out.commit()
+                txn_out = env_out.begin(write=True)
+                print(count)
+
+        txn_out.put('keys'.encode(), keys)
+        txn_out.commit()
+
+    env_out.sync()
+    print("converted {} images to {}".format(len(image_ids), args.lmdb_out))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lmdb_in', required=True, help='feature lmdb to convert.')
+    parser.add_argument('--lmdb_out', required=True, help='path of the converted lmdb.')
+    parser.add_argument('--max_region_num', default=37, type=int,
+                        help='regions stored per image including the global feature, as max_region_num of the task.')
+    parser.add_argument('--fp16', action='store_true', help='store the features in float16.')
+
+    args = parser.parse_args()
+    main(args)
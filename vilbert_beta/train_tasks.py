@@ -23,6 +23,7 @@ from pytorch_pretrained_bert.optimization import WarmupLinearSchedule
 # from parallel.parallel import DataParallelModel, DataParallelCriterion
 
 from vilbert.task_utils import LoadDatasets, LoadLosses, ForwardModelsTrain, ForwardModelsVal
+from vilbert.hard_negative import refresh_hard_pool
 from vilbert.optimization import BertAdam, Adam, Adamax
 from torch.optim.lr_scheduler import LambdaLR, ReduceLROnPlateau
 
@@ -128,6 +129,9 @@ def main():
     parser.add_argument(
         "--in_memory", default=False, type=bool, help="whether use chunck for parallel training."
     )
+    parser.add_argument(
+        "--feature_cache_size", default=10000, type=int, help="number of images kept in memory by the feature readers with --in_memory."
+    )
     parser.add_argument(
         "--optimizer", default='BertAdam', type=str, help="whether use chunck for parallel training."
     )
@@ -153,6 +157,10 @@ def main():
     parser.add_argument(
         "--compact", action="store_true", help="whether use compact vilbert model."
     )
+    parser.add_argument(
+        "--hard_negative_refresh", default=0, type=int,
+        help="mine the hard negative pools of the retrieval task with the current model every n epochs, 0 never."
+    )
     args = parser.parse_args()
     with open('vlbert_tasks.yml', 'r') as f:
         task_cfg = edict(yaml.load(f))
@@ -411,6 +419,19 @@ def main():
 
         ave_score = tbLogger.showLossVal()
 
+        if args.hard_negative_refresh > 0 and (epochId + 1) % args.hard_negative_refresh == 0:
+            # new pools are picked up by the workers of the next epoch
+            for task_id in task_ids:
+                dataset = task_datasets_train[task_id]
+                if not hasattr(dataset, "load_hard_pool"):
+                    continue
+                if default_gpu:
+                    logger.info("Refreshing the hard negative pools of %s" % task_id)
+                    refresh_hard_pool(model, dataset, device)
+                if args.local_rank != -1:
+                    dist.barrier()
+                    dataset.load_hard_pool()
+
         if args.lr_scheduler == 'automatic':
             lr_scheduler.step(ave_score)
             logger.info("best average score is %3f" %lr_scheduler.best)
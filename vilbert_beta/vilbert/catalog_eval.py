@@ -0,0 +1,196 @@
+"""Retrieval evaluation of a cross-encoder over the full image catalog"""
+
+import os
+import json
+import numpy as np
+import torch
+
+from vilbert.ranking import NO_GT_RANK
+
+"""
+Every caption is scored against every image, image block by image block: the features of a block
+are read from the feature reader of the dataset and moved to the device once and scored against caption_block captions per forward pass. The ranks
+are counted against the score of the ground truth pair, which is computed first, and the top k of
+every caption is merged block by block, so the (n_captions, n_images) scores are never held in memory.
+Optionally they are written to a memory-mapped scores.npy.
+
+The state is kept in eval_dir. The results of an image block are computed in memory and committed at
+once: the new totals are first written to pending arrays, then copied over the state and the block is
+marked done. A run that is interrupted re-applies a pending block that was not marked and continues with
+the first block that was not finished, so no block is counted twice.
+
+Captions without an image in the catalog (target -1) are not scored, their rank is NO_GT_RANK.
+"""
+
+
+class CatalogEval(object):
+    """Memory-mapped state of the evaluation in eval_dir"""
+
+    def __init__(self, eval_dir, n_captions, n_images, image_block, k=20, keep_scores=False):
+        self.eval_dir = eval_dir
+        self.n_blocks = (n_images - 1) // image_block + 1
+        meta = {"n_captions": n_captions, "n_images": n_images, "image_block": image_block,
+                "k": k, "keep_scores": keep_scores}
+
+        meta_file = os.path.join(eval_dir, "meta.json")
+        resume = False
+        if os.path.exists(meta_file):
+            with open(meta_file, 'r') as f:
+                resume = json.load(f) == meta
+        if not os.path.exists(eval_dir):
+            os.makedirs(eval_dir)
+
+        mode = 'r+' if resume else 'w+'
+        self.gold = self._open("gold", mode, np.float32, (n_captions,))
+        self.greater = self._open("greater", mode, np.int64, (n_captions,))
+        self.top_scores = self._open("top_scores", mode, np.float32, (n_captions, k))
+        self.top_idx = self._open("top_idx", mode, np.int64, (n_captions, k))
+        self.done = self._open("done", mode, np.bool_, (self.n_blocks + 1,))
+        self.scores = self._open("scores", mode, np.float32, (n_captions, n_images)) if keep_scores else None
+
+        # totals of the block being committed
+        self.pending_block = self._open("pending_block", mode, np.int64, (1,))
+        self.pending_greater = self._open("pending_greater", mode, np.int64, (n_captions,))
+        self.pending_top_scores = self._open("pending_top_scores", mode, np.float32, (n_captions, k))
+        self.pending_top_idx = self._open("pending_top_idx", mode, np.int64, (n_captions, k))
+
+        if not resume:
+            self.top_scores[:] = -np.inf
+            self.top_idx[:] = -1
+            self.pending_block[0] = -1
+            self.flush()
+            self.pending_block.flush()
+            with open(meta_file, 'w') as f:
+                json.dump(meta, f)
+
+    def _open(self, name, mode, dtype, shape):
+        return np.lib.format.open_memmap(os.path.join(self.eval_dir, name + ".npy"), mode=mode, dtype=dtype, shape=shape)
+
+    @property
+    def gold_done(self):
+        return bool(self.done[0])
+
+    def block_done(self, block):
+        return bool(self.done[block + 1])
+
+    def flush(self):
+        for array in [self.gold, self.greater, self.top_scores, self.top_idx, self.scores]:
+            if array is not None:
+                array.flush()
+
+    def mark_done(self, block=None):
+        # the results are on disk before the block is marked
+        self.flush()
+        self.done[0 if block is None else block + 1] = True
+        self.done.flush()
+
+    def commit(self, block, greater, top_scores, top_idx):
+        """
+        New totals of the state after block, written to the pending arrays before they are applied,
+        so a commit that is interrupted can be applied again
+        """
+        self.pending_greater[:] = greater
+        self.pending_top_scores[:] = top_scores
+        self.pending_top_idx[:] = top_idx
+        for array in [self.pending_greater, self.pending_top_scores, self.pending_top_idx]:
+            array.flush()
+        self.pending_block[0] = block
+        self.pending_block.flush()
+        self.apply_pending()
+
+    def apply_pending(self):
+        """Copy the pending totals over the state and mark their block, when it is not done yet"""
+        block = int(self.pending_block[0])
+        if block < 0 or self.block_done(block):
+            return
+        self.greater[:] = self.pending_greater
+        self.top_scores[:] = self.pending_top_scores
+        self.top_idx[:] = self.pending_top_idx
+        self.mark_done(block)
+
+    def ranks(self, valid):
+        return np.where(valid, np.asarray(self.greater), NO_GT_RANK)
+
+
+def grid_scores(score_fn, question, input_mask, segment_ids, features, spatials, image_mask):
+    """
+    Scores of every caption (n_cap, ...) with every image (n_img, ...) in one forward pass
+    score_fn: scores of aligned (caption, image) pairs
+    --> (n_cap, n_img)
+    """
+    n_cap, n_img = question.size(0), features.size(0)
+    scores = score_fn(question.repeat_interleave(n_img, dim=0), input_mask.repeat_interleave(n_img, dim=0),
+                      segment_ids.repeat_interleave(n_img, dim=0), features.repeat(n_cap, 1, 1),
+                      spatials.repeat(n_cap, 1, 1), image_mask.repeat(n_cap, 1))
+    return scores.view(n_cap, n_img)
+
+
+def evaluate_catalog(score_fn, dataset, device, eval_dir, image_block=500, caption_block=1, k=20,
+                     keep_scores=False, log_step=10):
+    """
+    Rank of the ground truth image of every caption of the dataset (RetreivalDatasetVal)
+    score_fn: scores of aligned (caption, image) pairs, (n,) tensor
+    --> (ranks (n_captions), top k image indices (n_captions, k)), rank NO_GT_RANK for captions without catalog image
+    """
+    question, input_mask, segment_ids = [t.to(device) for t in dataset.captions()]
+    targets = torch.from_numpy(dataset.caption_targets)
+    n_captions, n_images = question.size(0), dataset.num_images()
+    k = min(k, n_images)
+
+    valid = dataset.caption_targets >= 0
+    valid_index = torch.from_numpy(np.nonzero(valid)[0])
+
+    state = CatalogEval(eval_dir, n_captions, n_images, image_block, k, keep_scores)
+    # a block of which the commit was interrupted
+    state.apply_pending()
+    image_tensors = lambda index: [t.to(device, non_blocking=True) for t in dataset.images(index)]
+
+    with torch.no_grad():
+        # score of the ground truth pair of every caption
+        if not state.gold_done:
+            pair_batch = image_block * caption_block
+            for start in range(0, len(valid_index), pair_batch):
+                index = valid_index[start:start + pair_batch]
+                gold = score_fn(question[index.to(device)], input_mask[index.to(device)], segment_ids[index.to(device)],
+                                *image_tensors(targets[index]))
+                state.gold[index.numpy()] = gold.float().cpu().numpy()
+            state.mark_done()
+        gold = torch.from_numpy(np.array(state.gold)).to(device)
+
+        for block in range(state.n_blocks):
+            if state.block_done(block):
+                continue
+            img_start = block * image_block
+            img_end = min(img_start + image_block, n_images)
+            features, spatials, image_mask = image_tensors(range(img_start, img_end))
+            img_index = torch.arange(img_start, img_end, device=device)
+
+            # the totals after this block, committed at its end
+            block_greater = np.array(state.greater)
+            block_top_scores = np.array(state.top_scores)
+            block_top_idx = np.array(state.top_idx)
+
+            for start in range(0, n_captions, caption_block):
+                end = min(start + caption_block, n_captions)
+                scores = grid_scores(score_fn, question[start:end], input_mask[start:end], segment_ids[start:end],
+                                     features, spatials, image_mask).float()
+                if state.scores is not None:
+                    state.scores[start:end, img_start:img_end] = scores.cpu().numpy()
+
+                # the ground truth itself is never counted
+                is_gold = img_index.unsqueeze(0) == targets[start:end].to(device).unsqueeze(1)
+                greater = ((scores > gold[start:end].unsqueeze(1)) & ~is_gold).sum(dim=1)
+                block_greater[start:end] += greater.cpu().numpy()
+
+                top_scores = torch.cat([torch.from_numpy(block_top_scores[start:end]).to(device), scores], dim=1)
+                top_idx = torch.cat([torch.from_numpy(block_top_idx[start:end]).to(device),
+                                     img_index.unsqueeze(0).expand(end - start, -1)], dim=1)
+                top_scores, order = top_scores.topk(k, dim=1)
+                block_top_scores[start:end] = top_scores.cpu().numpy()
+                block_top_idx[start:end] = top_idx.gather(1, order).cpu().numpy()
+
+            state.commit(block, block_greater, block_top_scores, block_top_idx)
+            if block % log_step == 0:
+                print("image block %d/%d" % (block + 1, state.n_blocks))
+
+    return state.ranks(valid), np.array(state.top_idx)
@@ -1,140 +1,218 @@
 from typing import List
-import csv
-import h5py
+from collections import OrderedDict
+import os
+import struct
 import numpy as np
 import copy
 import pickle
 import lmdb # install lmdb by "pip install lmdb"
 import base64
-import pdb
+
+# binary record: header followed by the float32 features (num_boxes, feature_dim)
+# and the float32 boxes (num_boxes, 4) of the image, no pickle or base64
+RECORD_MAGIC = b'VLBF'
+RECORD_VERSION = 1
+# magic, version, image_h, image_w, num_boxes, feature_dim
+RECORD_HEADER = struct.Struct('<4sHxxIIII')
+
+# padded record: the global feature is prepended and the 5-d spatials are precomputed,
+# header followed by the features (n_rows, feature_dim) in float32 or float16 and the
+# float32 normalized and original spatials (n_rows, 5), num_boxes of the n_rows are valid
+PADDED_VERSION = 2
+# magic, version, dtype, image_h, image_w, num_boxes, n_rows, feature_dim
+PADDED_HEADER = struct.Struct('<4sHHIIIII')
+PADDED_DTYPES = [np.float32, np.float16]
+VERSION_HEADER = struct.Struct('<4sH')
+
+
+def encode_record(image_h, image_w, features, boxes):
+    """Binary LMDB value of the features (num_boxes, feature_dim) and boxes (num_boxes, 4) of an image"""
+    features = np.ascontiguousarray(features, dtype=np.float32)
+    boxes = np.ascontiguousarray(boxes, dtype=np.float32)
+    header = RECORD_HEADER.pack(RECORD_MAGIC, RECORD_VERSION, int(image_h), int(image_w),
+                                features.shape[0], features.shape[1])
+    return header + features.tobytes() + boxes.tobytes()
+
+
+def encode_padded_record(image_h, image_w, features, boxes, max_region_num, dtype=np.float32):
+    """Padded LMDB value of the features (num_boxes, feature_dim) and boxes (num_boxes, 4)
+    of an image, holds the output of ImageFeaturesH5Reader for the first max_region_num regions
+    """
+    features, num_boxes, image_location, image_location_ori = spatials(image_h, image_w, features, boxes)
+    num_boxes = min(num_boxes, max_region_num)
+
+    features_pad = np.zeros((max_region_num, features.shape[1]), dtype=dtype)
+    location_pad = np.zeros((max_region_num, 5), dtype=np.float32)
+    location_ori_pad = np.zeros((max_region_num, 5), dtype=np.float32)
+    features_pad[:num_boxes] = features[:num_boxes]
+    location_pad[:num_boxes] = image_location[:num_boxes]
+    location_ori_pad[:num_boxes] = image_location_ori[:num_boxes]
+
+    header = PADDED_HEADER.pack(RECORD_MAGIC, PADDED_VERSION, PADDED_DTYPES.index(dtype), int(image_h),
+                                int(image_w), num_boxes, max_region_num, features.shape[1])
+    return header + features_pad.tobytes() + location_pad.tobytes() + location_ori_pad.tobytes()
+
+
+def decode_record(buf):
+    """(image_h, image_w, features, boxes) of a binary record, features and boxes are views on buf"""
+    _, version, image_h, image_w, num_boxes, feature_dim = RECORD_HEADER.unpack_from(buf)
+    if version != RECORD_VERSION:
+        raise ValueError("unsupported feature record version %d" % version)
+    offset = RECORD_HEADER.size
+    features = np.frombuffer(buf, dtype=np.float32, count=num_boxes * feature_dim, offset=offset)
+    offset += features.nbytes
+    boxes = np.frombuffer(buf, dtype=np.float32, count=num_boxes * 4, offset=offset)
+    return image_h, image_w, features.reshape(num_boxes, feature_dim), boxes.reshape(num_boxes, 4)
+
+
+def decode_padded_record(buf):
+    """(features, num_boxes, image_location, image_location_ori) of a padded record,
+    the arrays hold the n_rows of the record and are views on buf
+    """
+    _, _, dtype, _, _, num_boxes, n_rows, feature_dim = PADDED_HEADER.unpack_from(buf)
+    offset = PADDED_HEADER.size
+    features = np.frombuffer(buf, dtype=PADDED_DTYPES[dtype], count=n_rows * feature_dim, offset=offset)
+    offset += features.nbytes
+    image_location = np.frombuffer(buf, dtype=np.float32, count=n_rows * 5, offset=offset)
+    offset += image_location.nbytes
+    image_location_ori = np.frombuffer(buf, dtype=np.float32, count=n_rows * 5, offset=offset)
+    return (features.reshape(n_rows, feature_dim), num_boxes,
+            image_location.reshape(n_rows, 5), image_location_ori.reshape(n_rows, 5))
+
+
+def record_version(buf):
+    """Version of a binary record, 0 for a pickled record"""
+    magic, version = VERSION_HEADER.unpack_from(buf)
+    return version if magic == RECORD_MAGIC else 0
+
+
+def decode_pickle_record(buf):
+    """(image_h, image_w, features, boxes) of a pickled record with base64 strings"""
+    item = pickle.loads(bytes(buf))
+    num_boxes = int(item['num_boxes'])
+    features = np.frombuffer(base64.b64decode(item["features"]), dtype=np.float32).reshape(num_boxes, -1)
+    boxes = np.frombuffer(base64.b64decode(item['boxes']), dtype=np.float32).reshape(num_boxes, 4)
+    return int(item['image_h']), int(item['image_w']), features, boxes
+
+
+# LMDB environments must not be shared with forked DataLoader workers and can only
+# be opened once per process, every process opens its own per path
+_ENVS = {}
+
+
+def open_env(features_path):
+    key = (os.getpid(), features_path)
+    if key not in _ENVS:
+        _ENVS[key] = lmdb.open(features_path, max_readers=126, readonly=True,
+                               lock=False, readahead=False, meminit=False)
+    return _ENVS[key]
+
 
 class ImageFeaturesH5Reader(object):
     """
-    A reader for H5 files containing pre-extracted image features. A typical
-    H5 file is expected to have a column named "image_id", and another column
-    named "features".
-
-    Example of an H5 file:
-    ```
-    faster_rcnn_bottomup_features.h5
-       |--- "image_id" [shape: (num_images, )]
-       |--- "features" [shape: (num_images, num_proposals, feature_size)]
-       +--- .attrs ("split", "train")
-    ```
-    # TODO (kd): Add support to read boxes, classes and scores.
+    A reader for the LMDB files containing pre-extracted image features. The
+    LMDB holds a pickled list of all image ids under the key "keys" and a
+    record for every image id, either padded with precomputed spatials (see
+    encode_padded_record), binary (see encode_record) or a pickled dict with
+    base64 encoded "features" and "boxes".
 
     Parameters
     ----------
-    features_h5path : str
-        Path to an H5 file containing COCO train / val image features.
+    features_path : str
+        Path to an LMDB folder containing the image features.
     in_memory : bool
-        Whether to load the whole H5 file in memory. Beware, these files are
-        sometimes tens of GBs in size. Set this to true if you have sufficient
-        RAM - trade-off between speed and memory.
+        Whether to keep the decoded features of recently read images in memory,
+        at most cache_size of them (least recently used are dropped first).
+    cache_size : int
+        Number of images kept in memory when in_memory is set.
     """
-    def __init__(self, features_path: str, in_memory: bool = False):
+    def __init__(self, features_path: str, in_memory: bool = False, cache_size: int = 10000):
         self.features_path = features_path
         self._in_memory = in_memory
+        self._cache_size = cache_size if in_memory else 0
 
-        # with h5py.File(self.features_h5path, "r", libver='latest', swmr=True) as features_h5:
-            # self._image_ids = list(features_h5["image_ids"])
-            # If not loaded in memory, then list of None.
-        self.env = lmdb.open(self.features_path, max_readers=1, readonly=True,
-                            lock=False, readahead=False, meminit=False)
-
-        with self.env.begin(write=False) as txn:
+        with self._open().begin(write=False) as txn:
             self._image_ids = pickle.loads(txn.get('keys'.encode()))
 
-        self.features = [None] * len(self._image_ids)
-        self.num_boxes = [None] * len(self._image_ids)
-        self.boxes = [None] * len(self._image_ids)
-        self.boxes_ori = [None] * len(self._image_ids)
+        # image id to slot, instead of a scan of the id list for every lookup
+        self._index = {image_id: i for i, image_id in enumerate(self._image_ids)}
+        self._cache = OrderedDict()
+
+    def __getstate__(self):
+        # the cache stays in the process that filled it
+        state = self.__dict__.copy()
+        state["_cache"] = OrderedDict()
+        return state
+
+    def _open(self):
+        return open_env(self.features_path)
 
     def __len__(self):
         return len(self._image_ids)
 
     def __getitem__(self, image_id):
         image_id = str(image_id).encode()
-
-        index = self._image_ids.index(image_id)
-        if self._in_memory:
-            # Load features during first epoch, all not loaded together as it
-            # has a slow start.
-            if self.features[index] is not None:
-                features = self.features[index]
-                num_boxes = self.num_boxes[index]
-                image_location = self.boxes[index]
-                image_location_ori = self.boxes_ori[index]
-            else:
-                with self.env.begin(write=False) as txn:
-                    item = pickle.loads(txn.get(image_id))
-                    image_id = item['image_id']
-                    image_h = int(item['image_h'])
-                    image_w = int(item['image_w'])
-                    num_boxes = int(item['num_boxes'])
-
-                    features = np.frombuffer(base64.b64decode(item["features"]), dtype=np.float32).reshape(num_boxes, 2048)
-                    boxes = np.frombuffer(base64.b64decode(item['boxes']), dtype=np.float32).reshape(num_boxes, 4)
-                    g_feat = np.sum(features, axis=0) / num_boxes
-                    num_boxes = num_boxes + 1
-
-                    features = np.concatenate([np.expand_dims(g_feat, axis=0), features], axis=0)
-                    self.features[index] = features
-
-                    image_location = np.zeros((boxes.shape[0], 5), dtype=np.float32)
-                    image_location[:,:4] = boxes
-                    image_location[:,4] = (image_location[:,3] - image_location[:,1]) * (image_location[:,2] - image_location[:,0]) / (float(image_w) * float(image_h))
-
-                    image_location_ori = copy.deepcopy(image_location)
-
-                    image_location[:,0] = image_location[:,0] / float(image_w)
-                    image_location[:,1] = image_location[:,1] / float(image_h)
-                    image_location[:,2] = image_location[:,2] / float(image_w)
-                    image_location[:,3] = image_location[:,3] / float(image_h)
-
-                    g_location = np.array([0,0,1,1,1])
-                    image_location = np.concatenate([np.expand_dims(g_location, axis=0), image_location], axis=0)
-                    self.boxes[index] = image_location
-
-                    g_location_ori = np.array([0,0,image_w,image_h,image_w*image_h])
-                    image_location_ori = np.concatenate([np.expand_dims(g_location_ori, axis=0), image_location_ori], axis=0)
-                    self.boxes_ori[index] = image_location_ori
-                    self.num_boxes[index] = num_boxes
+        if image_id not in self._index:
+            raise KeyError(image_id)
+
+        if image_id in self._cache:
+            self._cache.move_to_end(image_id)
+            return self._cache[image_id]
+
+        with self._open().begin(write=False, buffers=True) as txn:
+            # the buffer is only valid within the transaction, _load copies out of it
+            item = self._load(txn.get(image_id))
+
+        if self._cache_size > 0:
+            self._cache[image_id] = item
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return item
+
+    def _load(self, buf):
+        version = record_version(buf)
+        if version == PADDED_VERSION:
+            # already in the output layout, only copied out of the LMDB buffer
+            features, num_boxes, image_location, image_location_ori = decode_padded_record(buf)
+            return (features[:num_boxes].astype(np.float32), num_boxes,
+                    np.array(image_location[:num_boxes]), np.array(image_location_ori[:num_boxes]))
+        elif version == RECORD_VERSION:
+            image_h, image_w, features, boxes = decode_record(buf)
+        elif version == 0:
+            image_h, image_w, features, boxes = decode_pickle_record(buf)
         else:
-            # Read chunk from file everytime if not loaded in memory.
-            with self.env.begin(write=False) as txn:
-                item = pickle.loads(txn.get(image_id))
-                image_id = item['image_id']
-                image_h = int(item['image_h'])
-                image_w = int(item['image_w'])
-                num_boxes = int(item['num_boxes'])
-                # print(num_boxes)
-                # temp = np.frombuffer(base64.b64decode(item["features"]), dtype=np.float32)
-                # print(temp.shape)
-                features = np.frombuffer(base64.b64decode(item["features"]), dtype=np.float32).reshape(num_boxes, 2048)
-                boxes = np.frombuffer(base64.b64decode(item['boxes']), dtype=np.float32).reshape(num_boxes, 4)
-
-                g_feat = np.sum(features, axis=0) / num_boxes
-                num_boxes = num_boxes + 1
-                features = np.concatenate([np.expand_dims(g_feat, axis=0), features], axis=0)
-
-                image_location = np.zeros((boxes.shape[0], 5), dtype=np.float32)
-                image_location[:,:4] = boxes
-                image_location[:,4] = (image_location[:,3] - image_location[:,1]) * (image_location[:,2] - image_location[:,0]) / (float(image_w) * float(image_h))
-
-                image_location_ori = copy.deepcopy(image_location)
-                image_location[:,0] = image_location[:,0] / float(image_w)
-                image_location[:,1] = image_location[:,1] / float(image_h)
-                image_location[:,2] = image_location[:,2] / float(image_w)
-                image_location[:,3] = image_location[:,3] / float(image_h)
-
-                g_location = np.array([0,0,1,1,1])
-                image_location = np.concatenate([np.expand_dims(g_location, axis=0), image_location], axis=0)
-
-                g_location_ori = np.array([0,0,image_w,image_h,image_w*image_h])
-                image_location_ori = np.concatenate([np.expand_dims(g_location_ori, axis=0), image_location_ori], axis=0)
-
-        return features, num_boxes, image_location, image_location_ori
+            raise ValueError("unsupported feature record version %d" % version)
+
+        return spatials(image_h, image_w, features, boxes)
 
     def keys(self) -> List[int]:
         return self._image_ids
+
+
+def spatials(image_h, image_w, features, boxes):
+    """Prepends the mean feature of all regions as global feature and computes the 5-d
+    spatials (x1, y1, x2, y2, area), normalized by the image size and the original ones
+    --> (features, num_boxes, image_location, image_location_ori) with the global region first
+    """
+    num_boxes = features.shape[0]
+    g_feat = np.sum(features, axis=0) / num_boxes
+    num_boxes = num_boxes + 1
+    features = np.concatenate([np.expand_dims(g_feat, axis=0), features], axis=0)
+
+    image_location = np.zeros((boxes.shape[0], 5), dtype=np.float32)
+    image_location[:,:4] = boxes
+    image_location[:,4] = (image_location[:,3] - image_location[:,1]) * (image_location[:,2] - image_location[:,0]) / (float(image_w) * float(image_h))
+
+    image_location_ori = copy.deepcopy(image_location)
+    image_location[:,0] = image_location[:,0] / float(image_w)
+    image_location[:,1] = image_location[:,1] / float(image_h)
+    image_location[:,2] = image_location[:,2] / float(image_w)
+    image_location[:,3] = image_location[:,3] / float(image_h)
+
+    g_location = np.array([0,0,1,1,1])
+    image_location = np.concatenate([np.expand_dims(g_location, axis=0), image_location], axis=0)
+
+    g_location_ori = np.array([0,0,image_w,image_h,image_w*image_h])
+    image_location_ori = np.concatenate([np.expand_dims(g_location_ori, axis=0), image_location_ori], axis=0)
+
+    return features, num_boxes, image_location, image_location_ori
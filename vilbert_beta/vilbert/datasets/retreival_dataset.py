@@ -4,7 +4,7 @@ import random
 import os
 
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, get_worker_info
 import numpy as np
 import _pickle as cPickle
 
@@ -14,6 +14,10 @@ import jsonlines
 import sys
 import pdb
 
+# image of every option of a training sample: the correct image, except for
+# option 3 (random image wrong)
+OPTION_IMAGES = [0, 0, 1, 0]
+
 def assert_eq(real, expected):
     assert real == expected, "%s (true) vs %s (expected)" % (real, expected)
 
@@ -74,11 +78,9 @@ class RetreivalDataset(Dataset):
         self._max_region_num = max_region_num
         self._max_seq_length = max_seq_length
 
+        self.hard_pool_path = os.path.join(dataroot, 'hard_negative.pkl')
         if self._split == 'train':
-            image_info = cPickle.load(open(os.path.join(dataroot, 'hard_negative.pkl'), 'rb'))
-            for key, value in image_info.items():
-                setattr(self, key, value)
-            self.train_imgId2pool = {imageId:i for i, imageId in enumerate(self.train_image_list)}
+            self.load_hard_pool()
 
         cache_path = os.path.join(dataroot, "cache", task + '_' + split + '_' + str(max_seq_length)+'.pkl')
 
@@ -90,6 +92,13 @@ class RetreivalDataset(Dataset):
             print('loading entries from %s' %(cache_path))
             self._entries = cPickle.load(open(cache_path, "rb"))
 
+    def load_hard_pool(self):
+        """(Re)load the hard negative pools, see vilbert/hard_negative.py"""
+        image_info = cPickle.load(open(self.hard_pool_path, 'rb'))
+        for key, value in image_info.items():
+            setattr(self, key, value)
+        self.train_imgId2pool = {imageId:i for i, imageId in enumerate(self.train_image_list)}
+
     def tokenize(self):
         """Tokenizes the captions.
 
@@ -134,28 +143,13 @@ class RetreivalDataset(Dataset):
 
 
     def __getitem__(self, index):
+        """
+        The ids of the two images and the captions of the four options, the image features
+        are read and padded per batch in collate.
+        """
         entry = self._entries[index]
         image_id = entry["image_id"]
 
-        features, num_boxes, boxes, _ = self._image_features_reader[image_id]
-        mix_num_boxes = min(int(num_boxes), self._max_region_num)
-        mix_boxes_pad = np.zeros((self._max_region_num, 5))
-        mix_features_pad = np.zeros((self._max_region_num, 2048))
-
-        image_mask = [1] * (int(mix_num_boxes))
-        while len(image_mask) < self._max_region_num:
-            image_mask.append(0)
-
-        mix_boxes_pad[:mix_num_boxes] = boxes[:mix_num_boxes]
-        mix_features_pad[:mix_num_boxes] = features[:mix_num_boxes]
-
-        features1 = torch.tensor(mix_features_pad).float()
-        image_mask1 = torch.tensor(image_mask).long()
-        spatials1 = torch.tensor(mix_boxes_pad).float()
-
-        caption1 = entry["token"]
-        input_mask1 = entry["input_mask"]
-        segment_ids1 = entry["segment_ids"]
         # negative samples.
         # 1: correct one, 2: random caption wrong, 3: random image wrong. 4: hard image wrong.
 
@@ -166,42 +160,12 @@ class RetreivalDataset(Dataset):
 
         entry2 = self._entries[random.choice(self.imgid2entry[img_id2])]
 
-        features2 = features1
-        image_mask2 = image_mask1
-        spatials2 = spatials1
-        caption2 = entry2["token"]
-        input_mask2 = entry2["input_mask"]
-        segment_ids2 = entry2["segment_ids"]
-
         # random image wrong
         while True:
             # sample a random image:
             img_id3 = random.choice(self.image_id_list)
             if img_id3 != image_id: break
 
-        features3, num_boxes3, boxes3, _ = self._image_features_reader[img_id3]
-        image_mask3 = [1] * (int(num_boxes3))
-
-        mix_num_boxes3 = min(int(num_boxes3), self._max_region_num)
-        mix_boxes_pad3 = np.zeros((self._max_region_num, 5))
-        mix_features_pad3 = np.zeros((self._max_region_num, 2048))
-
-        while len(image_mask3) < self._max_region_num:
-            image_mask3.append(0)
-
-
-        mix_boxes_pad[:mix_num_boxes3] = boxes3[:mix_num_boxes3]
-        mix_features_pad[:mix_num_boxes3] = features3[:mix_num_boxes3]
-
-        features3 = torch.tensor(mix_features_pad).float()
-        image_mask3 = torch.tensor(image_mask3).long()
-        spatials3 = torch.tensor(mix_boxes_pad).float()
-
-        caption3 = caption1
-        input_mask3 = input_mask1
-        segment_ids3 = segment_ids1
-
-
         if self._split == 'train':
 
             # random hard caption.
@@ -216,20 +180,50 @@ class RetreivalDataset(Dataset):
 
         entry4 = self._entries[random.choice(self.imgid2entry[img_id4])]
 
-        features4 = features1
-        image_mask4 = image_mask1
-        spatials4 = spatials1
-        caption4 = entry4["token"]
-        input_mask4 = entry4["input_mask"]
-        segment_ids4 = entry4["segment_ids"]
-        features = torch.stack([features1, features2, features3, features4], dim=0)
-        spatials = torch.stack([spatials1, spatials2, spatials3, spatials4], dim=0)
-        image_mask = torch.stack([image_mask1, image_mask2, image_mask3, image_mask4], dim=0)
-        caption = torch.stack([caption1, caption2, caption3, caption4], dim=0)
-        input_mask = torch.stack([input_mask1, input_mask2, input_mask3, input_mask4], dim=0)
-        segment_ids = torch.stack([segment_ids1, segment_ids2, segment_ids3, segment_ids4], dim=0)
-        co_attention_mask = torch.zeros((4, self._max_region_num, self._max_seq_length))
-        target = 0
+        # the captions of option 1 and 3 are the correct one
+        options = [entry, entry2, entry, entry4]
+        caption = torch.stack([e["token"] for e in options], dim=0)
+        input_mask = torch.stack([e["input_mask"] for e in options], dim=0)
+        segment_ids = torch.stack([e["segment_ids"] for e in options], dim=0)
+
+        return [image_id, img_id3], caption, input_mask, segment_ids, image_id
+
+    def collate(self, samples):
+        """
+        Batch of samples of __getitem__: the features of every distinct image of the batch are read
+        once and padded in float32 directly into the batch tensors. The features hold the two images
+        of every sample (see OPTION_IMAGES), they are expanded to the four options on the device.
+        """
+        batch_size = len(samples)
+        n_images = max(OPTION_IMAGES) + 1
+        # pinned here only in the main process, DataLoader workers may not initialize CUDA
+        pin = torch.cuda.is_available() and get_worker_info() is None
+        features = torch.zeros((batch_size, n_images, self._max_region_num, 2048), pin_memory=pin)
+        spatials = torch.zeros((batch_size, n_images, self._max_region_num, 5), pin_memory=pin)
+        image_mask = torch.zeros((batch_size, n_images, self._max_region_num), dtype=torch.long, pin_memory=pin)
+
+        positions = {}
+        for i, sample in enumerate(samples):
+            for j, img_id in enumerate(sample[0]):
+                positions.setdefault(img_id, []).append((i, j))
+
+        for img_id, where in positions.items():
+            image_features, num_boxes, boxes, _ = self._image_features_reader[img_id]
+            mix_num_boxes = min(int(num_boxes), self._max_region_num)
+            image_features = torch.from_numpy(np.asarray(image_features[:mix_num_boxes]))
+            boxes = torch.from_numpy(np.asarray(boxes[:mix_num_boxes]))
+            for i, j in where:
+                features[i, j, :mix_num_boxes] = image_features
+                spatials[i, j, :mix_num_boxes] = boxes
+                image_mask[i, j, :mix_num_boxes] = 1
+
+        _, caption, input_mask, segment_ids, image_id = zip(*samples)
+        caption = torch.stack(caption, dim=0)
+        input_mask = torch.stack(input_mask, dim=0)
+        segment_ids = torch.stack(segment_ids, dim=0)
+        co_attention_mask = torch.zeros((batch_size, 4, self._max_region_num, self._max_seq_length))
+        target = torch.zeros(batch_size, dtype=torch.long)
+        image_id = torch.tensor(image_id)
         return features, spatials, image_mask, caption, target, input_mask, segment_ids, co_attention_mask, image_id
 
     def __len__(self):
@@ -271,6 +265,7 @@ class RetreivalDatasetVal(Dataset):
         padding_index: int = 0,
         max_seq_length: int = 20,
         max_region_num: int = 10,
+        image_block: int = 500,
     ):
         # All the keys in `self._entries` would be present in `self._image_features_reader`
 
@@ -283,6 +278,7 @@ class RetreivalDatasetVal(Dataset):
         self._padding_index = padding_index
         self._max_region_num = max_region_num
         self._max_seq_length = max_seq_length
+        self._image_block = image_block
         self.num_labels = 1
 
         # cache file path data/cache/train_ques
@@ -295,34 +291,10 @@ class RetreivalDatasetVal(Dataset):
             # print('loading entries from %s' %(cap_cache_path))
             # self._entries = cPickle.load(open(cap_cache_path, "rb"))
 #
-        self.features_all = np.zeros((1000, self._max_region_num, 2048))
-        self.spatials_all = np.zeros((1000, self._max_region_num, 5))
-        self.image_mask_all = np.zeros((1000, self._max_region_num))
-
-        for i, image_id in enumerate(self._image_entries):
-            features, num_boxes, boxes, _ = self._image_features_reader[image_id]
-
-            mix_num_boxes = min(int(num_boxes), self._max_region_num)
-            mix_boxes_pad = np.zeros((self._max_region_num, 5))
-            mix_features_pad = np.zeros((self._max_region_num, 2048))
-
-            image_mask = [1] * (int(mix_num_boxes))
-            while len(image_mask) < self._max_region_num:
-                image_mask.append(0)
-
-            mix_boxes_pad[:mix_num_boxes] = boxes[:mix_num_boxes]
-            mix_features_pad[:mix_num_boxes] = features[:mix_num_boxes]
-
-            self.features_all[i] = mix_features_pad
-            self.image_mask_all[i] = np.array(image_mask)
-            self.spatials_all[i] = mix_boxes_pad
-
-            sys.stdout.write('%d/%d\r' % (i, len(self._image_entries)))
-            sys.stdout.flush()
-
-        self.features_all = torch.Tensor(self.features_all).float()
-        self.image_mask_all = torch.Tensor(self.image_mask_all).long()
-        self.spatials_all = torch.Tensor(self.spatials_all).float()
+        # the catalog is not held in memory, the features of the images are read when they are scored
+        # index of the ground truth image of every caption
+        image_index = {image_id: i for i, image_id in enumerate(self._image_entries)}
+        self.caption_targets = np.array([image_index.get(entry["image_id"], -1) for entry in self._caption_entries])
 
     def tokenize(self):
         """Tokenizes the captions.
@@ -367,33 +339,59 @@ class RetreivalDatasetVal(Dataset):
 
     def __getitem__(self, index):
 
-        # we iterate through every caption here.
-        caption_idx = int(index / 2)     # rond naar beneden af
-        image_idx = index % 2
+        # we iterate through every caption here, against one block of image_block images at a time
+        n_blocks = self.num_image_blocks()
+        caption_idx = index // n_blocks
+        image_idx = index % n_blocks
 
-        if image_idx == 0:
-            image_entries = self._image_entries[:500]
-            features_all = self.features_all[:500]
-            spatials_all = self.spatials_all[:500]
-            image_mask_all = self.image_mask_all[:500]
-
-        else:
-            image_entries = self._image_entries[500:]
-            features_all = self.features_all[500:]
-            spatials_all = self.spatials_all[500:]
-            image_mask_all = self.image_mask_all[500:]
+        start = image_idx * self._image_block
+        end = min(start + self._image_block, len(self._image_entries))
+        features_all, spatials_all, image_mask_all = self.images(range(start, end))
 
         entry = self._caption_entries[caption_idx]
         caption = entry["token"]
         input_mask = entry["input_mask"]
         segment_ids = entry["segment_ids"]
 
-        target_all = torch.zeros(500)
-        for i, image_id in enumerate(image_entries):
-            if image_id == entry["image_id"]:
-                target_all[i] = 1
+        target_all = torch.zeros(end - start)
+        target = self.caption_targets[caption_idx]
+        if start <= target < end:
+            target_all[target - start] = 1
 
         return features_all, spatials_all, image_mask_all, caption, input_mask, segment_ids, target_all, caption_idx, image_idx
 
+    def num_image_blocks(self):
+        return (len(self._image_entries) - 1) // self._image_block + 1
+
+    def num_images(self):
+        return len(self._image_entries)
+
+    def images(self, index):
+        """
+        Padded features of the catalog images index (range or sequence of image indices), read from
+        the feature reader
+        --> (features (n, max_region_num, 2048), spatials (n, max_region_num, 5), image_mask (n, max_region_num))
+        """
+        index = [int(i) for i in index]
+        features_all = np.zeros((len(index), self._max_region_num, 2048), dtype=np.float32)
+        spatials_all = np.zeros((len(index), self._max_region_num, 5), dtype=np.float32)
+        image_mask_all = np.zeros((len(index), self._max_region_num), dtype=np.int64)
+
+        for j, i in enumerate(index):
+            features, num_boxes, boxes, _ = self._image_features_reader[self._image_entries[i]]
+
+            mix_num_boxes = min(int(num_boxes), self._max_region_num)
+            features_all[j, :mix_num_boxes] = features[:mix_num_boxes]
+            spatials_all[j, :mix_num_boxes] = boxes[:mix_num_boxes]
+            image_mask_all[j, :mix_num_boxes] = 1
+
+        return torch.from_numpy(features_all), torch.from_numpy(spatials_all), torch.from_numpy(image_mask_all)
+
+    def captions(self):
+        """(tokens, input_mask, segment_ids) of all captions, each (n_captions, max_seq_length)"""
+        return (torch.stack([entry["token"] for entry in self._caption_entries]),
+                torch.stack([entry["input_mask"] for entry in self._caption_entries]),
+                torch.stack([entry["segment_ids"] for entry in self._caption_entries]))
+
     def __len__(self):
-        return len(self._caption_entries) * 2
+        return len(self._caption_entries) * self.num_image_blocks()
@@ -0,0 +1,123 @@
+"""Hard negative pools of the retrieval training"""
+
+import os
+import pickle
+import numpy as np
+import torch
+
+"""
+The pool of an image holds the image itself followed by the n_hard most similar other images of
+the training set, found with an exact blocked nearest neighbour search on l2 normalized embeddings.
+RetreivalDataset samples the hard negative caption from the pool, skipping the first entry.
+
+During training the pools are refreshed from the pooled visual output of the current model, the
+embeddings of the last refresh are cached next to the pickle (hard_negative_embs.npy).
+
+The pickle has the schema of the pools of ViLBERT:
+{"train_hard_pool": (n_images, n_hard + 1) indices into "train_image_list", "train_image_list": image ids}
+"""
+
+
+def mine_hard_pool(embs, n_hard, device, block=1024):
+    """
+    embs: (n_images, d) embeddings of the images
+    --> (n_images, n_hard + 1) indices, every row starts with the image itself
+    """
+    embs = torch.as_tensor(np.asarray(embs)).float().to(device)
+    embs = embs / embs.norm(dim=1, keepdim=True).clamp(min=1e-12)
+    n_images = embs.size(0)
+    n_hard = min(n_hard, n_images - 1)
+    pool = np.zeros((n_images, n_hard + 1), dtype=np.int64)
+
+    for start in range(0, n_images, block):
+        end = min(start + block, n_images)
+        sims = embs[start:end] @ embs.t()
+        rows = torch.arange(end - start, device=device)
+        # the image itself is put first
+        sims[rows, rows + start] = float('inf')
+        pool[start:end] = sims.topk(n_hard + 1, dim=1)[1].cpu().numpy()
+    return pool
+
+
+def write_hard_pool(path, pool, image_list):
+    """Write the pool pickle, it is replaced at once so readers never see a partial file"""
+    tmp_path = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump({"train_hard_pool": pool, "train_image_list": list(image_list)}, f)
+    os.replace(tmp_path, path)
+
+
+class TrainImages(torch.utils.data.Dataset):
+    """Padded regions of the images, read from the LMDB by the workers of a DataLoader"""
+
+    def __init__(self, reader, image_ids, max_region_num):
+        self.reader = reader
+        self.image_ids = image_ids
+        self.max_region_num = max_region_num
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __getitem__(self, index):
+        image_features, num_boxes, boxes, _ = self.reader[self.image_ids[index]]
+        num_boxes = min(int(num_boxes), self.max_region_num)
+        features = np.zeros((self.max_region_num, image_features.shape[1]), dtype=np.float32)
+        spatials = np.zeros((self.max_region_num, 5), dtype=np.float32)
+        image_mask = np.zeros(self.max_region_num, dtype=np.int64)
+        features[:num_boxes] = image_features[:num_boxes]
+        spatials[:num_boxes] = boxes[:num_boxes]
+        image_mask[:num_boxes] = 1
+        return torch.from_numpy(features), torch.from_numpy(spatials), torch.from_numpy(image_mask)
+
+
+def image_embeddings(model, reader, image_ids, max_region_num, text_ids, device, batch_size=256, workers=4):
+    """
+    Embeddings of the current model for the images: the pooled visual output of the full ViLBERT
+    forward (co-attention stack included), with text_ids (e.g. [CLS] [SEP]) as the text of every image
+    --> (n_images, bi_hidden_size)
+    """
+    bert = (model.module if hasattr(model, "module") else model).bert
+    training = model.training
+    model.eval()
+
+    loader = torch.utils.data.DataLoader(TrainImages(reader, image_ids, max_region_num),
+                                         batch_size=batch_size, shuffle=False, num_workers=workers)
+    text = torch.tensor(text_ids, dtype=torch.long, device=device).unsqueeze(0)
+    embs = []
+    with torch.no_grad():
+        for features, spatials, image_mask in loader:
+            input_txt = text.expand(features.size(0), -1)
+            _, _, _, pooled_output_v, _ = bert(input_txt, features.to(device), spatials.to(device),
+                                               image_attention_mask=image_mask.to(device))
+            embs.append(pooled_output_v.float().cpu())
+
+    model.train(training)
+    return torch.cat(embs).numpy()
+
+
+def embedding_cache_path(pool_path):
+    """the embeddings of the last refresh are kept next to the pool pickle"""
+    return os.path.splitext(pool_path)[0] + "_embs.npy"
+
+
+def write_embedding_cache(path, embs):
+    tmp_path = "{}.tmp{}.npy".format(path, os.getpid())
+    np.save(tmp_path, np.asarray(embs, dtype=np.float32))
+    os.replace(tmp_path, path)
+
+
+def refresh_hard_pool(model, dataset, device, n_hard=None):
+    """
+    Embed the training images of dataset (RetreivalDataset) once with the current model, cache the
+    embeddings next to the pool pickle, mine the pools from them, write the pickle and reload it
+    """
+    if n_hard is None:
+        n_hard = dataset.train_hard_pool.shape[1] - 1
+    vocab = dataset._tokenizer.vocab
+    embs = image_embeddings(model, dataset._image_features_reader, dataset.train_image_list,
+                            dataset._max_region_num, [vocab["[CLS]"], vocab["[SEP]"]], device)
+    write_embedding_cache(embedding_cache_path(dataset.hard_pool_path), embs)
+
+    pool = mine_hard_pool(embs, n_hard, device)
+    write_hard_pool(dataset.hard_pool_path, pool, dataset.train_image_list)
+    dataset.load_hard_pool()
@@ -0,0 +1,77 @@
+"""Ranking metrics without sorting"""
+
+# the same module is in comb/, laenen/ and vilbert_beta/vilbert/, the copies are kept identical
+
+import numpy as np
+
+# rank of a row without ground truth
+NO_GT_RANK = -1
+
+
+def diag_ranks(sims, chunk_size=1024):
+    """
+    Rank of the diagonal entry of every row of sims, computed by counting the
+    scores that are strictly higher than the ground truth instead of sorting.
+    sims: (N, M) matrix of similarities, ground truth of row i is column i
+    chunk_size: number of rows compared at once, bounds the (chunk, M) temporary
+    --> ranks: (N) 0 when the ground truth is ranked highest, top1: (N) best column
+    """
+    npts = sims.shape[0]
+    ranks = np.zeros(npts)
+    top1 = np.zeros(npts)
+
+    for start in range(0, npts, chunk_size):
+        end = min(start + chunk_size, npts)
+        block = np.asarray(sims[start:end])
+        gt = block[np.arange(end - start), np.arange(start, end)]
+        ranks[start:end] = np.count_nonzero(block > gt[:, None], axis=1)
+        top1[start:end] = np.argmax(block, axis=1)
+    return ranks, top1
+
+
+def target_ranks(sims, targets, chunk_size=1024):
+    """
+    Same as diag_ranks, but the ground truth column of row i is targets[i]
+    """
+    npts = sims.shape[0]
+    targets = np.asarray(targets)
+    ranks = np.zeros(npts)
+
+    for start in range(0, npts, chunk_size):
+        end = min(start + chunk_size, npts)
+        block = np.asarray(sims[start:end])
+        gt = block[np.arange(end - start), targets[start:end]]
+        ranks[start:end] = np.count_nonzero(block > gt[:, None], axis=1)
+    return ranks
+
+
+def recall_metrics(ranks, ks=(1, 5, 10, 20, 50)):
+    """
+    R@k for every k in ks followed by medr and meanr, rows with rank NO_GT_RANK
+    (no ground truth) are left out
+    """
+    ranks = np.asarray(ranks)
+    ranks = ranks[ranks != NO_GT_RANK]
+    recalls = tuple(100.0 * np.count_nonzero(ranks < k) / len(ranks) for k in ks)
+    medr = np.floor(np.median(ranks)) + 1
+    meanr = ranks.mean() + 1
+    return recalls + (medr, meanr)
+
+
+def top_n(sims, n, chunk_size=1024):
+    """
+    Indices of the n highest scores of every row, best first, using a
+    partial sort of each row
+    --> (N, n) array
+    """
+    npts = sims.shape[0]
+    n = min(n, sims.shape[1])
+    top = np.zeros((npts, n), dtype=np.int64)
+
+    for start in range(0, npts, chunk_size):
+        end = min(start + chunk_size, npts)
+        block = np.asarray(sims[start:end])
+        part = np.argpartition(-block, n - 1, axis=1)[:, :n]
+        order = np.argsort(-np.take_along_axis(block, part, axis=1), axis=1)
+        top[start:end] = np.take_along_axis(part, order, axis=1)
+    return top
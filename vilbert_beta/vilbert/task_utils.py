@@ -9,10 +9,12 @@ import torch.nn.functional as F
 import torch.nn as nn
 import torch.distributed as dist
 from torch.utils.data import DataLoader, Dataset, RandomSampler
+from torch.utils.data.dataloader import default_collate
 from torch.utils.data.distributed import DistributedSampler
 from pytorch_pretrained_bert.tokenization import BertTokenizer
 from vilbert.datasets import DatasetMapTrain, DatasetMapEval
 from vilbert.datasets._image_features_reader import ImageFeaturesH5Reader
+from vilbert.datasets.retreival_dataset import OPTION_IMAGES
 import pdb
 
 logger = logging.getLogger(__name__)
@@ -33,6 +35,9 @@ def ForwardModelsVal(args, task_cfg, device, task_id, batch, model, task_losses)
         # features = features.unsqueeze(1).expand(batch_size, num_options, max_num_bbox, 2048).contiguous().view(-1, max_num_bbox, 2048)
         # spatials = spatials.unsqueeze(1).expand(batch_size, num_options, max_num_bbox, 5).contiguous().view(-1, max_num_bbox, 5)
         # image_mask = image_mask.unsqueeze(1).expand(batch_size, num_options, max_num_bbox).contiguous().view(-1, max_num_bbox)
+        if task_id == 'TASK3' and features.size(1) != num_options:
+            # retrieval batches hold the distinct images of the options once
+            features, spatials, image_mask = [t[:, OPTION_IMAGES] for t in (features, spatials, image_mask)]
         features = features.expand(batch_size, num_options, max_num_bbox, 2048).contiguous().view(-1, max_num_bbox, 2048)
         spatials = spatials.expand(batch_size, num_options, max_num_bbox, 5).contiguous().view(-1, max_num_bbox, 5)
         image_mask = image_mask.expand(batch_size, num_options, max_num_bbox).contiguous().view(-1, max_num_bbox)
@@ -100,6 +105,9 @@ def ForwardModelsTrain(args, task_cfg, device, task_id, task_count, task_iter_tr
         # spatials = spatials.unsqueeze(1).expand(batch_size, num_options, max_num_bbox, 5).contiguous().view(-1, max_num_bbox, 5)
         # image_mask = image_mask.unsqueeze(1).expand(batch_size, num_options, max_num_bbox).contiguous().view(-1, max_num_bbox)
 
+        if task_id == 'TASK3' and features.size(1) != num_options:
+            # retrieval batches hold the distinct images of the options once
+            features, spatials, image_mask = [t[:, OPTION_IMAGES] for t in (features, spatials, image_mask)]
         features = features.expand(batch_size, num_options, max_num_bbox, 2048).contiguous().view(-1, max_num_bbox, 2048)
         spatials = spatials.expand(batch_size, num_options, max_num_bbox, 5).contiguous().view(-1, max_num_bbox, 5)
         image_mask = image_mask.expand(batch_size, num_options, max_num_bbox).contiguous().view(-1, max_num_bbox)
@@ -180,12 +188,13 @@ def LoadDatasets(args, task_cfg, ids, split='trainval'):
     # initilzie the feature reader
     for features_h5path in task_feature_reader1.keys():
         if features_h5path != '':
-            task_feature_reader1[features_h5path] = ImageFeaturesH5Reader(features_h5path,
-                                                                            args.in_memory)
+            task_feature_reader1[features_h5path] = ImageFeaturesH5Reader(features_h5path, args.in_memory,
+                                                                            getattr(args, "feature_cache_size", 10000))
 
     for features_h5path in task_feature_reader2.keys():
         if features_h5path != '':
-            task_feature_reader2[features_h5path] = ImageFeaturesH5Reader(features_h5path, args.in_memory)
+            task_feature_reader2[features_h5path] = ImageFeaturesH5Reader(features_h5path, args.in_memory,
+                                                                            getattr(args, "feature_cache_size", 10000))
 
     task_datasets_train = {}
     task_datasets_val = {}
@@ -254,6 +263,7 @@ def LoadDatasets(args, task_cfg, ids, split='trainval'):
                 batch_size=batch_size,
                 num_workers=num_workers,
                 pin_memory=True,
+                collate_fn=getattr(task_datasets_train[task], "collate", default_collate),
             )
             task_num_iters[task] = len(task_dataloader_train[task])
             task_batch_size[task] = batch_size
@@ -265,12 +275,14 @@ def LoadDatasets(args, task_cfg, ids, split='trainval'):
                 batch_size=batch_size,
                 num_workers=num_workers,
                 pin_memory=True,
+                collate_fn=getattr(task_datasets_val[task], "collate", default_collate),
             )
 
     return task_batch_size, task_num_iters, task_ids, task_datasets_train, task_datasets_val, task_dataloader_train, task_dataloader_val
 
 
-def LoadDatasetEval(args, task_cfg, ids):
+def LoadDatasetEval(args, task_cfg, ids, dataloader=True):
+    """dataloader: False when the datasets are evaluated without a DataLoader (eval_retrieval.py)"""
 
     tokenizer = BertTokenizer.from_pretrained(
         args.bert_model, do_lower_case=True
@@ -288,12 +300,13 @@ def LoadDatasetEval(args, task_cfg, ids):
     # initilzie the feature reader
     for features_h5path in task_feature_reader1.keys():
         if features_h5path != '':
-            task_feature_reader1[features_h5path] = ImageFeaturesH5Reader(features_h5path,
-                                                                            args.in_memory)
+            task_feature_reader1[features_h5path] = ImageFeaturesH5Reader(features_h5path, args.in_memory,
+                                                                            getattr(args, "feature_cache_size", 10000))
 
     for features_h5path in task_feature_reader2.keys():
         if features_h5path != '':
-            task_feature_reader2[features_h5path] = ImageFeaturesH5Reader(features_h5path, args.in_memory)
+            task_feature_reader2[features_h5path] = ImageFeaturesH5Reader(features_h5path, args.in_memory,
+                                                                            getattr(args, "feature_cache_size", 10000))
 
     task_datasets_val = {}
     task_dataloader_val = {}
@@ -328,6 +341,10 @@ def LoadDatasetEval(args, task_cfg, ids):
                             max_seq_length=task_cfg[task]['max_seq_length'],
                             max_region_num=task_cfg[task]['max_region_num'])
 
+        task_batch_size[task] = batch_size
+        if not dataloader:
+            continue
+
         task_dataloader_val[task] = DataLoader(
             task_datasets_val[task],
             shuffle=False,
@@ -337,7 +354,6 @@ def LoadDatasetEval(args, task_cfg, ids):
         )
 
         task_num_iters[task] = len(task_dataloader_val[task])
-        task_batch_size[task] = batch_size
 
     return task_batch_size, task_num_iters, task_ids, task_datasets_val, task_dataloader_val
 
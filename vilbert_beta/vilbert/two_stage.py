@@ -0,0 +1,131 @@
+"""Two-stage retrieval: dual-encoder shortlist, ViLBERT re-ranking"""
+
+import time
+import numpy as np
+import torch
+
+from vilbert.ranking import NO_GT_RANK
+
+"""
+The images of every caption are first ranked with the cosine similarity of pooled caption and image
+embeddings of a dual encoder (e.g. SCAN, written by comb/export_pooled.py), only the top k of this
+shortlist are scored by ViLBERT. A caption of which the ground truth image is not in the shortlist
+keeps its first stage rank.
+
+The embeddings file is an .npz with image_ids, image_embs (n_images, d), caption_ids (image id of
+every caption), caption_texts (text of every caption) and caption_embs (n_captions, d). The captions
+of the dataset are found by the id of their image and their text, not by their order; caption_text
+normalizes the texts of the file and of the dataset alike.
+
+The cost of scoring every pair with ViLBERT is not measured, it is extrapolated from the time per
+re-ranked pair, and so is the speedup.
+"""
+
+
+def caption_text(caption):
+    """caption text used in the join, lower case with single spaces"""
+    return " ".join(caption.lower().split())
+
+
+def load_pooled(path, dataset):
+    """
+    Embeddings of the file in the order of the images and captions of the dataset (RetreivalDatasetVal),
+    the captions are joined on the id of their image and their text
+    --> (caption embeddings (n_captions, d), image embeddings (n_images, d)), l2 normalized
+    """
+    pooled = np.load(path)
+    if "caption_texts" not in pooled:
+        raise ValueError("%s has no caption texts, export it again with comb/export_pooled.py" % path)
+    image_row = {int(image_id): i for i, image_id in enumerate(pooled["image_ids"])}
+    # the same caption twice for an image has the same embedding, any of its rows will do
+    caption_row = {(int(image_id), caption_text(str(text))): i
+                   for i, (image_id, text) in enumerate(zip(pooled["caption_ids"], pooled["caption_texts"]))}
+
+    missing = [image_id for image_id in dataset._image_entries if int(image_id) not in image_row]
+    if len(missing) > 0:
+        raise ValueError("%d images of the dataset are not in %s, e.g. %s" % (len(missing), path, missing[0]))
+    img_embs = pooled["image_embs"][[image_row[int(image_id)] for image_id in dataset._image_entries]]
+
+    rows = []
+    for entry in dataset._caption_entries:
+        key = (int(entry["image_id"]), caption_text(entry["caption"]))
+        if key not in caption_row:
+            raise ValueError("caption \"%s\" of image %d is not in %s" % (key[1], key[0], path))
+        rows.append(caption_row[key])
+    cap_embs = pooled["caption_embs"][rows]
+
+    normalize = lambda x: x / x.norm(dim=1, keepdim=True).clamp(min=1e-12)
+    return normalize(torch.from_numpy(cap_embs).float()), normalize(torch.from_numpy(img_embs).float())
+
+
+def shortlist(cap_embs, img_embs, targets, k, device, block=1024):
+    """
+    Top k images of every caption by cosine similarity, best first, and the rank of the ground truth
+    --> (shortlist (n_captions, k), ranks (n_captions)), rank NO_GT_RANK for captions without catalog image (target -1)
+    """
+    img_embs = img_embs.to(device)
+    targets = torch.as_tensor(targets)
+    k = min(k, img_embs.size(0))
+    top = torch.zeros((cap_embs.size(0), k), dtype=torch.long)
+    ranks = torch.zeros(cap_embs.size(0), dtype=torch.long)
+
+    for start in range(0, cap_embs.size(0), block):
+        end = min(start + block, cap_embs.size(0))
+        sims = cap_embs[start:end].to(device) @ img_embs.t()
+        target = targets[start:end].to(device)
+        gold = sims.gather(1, target.clamp(min=0).unsqueeze(1))
+        rank = (sims > gold).sum(dim=1)
+        ranks[start:end] = torch.where(target >= 0, rank, torch.full_like(rank, NO_GT_RANK)).cpu()
+        top[start:end] = sims.topk(k, dim=1)[1].cpu()
+    return top, ranks
+
+
+def rerank(score_fn, dataset, top, device, caption_block=1):
+    """
+    score_fn scores of every caption with the images of its shortlist
+    score_fn: scores of aligned (caption, image) pairs
+    --> (n_captions, k) scores
+    """
+    question, input_mask, segment_ids = dataset.captions()
+    n_captions, k = top.size()
+    scores = torch.zeros((n_captions, k))
+
+    with torch.no_grad():
+        for start in range(0, n_captions, caption_block):
+            end = min(start + caption_block, n_captions)
+            index = top[start:end].reshape(-1)
+            pairs = [t[start:end].repeat_interleave(k, dim=0).to(device) for t in [question, input_mask, segment_ids]]
+            images = [t.to(device, non_blocking=True) for t in dataset.images(index)]
+            scores[start:end] = score_fn(*pairs, *images).float().view(-1, k).cpu()
+    return scores
+
+
+def two_stage_ranks(score_fn, dataset, pooled_path, device, k=100, caption_block=1):
+    """
+    --> (ranks after the first stage, ranks after re-ranking, re-ranked top k image indices, timings)
+    """
+    targets = torch.from_numpy(dataset.caption_targets)
+
+    start_time = time.time()
+    cap_embs, img_embs = load_pooled(pooled_path, dataset)
+    top, ranks_first = shortlist(cap_embs, img_embs, targets, k, device)
+    first_time = time.time() - start_time
+
+    start_time = time.time()
+    scores = rerank(score_fn, dataset, top, device, caption_block)
+    second_time = time.time() - start_time
+
+    # rank of the ground truth within the shortlist, first stage rank when it is not in it
+    in_top = top == targets.unsqueeze(1)
+    found = in_top.any(dim=1)
+    gold = (scores * in_top.float()).sum(dim=1, keepdim=True)
+    ranks = torch.where(found, ((scores > gold) & ~in_top).sum(dim=1), ranks_first)
+
+    order = scores.argsort(dim=1, descending=True)
+    reranked = top.gather(1, order)
+
+    # cost of scoring every pair with ViLBERT, estimated from the time per re-ranked pair
+    full_time = second_time / top.numel() * top.size(0) * img_embs.size(0)
+    timings = {"first_stage": first_time, "second_stage": second_time, "full_estimate": full_time,
+               "speedup_estimate": full_time / max(first_time + second_time, 1e-9)}
+    return ranks_first.numpy(), ranks.numpy(), reranked.numpy(), timings